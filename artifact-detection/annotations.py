@@ -0,0 +1,52 @@
+import numpy as np
+import mne
+
+
+def add_bad_annotations(raw, starts, stops, description):
+    """
+    Add [start, stop) sample intervals to raw as annotations; with a 'BAD' description, mne.Epochs
+    rejects the epochs overlapping them (reject_by_annotation=True is the default).
+
+    Annotation onsets depend on the measurement date: with one, they are relative to it and the
+    intervals are shifted by raw.first_time; without one (orig_time None), set_annotations takes
+    onsets relative to the first sample and stores them shifted by raw.first_time itself, so the
+    existing annotations are brought back to the first sample before being set again.
+
+    Parameters:
+    raw (mne.io.Raw): Recording the intervals were detected on.
+    starts (numpy.ndarray): Interval start samples, relative to the first sample of raw.
+    stops (numpy.ndarray): Interval stop samples (exclusive).
+    description (str): Annotation label.
+    """
+    starts = np.asarray(starts)
+    onset = starts / raw.info['sfreq']
+    duration = (np.asarray(stops) - starts) / raw.info['sfreq']
+    existing = raw.annotations.copy()
+    if existing.orig_time is not None:
+        onset = onset + raw.first_time
+    else:
+        existing.onset = existing.onset - raw.first_time
+    annotations = mne.Annotations(onset, duration, [description] * len(onset), orig_time=existing.orig_time)
+    raw.set_annotations(existing + annotations)
+
+
+if __name__ == '__main__':
+    # Check both onset conventions: a recording with and without a measurement date, not starting at
+    # sample 0 and with an existing annotation, must keep it in place and add the new one at 3 s
+    from datetime import datetime, timezone
+
+    for meas_date in (None, datetime(2020, 1, 1, tzinfo=timezone.utc)):
+        raw = mne.io.RawArray(np.zeros((1, 1000)), mne.create_info(1, 100.0, 'eeg'), first_samp=200, verbose=False)
+        raw.set_meas_date(meas_date)
+        existing_onset = 5.0 + (raw.first_time if raw.annotations.orig_time is not None else 0.0)
+        raw.set_annotations(mne.Annotations([existing_onset], [1.0], ['BAD_existing'], orig_time=raw.annotations.orig_time))
+        stored = raw.annotations.onset.copy()
+
+        add_bad_annotations(raw, np.array([300]), np.array([400]), 'BAD_new')
+        new = raw.annotations.description == 'BAD_new'
+        assert np.allclose(raw.annotations.onset[~new], stored), (meas_date, raw.annotations.onset)
+        # Epochs at 3.5 s (new annotation) and 5.5 s (existing one) are rejected, the one at 8 s is kept
+        events = np.array([[raw.first_samp + sample, 0, 1] for sample in (350, 550, 800)])
+        epochs = mne.Epochs(raw, events, tmin=0, tmax=0.05, baseline=None, preload=True, verbose=False)
+        assert list(epochs.selection) == [2], (meas_date, raw.annotations.onset, epochs.drop_log)
+        print(f"meas_date={meas_date}: onsets {raw.annotations.onset} OK")
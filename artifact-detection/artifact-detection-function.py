@@ -1,54 +1,113 @@
+import os
 import numpy as np
 import mne
+from annotations import add_bad_annotations
 
-def detect_artifacts(raw_data, threshold_factor=8):
+def window_stats(raw_data, window, step, block_size=16):
+    """
+    Per-channel mean, standard deviation and peak-to-peak amplitude over sliding windows.
+
+    Mean and standard deviation come from cumulative sums and peak-to-peak from a strided view of the
+    data, so no window is copied; channels are processed in blocks to bound the temporary arrays.
+
+    Parameters:
+    raw_data (numpy.ndarray): EEG data (channels x samples).
+    window (int): Window length in samples.
+    step (int): Step between window starts in samples.
+    block_size (int): Number of channels processed at a time.
+
+    Returns:
+    tuple: Window start samples and the (channels x windows) mean, std and peak-to-peak arrays.
+    """
+    n_channels, n_samples = raw_data.shape
+    starts = np.arange(0, n_samples - window + 1, step)
+    mean = np.empty((n_channels, len(starts)))
+    std = np.empty((n_channels, len(starts)))
+    ptp = np.empty((n_channels, len(starts)))
+
+    for first in range(0, n_channels, block_size):
+        block = raw_data[first:first + block_size]
+        # Centre each channel so the running sums do not lose precision
+        offset = block.mean(axis=1, keepdims=True)
+        centred = block - offset
+        cumsum = np.zeros((len(block), n_samples + 1))
+        np.cumsum(centred, axis=1, out=cumsum[:, 1:])
+        window_mean = (cumsum[:, starts + window] - cumsum[:, starts]) / window
+        np.cumsum(centred ** 2, axis=1, out=cumsum[:, 1:])
+        window_power = (cumsum[:, starts + window] - cumsum[:, starts]) / window
+
+        mean[first:first + block_size] = window_mean + offset
+        std[first:first + block_size] = np.sqrt(np.maximum(window_power - window_mean ** 2, 0))
+        windows = np.lib.stride_tricks.sliding_window_view(block, window, axis=1)[:, ::step]
+        ptp[first:first + block_size] = windows.max(axis=-1) - windows.min(axis=-1)
+
+    return starts, mean, std, ptp
+
+
+def robust_z(values):
+    """
+    Robust z-score of each channel's window statistic against that channel's median and MAD.
+    Channels with zero MAD (e.g. a flat reference) get a z-score of 0.
+    """
+    median = np.median(values, axis=1, keepdims=True)
+    mad = 1.4826 * np.median(np.abs(values - median), axis=1, keepdims=True)
+    z = np.zeros_like(values)
+    np.divide(values - median, mad, out=z, where=mad > 0)
+    return z
+
+
+def detect_artifacts(raw_data, sfreq, window_sec=1.0, overlap=0.5, threshold_factor=8, ptp_threshold=None):
     """
     Automatically detect artifacts in the EEG data.
 
+    A window is flagged when, on any channel, its mean, standard deviation or peak-to-peak amplitude
+    deviates from that channel's typical window by more than threshold_factor robust SDs, or when its
+    peak-to-peak amplitude exceeds ptp_threshold. Overlapping flagged windows are merged.
+
     Parameters:
     raw_data (numpy.ndarray): Raw EEG data (channels x samples).
-    threshold_factor (float): Factor to multiply the channel variance threshold (default=3).
+    sfreq (float): Sampling rate in Hz.
+    window_sec (float): Window length in seconds (default=1.0).
+    overlap (float): Fraction of overlap between consecutive windows (default=0.5).
+    threshold_factor (float): Robust z-score above which a window is flagged (default=8).
+    ptp_threshold (float): Optional absolute peak-to-peak limit in the units of raw_data (e.g. volts).
 
     Returns:
-    tuple: Tuple containing start and end time indices of the detected artifact, or None if no artifact is detected.
+    numpy.ndarray: Artifact intervals (n_intervals x 2) as [start, stop) sample indices, empty if none.
+    """
+    window = int(round(window_sec * sfreq))
+    step = max(1, int(round(window * (1 - overlap))))
+    starts, mean, std, ptp = window_stats(raw_data, window, step)
+
+    flagged = ((np.abs(robust_z(mean)) > threshold_factor) |
+               (robust_z(std) > threshold_factor) |
+               (robust_z(ptp) > threshold_factor)).any(axis=0)
+    if ptp_threshold is not None:
+        flagged |= (ptp > ptp_threshold).any(axis=0)
+
+    flagged_starts = starts[flagged]
+    if len(flagged_starts) == 0:
+        return np.empty((0, 2), dtype=int)
+
+    # Windows that overlap or touch belong to the same artifact interval
+    breaks = np.flatnonzero(np.diff(flagged_starts) > window) + 1
+    first = np.r_[0, breaks]
+    last = np.r_[breaks - 1, len(flagged_starts) - 1]
+    return np.column_stack((flagged_starts[first], flagged_starts[last] + window))
+
+
+def add_artifact_annotations(raw, intervals, description='BAD_artifact'):
+    """
+    Add artifact intervals to raw as annotations; epochs overlapping them are then rejected by
+    mne.Epochs (reject_by_annotation=True is the default).
+
+    Parameters:
+    raw (mne.io.Raw): Recording the intervals were detected on.
+    intervals (numpy.ndarray): Output of detect_artifacts.
+    description (str): Annotation label; it must start with 'BAD' for automatic rejection.
     """
-    # Calculate the variance of each channel across the entire recording
-    channel_variances = np.var(raw_data, axis=1)
-
-    # Identify channels with unusually high variance
-    high_variance_channels = \
-    np.where(channel_variances > np.mean(channel_variances) + threshold_factor * np.std(channel_variances))[0]
-
-    # Initialize variables to track the start and end time indices of the artifact
-    artifact_start_idx = None
-    artifact_end_idx = None
-
-    # Loop through all segments of 1-second duration with 50% overlap
-    segment_length = raw_data.shape[1] // 2
-    for i in range(0, raw_data.shape[1], segment_length):
-        segment_start_idx = i
-        segment_end_idx = min(i + segment_length, raw_data.shape[1])
-
-        # Check activity during the segment for each high variance channel
-        for ch_idx in high_variance_channels:
-            channel_activity = raw_data[ch_idx, segment_start_idx:segment_end_idx]
-            channel_mean_activity = np.mean(channel_activity)
-            channel_std_activity = np.std(channel_activity)
-
-            # Calculate threshold for detecting artifacts (e.g., 3 SD from mean activity)
-            threshold = channel_mean_activity + threshold_factor * channel_std_activity
-
-            # Check if any activity during the segment exceeds the threshold
-            if np.any(channel_activity > threshold):
-                if artifact_start_idx is None:
-                    artifact_start_idx = segment_start_idx
-                artifact_end_idx = segment_end_idx
-
-    # Return the start and end time indices of the detected artifact
-    if artifact_start_idx is not None and artifact_end_idx is not None:
-        return artifact_start_idx, artifact_end_idx
-    else:
-        return None
+    add_bad_annotations(raw, intervals[:, 0], intervals[:, 1], description)
+
 
 # Set parameters for fif path
 sub = 'pilot-3'
@@ -61,14 +120,22 @@ fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
 # Load the data in MNE
 raw = mne.io.read_raw_fif(fif_path, preload=True)
 
-# Extract EEG data
-raw_data = raw.get_data()
+# Extract EEG data (EEG channels only, the trigger channel would be flagged on every stimulus)
+raw_data = raw.get_data(picks='eeg')
 
-# Detect artifacts in the EEG data
-artifact_indices = detect_artifacts(raw_data)
-if artifact_indices is not None:
-    start_time = raw.times[artifact_indices[0]]
-    end_time = raw.times[artifact_indices[1]]
-    print("Artifact detected from {}s to {}s.".format(start_time, end_time))
-else:
+# Detect artifacts in the EEG data with 1-second windows and 50% overlap
+artifact_intervals = detect_artifacts(raw_data, raw.info['sfreq'], window_sec=1.0, overlap=0.5)
+for start_idx, stop_idx in artifact_intervals:
+    print("Artifact detected from {}s to {}s.".format(raw.times[start_idx], raw.times[stop_idx - 1]))
+if len(artifact_intervals) == 0:
     print("No artifact detected.")
+
+# Mark the artifacts as BAD_artifact annotations so epoching rejects them automatically
+add_artifact_annotations(raw, artifact_intervals)
+
+# Save the annotations for the preprocessing scripts
+annotations_dir = os.path.join(base_path, 'derivatives', 'individual', 'artifact_annotations')
+os.makedirs(annotations_dir, exist_ok=True)
+annotations_path = os.path.join(annotations_dir, f'{sub}_{seg}_{stim}_artifact-annot.fif')
+raw.annotations.save(annotations_path, overwrite=True)
+print(f"Artifact annotations saved to: {annotations_path}")
@@ -1,6 +1,109 @@
 import mne
 import numpy as np
+import pandas as pd
 import os
+from scipy.signal import find_peaks, peak_widths
+from scipy.stats import skew
+from annotations import add_bad_annotations
+
+
+def channel_correlations(raw, ref_channels, chunk_sec=10.0):
+    """
+    Correlation of every channel with each reference (EOG) channel, streamed over the recording.
+
+    Only the (channels x references) sums are accumulated chunk by chunk, so the full
+    channels x channels correlation matrix is never formed and raw does not need to be preloaded.
+
+    Parameters:
+    raw (mne.io.Raw): Recording, preloaded or not.
+    ref_channels (list): Reference channel names, e.g. ['E127', 'E128'].
+    chunk_sec (float): Chunk length in seconds.
+
+    Returns:
+    numpy.ndarray: Correlations (n_channels x n_references).
+    """
+    ref_idx = [raw.ch_names.index(ch_name) for ch_name in ref_channels]
+    chunk = int(np.ceil(chunk_sec * raw.info['sfreq']))
+    n_total = 0
+    shift = None
+
+    for start in range(0, raw.n_times, chunk):
+        data = raw.get_data(start=start, stop=min(start + chunk, raw.n_times))
+        if shift is None:
+            # Shift by the first chunk's mean so the running sums do not lose precision
+            shift = data.mean(axis=1, keepdims=True)
+            sum_x = np.zeros(len(data))
+            sum_xx = np.zeros(len(data))
+            sum_xr = np.zeros((len(data), len(ref_idx)))
+        data = data - shift
+        sum_x += data.sum(axis=1)
+        sum_xx += (data ** 2).sum(axis=1)
+        sum_xr += data @ data[ref_idx].T
+        n_total += data.shape[1]
+
+    mean = sum_x / n_total
+    cov = sum_xr / n_total - np.outer(mean, mean[ref_idx])
+    std = np.sqrt(np.maximum(sum_xx / n_total - mean ** 2, 0))
+    denom = np.outer(std, std[ref_idx])
+    corr = np.zeros_like(cov)
+    np.divide(cov, denom, out=corr, where=denom > 0)
+    return corr
+
+
+def detect_blinks(eog, sfreq, threshold=None, threshold_factor=5, min_interval_sec=0.3, polarity='auto'):
+    """
+    Detect blinks as peaks of an EOG trace.
+
+    Parameters:
+    eog (numpy.ndarray): EOG trace (samples), ideally band-passed around 1-10 Hz.
+    sfreq (float): Sampling rate in Hz.
+    threshold (float): Minimum peak amplitude above the median; defaults to threshold_factor robust SDs.
+    threshold_factor (float): Robust SDs used when threshold is None (default=5).
+    min_interval_sec (float): Minimum time between two blinks in seconds (default=0.3).
+    polarity (str or int): 1 for positive blinks, -1 for negative, 'auto' to use the sign of the skew.
+
+    Returns:
+    pandas.DataFrame: One row per blink with onset, peak and offset samples (half-amplitude crossings)
+    and the peak amplitude.
+    """
+    if polarity == 'auto':
+        # Blinks are rare, large deflections, so they dominate the skew of the trace
+        polarity = 1 if skew(eog) >= 0 else -1
+    signal = polarity * (eog - np.median(eog))
+    if threshold is None:
+        threshold = threshold_factor * 1.4826 * np.median(np.abs(signal))
+
+    peaks, properties = find_peaks(signal, height=threshold, distance=max(1, int(min_interval_sec * sfreq)))
+    _, _, left, right = peak_widths(signal, peaks, rel_height=0.5)
+    return pd.DataFrame({
+        'onset': np.floor(left).astype(int),
+        'peak': peaks,
+        'offset': np.ceil(right).astype(int),
+        'amplitude': polarity * properties['peak_heights'],
+    })
+
+
+def blink_events(blinks, first_samp=0, event_id=998):
+    """
+    MNE events array (n_blinks x 3) with one event at each blink peak.
+    """
+    events = np.zeros((len(blinks), 3), dtype=int)
+    events[:, 0] = blinks['peak'].values + first_samp
+    events[:, 2] = event_id
+    return events
+
+
+def add_blink_annotations(raw, blinks, description='BAD_blink'):
+    """
+    Add each blink from onset to offset to raw as an annotation.
+
+    Parameters:
+    raw (mne.io.Raw): Recording the blinks were detected on.
+    blinks (pandas.DataFrame): Output of detect_blinks.
+    description (str): Annotation label; a 'BAD' prefix makes mne.Epochs reject overlapping epochs.
+    """
+    add_bad_annotations(raw, blinks['onset'].values, blinks['offset'].values, description)
+
 
 # Set parameters for fif path
 sub = 'pilot-3'
@@ -10,34 +113,34 @@ seg = 'segment_2'
 base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
 fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
 
-# Load the data in MNE
-raw = mne.io.read_raw_fif(fif_path, preload=True)
+# Load the data in MNE (read lazily, the correlations are computed chunk by chunk)
+raw = mne.io.read_raw_fif(fif_path, preload=False)
 
 # Identify channels that correlate with E127 and E128
 blink_channels = ['E127', 'E128']
-correlated_channels = []
-for ch_name in blink_channels:
-    ch_idx = raw.ch_names.index(ch_name)
-    try:
-        corr_matrix = np.corrcoef(raw._data)
-    except Exception as e:
-        print(f"Error computing correlation matrix for channel {ch_name}: {e}")
-        continue
-    correlated_channels.extend(np.where(np.abs(corr_matrix[ch_idx, :]) > 0.7)[0])
-
-# Identify the timepoints where blink artifacts occur
-blink_artifact_indices = []
-for ch_name in blink_channels:
-    ch_idx = raw.ch_names.index(ch_name)
-    try:
-        channel_data = raw._data[ch_idx]
-        blink_threshold = 1  # Adjust as needed
-        blink_artifact_indices.extend(np.where(channel_data > blink_threshold)[0])
-    except Exception as e:
-        print(f"Error processing data for channel {ch_name}: {e}")
-
-# Print the timepoints where blink artifacts occur
-blink_times = raw.times[blink_artifact_indices]
-print("Timepoints where blink artifacts occur:")
-for time in blink_times:
-    print(f"{time:.3f} seconds")
+corr = channel_correlations(raw, blink_channels)
+correlated_channels = [raw.ch_names[idx] for idx in np.flatnonzero((np.abs(corr) > 0.7).any(axis=1))]
+print(f"Channels correlated with {blink_channels}: {correlated_channels}")
+
+# Build the EOG trace from the blink channels and band-pass it around the blink frequencies
+eog = raw.get_data(picks=blink_channels).mean(axis=0)
+eog = mne.filter.filter_data(eog, raw.info['sfreq'], l_freq=1.0, h_freq=10.0, verbose='WARNING')
+
+# Detect blinks as peaks with onset and offset
+blinks = detect_blinks(eog, raw.info['sfreq'])
+blinks['onset_time'] = raw.times[blinks['onset']]
+blinks['peak_time'] = raw.times[blinks['peak']]
+blinks['offset_time'] = raw.times[blinks['offset']]
+print(f"Detected {len(blinks)} blinks:")
+print(blinks[['onset_time', 'peak_time', 'offset_time', 'amplitude']].to_string(index=False, float_format='%.3f'))
+
+# Blink events for epoching around blinks, and BAD_blink annotations for rejecting epochs with blinks
+events = blink_events(blinks, first_samp=raw.first_samp)
+add_blink_annotations(raw, blinks)
+
+# Save the blink event table
+blinks_dir = os.path.join(base_path, 'derivatives', 'individual', 'blinks')
+os.makedirs(blinks_dir, exist_ok=True)
+blinks_path = os.path.join(blinks_dir, f'{sub}_{seg}_{stim}_blinks.tsv')
+blinks.to_csv(blinks_path, sep='\t', index=False)
+print(f"Blink events saved to: {blinks_path}")
@@ -2,6 +2,12 @@ import mne
 import numpy as np
 import pandas as pd
 import os
+import sys
+
+# Shared pipeline helpers live in scripts/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from evoked import accumulate_evoked
+from annotation_index import load_annotation_index
 
 # Set parameters for fif path
 sub = 'pilot-2'
@@ -11,7 +17,6 @@ comp = 'no-ica'  # or 'with-ica' depending on your analysis
 
 base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
 fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
-word_path = f'{base_path}/annotations/words/tsv/{stim}-words.tsv'
 
 # Load the data in MNE
 raw = mne.io.read_raw_fif(fif_path, preload=True)
@@ -40,15 +45,12 @@ summary_stats_filepath = os.path.join(base_path, 'segmented_data', 'summary_stat
 summary_stats.to_csv(summary_stats_filepath, index=False)
 print(f"\nSummary statistics saved to '{summary_stats_filepath}'")
 
-# Load metadata for words from annotations
-word_info = pd.read_csv(word_path, delimiter='\t', encoding='utf-8')
+# Word events and aligned metadata from the annotation index (rounded onsets, coincident onsets dropped)
+sampling_rate = raw.info['sfreq']
+word_events, word_info = load_annotation_index(base_path).events('words', stim, sampling_rate)
 
 # Create word epochs
-sampling_rate = raw.info['sfreq']
-word_onsets = (word_info['Start'].values * sampling_rate).astype(int)
-word_events = np.column_stack((word_onsets, np.zeros_like(word_onsets), np.ones_like(word_onsets)))
-word_epochs = mne.Epochs(raw, word_events, tmin=-0.2, tmax=0.6, baseline=None, preload=True)
-word_epochs.metadata = word_info  # Assign metadata to word epochs
+word_epochs = mne.Epochs(raw, word_events, tmin=-0.2, tmax=0.6, baseline=None, preload=False, metadata=word_info)
 
 # Define the directory path for saving word epochs
 word_epochs_dir = os.path.join(base_path, 'derivatives', 'individual', 'word_epochs')
@@ -60,8 +62,8 @@ word_epochs_filepath = os.path.join(word_epochs_dir, word_epochs_filename)
 word_epochs.save(word_epochs_filepath, overwrite=True)
 print(f"Word epochs saved to: {word_epochs_filepath}")
 
-# Average epochs for evoked response
-word_evoked = word_epochs.average()
+# Average epochs for evoked response, streaming the epochs in chunks instead of loading them all
+word_evoked = accumulate_evoked(word_epochs).evoked()
 
 # Define the path for saving the evoked figure
 evoked_fig_name = f'word-evoked-{sub}-{stim}_{seg}.jpg'
@@ -4,6 +4,12 @@ import pandas as pd
 import os
 from mne.preprocessing import ICA
 import json
+import sys
+
+# Shared helpers live in scripts/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from ica_selection import select_components, save_excluded_components
+from annotation_index import load_annotation_index
 
 # Set parameters for fif path
 sub = 'pilot-3'
@@ -13,7 +19,6 @@ comp = 'no-ica'
 
 base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
 fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
-word_path = f'{base_path}/annotations/words/tsv/{stim}-words.tsv'
 
 # Load the data in MNE
 raw = mne.io.read_raw_fif(fif_path, preload=True)
@@ -28,24 +33,13 @@ raw.notch_filter(60)
 ica = ICA(n_components=20, random_state=35)
 ica.fit(raw)
 
-ica.plot_sources(raw)
-
-# Select components from ICA to remove
-ica.exclude = []
-
-# Save the excluded components to a JSON file
-excluded_components = {
-    'subject': sub,
-    'segment': seg,
-    'stimulus': stim,
-    'excluded_components': ica.exclude
-}
-json_dir = os.path.join(base_path, 'derivatives', 'individual', 'ica_excluded_components')
-os.makedirs(json_dir, exist_ok=True)
-json_filename = f'{sub}_{seg}_{stim}_excluded_components.json'
-json_filepath = os.path.join(json_dir, json_filename)
-with open(json_filepath, 'w') as json_file:
-    json.dump(excluded_components, json_file)
+# ica.plot_sources(raw)
+
+# Select components from ICA to remove from their EOG correlation, spectral slope and kurtosis
+component_scores = select_components(ica, raw)
+
+# Save the excluded components and their scores to a JSON file
+save_excluded_components(base_path, sub, seg, stim, ica.exclude, component_scores)
 
 ica.apply(raw)
 
@@ -60,25 +54,14 @@ raw.pick_channels(eeg_channels)
 # Apply common average reference (CAR) across remaining electrodes
 raw_car = raw.set_eeg_reference('average', projection=True)
 
-# Load metadata for words from annotations
-word_info = pd.read_csv(word_path, delimiter='\t', encoding='utf-8')
-
-# Create word epochs
+# Word events and aligned metadata from the annotation index (rounded onsets, coincident onsets dropped),
+# so the events and the metadata rows always match
 sampling_rate = raw.info['sfreq']
-word_onsets = (word_info['Start'].values * sampling_rate).astype(int)
-word_events = np.column_stack((word_onsets, np.zeros_like(word_onsets), np.ones_like(word_onsets)))
-
-# Check if the number of word events matches the number of rows in word_info
+word_events, word_info = load_annotation_index(base_path).events('words', stim, sampling_rate)
 print("Number of word events:", len(word_events))
-print("Number of rows in word_info:", len(word_info))
 
-# Ensure that the lengths match
-min_length = min(len(word_events), len(word_info))
-word_events = word_events[:min_length]
-word_info = word_info.iloc[:min_length]
-
-word_epochs = mne.Epochs(raw_car, word_events, tmin=-0.1, tmax=0.3, baseline=None, reject=None, flat=None, preload=True)
-word_epochs.metadata = word_info  # Assign metadata to word epochs
+# Create word epochs
+word_epochs = mne.Epochs(raw_car, word_events, tmin=-0.1, tmax=0.3, baseline=None, reject=None, flat=None, preload=True, metadata=word_info)
 
 # Define the directory path for saving word epochs
 word_epochs_dir = os.path.join(base_path, 'derivatives', 'individual', 'word_epochs')
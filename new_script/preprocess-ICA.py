@@ -3,6 +3,15 @@ import numpy as np
 import pandas as pd
 import os
 import matplotlib.pyplot as plt
+import sys
+
+# Shared helpers live in scripts/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from ica_selection import select_components, save_excluded_components
+from bad_channels import detect_bad_channels
+from filtering import fused_filter
+from normalization import normalize
+from annotation_index import load_annotation_index
 
 # Set parameters for fif path
 sub = 'pilot-3'
@@ -11,7 +20,6 @@ seg = 'segment_8'
 comp = 'with-ica1'  # two options: 'no-ica' or 'with-ica'
 
 base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
-word_path = f'{base_path}/annotations/words/tsv/{stim}-words.tsv'
 fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
 
 # Load the data in MNE
@@ -22,19 +30,8 @@ raw = mne.io.read_raw_fif(fif_path, preload=True)
 # Get sampling rate
 sampling_rate = raw.info['sfreq']
 
-# Calculate mean and standard deviation across all electrodes
-data = raw.get_data()  # Get the EEG data
-mean_data = np.mean(data, axis=1)  # Calculate mean across channels
-std_data = np.std(data, axis=1)  # Calculate standard deviation across channels
-
-# Define threshold for identifying bad electrodes (e.g., 5 SD)
-threshold = 10 * np.mean(std_data)
-
-# Find indices of electrodes exceeding the threshold
-bad_indices = np.where(np.abs(mean_data) > threshold)[0]
-
-# Convert indices to channel names
-bad_channels = [raw.ch_names[idx] for idx in bad_indices]
+# Detect bad electrodes from robust amplitude, flatline, high-frequency noise and neighbour correlation
+bad_channels, channel_stats = detect_bad_channels(raw)
 
 # Interpolate bad electrodes
 raw.info['bads'] = bad_channels
@@ -52,19 +49,19 @@ ica = mne.preprocessing.ICA(n_components=20, random_state=97)
 ica.fit(raw)
 
 # Plot ICA components for visual inspection
-ica.plot_components()
+# ica.plot_components()
 
-# Exclude blink-related components interactively
-ica.exclude = [18,19,20]  # Set to your excluded components
+# Exclude blink-related components from their EOG correlation, spectral slope and kurtosis
+component_scores = select_components(ica, raw)
+
+# Save the excluded components and their scores to a JSON file
+save_excluded_components(base_path, sub, seg, stim, ica.exclude, component_scores)
 
 # Apply ICA artifact removal
 ica.apply(raw)
 
-# Apply Notch filter
-raw.notch_filter(60)
-
-# Apply bandpass filter
-raw.filter(l_freq=1.0, h_freq=15.0)
+# Notch (60 Hz) and band-pass (1-15 Hz) filter in a single pass
+fused_filter(raw, l_freq=1.0, h_freq=15.0, notch_freq=60)
 
 # Re-reference the data using the 'VREF' channel
 raw.set_eeg_reference(['VREF'])
@@ -76,27 +73,18 @@ raw = raw.pick_channels(eeg_channels)
 # Apply common average reference (CAR) across remaining electrodes
 raw_car = raw.set_eeg_reference('average', projection=True)
 
-# Z-score the data
-data = raw_car.get_data()
-mean_data = np.mean(data, axis=1)
-std_data = np.std(data, axis=1)
-zscore_data = (data - mean_data[:, np.newaxis]) / std_data[:, np.newaxis]
-
-# Create a new Raw object with z-scored data
-raw_zscored = mne.io.RawArray(zscore_data, raw_car.info)
+# Z-score the data in place into a float32 buffer (raw_zscored is the same object as raw_car)
+raw_zscored = normalize(raw_car, dtype=np.float32)
 
-# Load metadata for words from annotations
-word_info = pd.read_csv(word_path, delimiter='\t', encoding='utf-8')
+# Word events and aligned metadata from the annotation index (rounded onsets, coincident onsets dropped)
+word_events, word_info = load_annotation_index(base_path).events('words', stim, sampling_rate)
 
 # Create word epochs
-word_onsets = (word_info['Start'].values * sampling_rate).astype(int)
-word_events = np.column_stack((word_onsets, np.zeros_like(word_onsets), np.ones_like(word_onsets)))
 
 # Ensure picks for epoching are within the valid range
 picks = mne.pick_types(raw_zscored.info, eeg=True)
 
-word_epochs = mne.Epochs(raw_zscored, word_events, tmin=-0.2, tmax=0.6, baseline=None, reject=None, flat=None, picks=picks)
-word_epochs.metadata = word_info  # Assign metadata to word epochs
+word_epochs = mne.Epochs(raw_zscored, word_events, tmin=-0.2, tmax=0.6, baseline=None, reject=None, flat=None, picks=picks, metadata=word_info)
 
 # Define the directory path for saving word epochs
 word_epochs_dir = os.path.join(base_path, 'derivatives', 'individual', 'word_epochs')
@@ -4,9 +4,16 @@ import librosa
 import os
 import pandas as pd
 from collections import defaultdict
+from segmentation import find_event_runs, save_segment
+from filtering import filter_to_file
 
 sub = 'pilot-3'
 
+# Optionally notch and band-pass filter the whole session before segmentation (out of core, in chunks)
+filter_session = False
+notch_freq = 60
+l_freq, h_freq = 1.0, 15.0
+
 base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
 
 # Set file path
@@ -17,8 +24,8 @@ segmented_data_dir = f'{base_path}/segmented_data'
 sub_dir = os.path.join(segmented_data_dir, sub)
 os.makedirs(sub_dir, exist_ok=True)
 
-# Read in mff data with read_raw_egi
-raw = mne.io.read_raw_egi(file)
+# Read in mff data with read_raw_egi (not preloaded, data is only read in chunks below)
+raw = mne.io.read_raw_egi(file, preload=False)
 
 # Get channel names
 channel_names = raw.ch_names
@@ -35,16 +42,10 @@ reference_channel_name = 'VREF'
 reference_channel_index = channel_names.index(reference_channel_name)
 print(f"\nReference channel '{reference_channel_name}' found at index:", reference_channel_index)
 
-# Extract EEG data
-eeg_data = raw.get_data()
-
-# Print shape of EEG data
-print("\nShape of EEG data:", np.shape(eeg_data))
+# Print shape of EEG data without loading it
+print("\nShape of EEG data:", (raw.info['nchan'], raw.n_times))
 
-# Access trigger channel data
-trigger_channel_data = eeg_data[trigger_channel_index, :]
-
-# Find events for channel 1 only
+# Find events for channel 1 only (reads just the trigger channel)
 events = mne.find_events(raw, stim_channel=trigger_channel_name)
 
 # Filter events where the third column is equal to 1
@@ -78,44 +79,9 @@ csv_filepath = os.path.join(save_dir, csv_filename)
 event_timestamps.to_csv(csv_filepath, index=False)
 print(f"\nEvent timestamps saved to '{csv_filepath}'")
 
-# Sort the events by timestamp
-event_timestamps = event_timestamps.sort_values('Timestamp')
-
-# Initialize variables to keep track of segments
-segments = []
-segment_start = None
-prev_timestamp = None
-prev_event = None
-
-# Iterate through the events
-for _, row in event_timestamps.iterrows():
-    timestamp = row['Timestamp']
-    event = row['Event']
-
-    # Check if at the start of a new segment
-    if segment_start is None:
-        segment_start = timestamp
-        prev_event = event
-    else:
-        # If the difference between the current and previous timestamp is greater than 20 seconds or
-        # the current event is different from the previous event, it's the start of a new segment
-        if (timestamp - prev_timestamp > 20) or (event != prev_event):
-            segment_end = prev_timestamp
-            segment_duration = segment_end - segment_start
-            segments.append((segment_start, segment_end, prev_event, segment_duration))
-            segment_start = timestamp
-            prev_event = event
-
-    prev_timestamp = timestamp
-
-# Add the last segment if it exists
-if segment_start is not None:
-    segment_end = prev_timestamp
-    segment_duration = segment_end - segment_start
-    segments.append((segment_start, segment_end, prev_event, segment_duration))
-
-# Create a DataFrame from the segments list
-segments_df = pd.DataFrame(segments, columns=['start', 'end', 'event', 'duration'])
+# Split the triggers into segments wherever the gap exceeds 20 seconds or the event changes
+segments_df = find_event_runs(event_timestamps['Sample'].values, event_timestamps['Event'].values, sample_rate,
+                              max_gap_sec=20.0)
 
 # Save the segments DataFrame as a CSV file
 segments_csv_filename = f'{sub}_segments.csv'
@@ -135,25 +101,27 @@ wav_files = ['Jobs1.wav', 'Jobs2.wav', 'Jobs3.wav',
 # Get the sample rate from the raw data
 sampling_rate = raw.info['sfreq']
 
+if filter_session:
+    # Filter the session chunk by chunk into a memory-mapped array, then segment from that array
+    filtered_path = os.path.join(sub_dir, f'{sub}_filtered.npy')
+    raw = filter_to_file(raw, filtered_path, l_freq=l_freq, h_freq=h_freq, notch_freq=notch_freq, chunk_sec=10.0)
+
 # Iterate through the segments and WAV files
 for i, (_, segment) in enumerate(segments_df.iterrows()):
     filename = wav_files[i]
-    start_time = segment['start']
-    end_time = segment['end']
     wav_duration = wav_durations_df.loc[wav_durations_df['filename'] == filename, 'duration'].values[0]
 
-    # Convert times to samples
-    start_sample = int(start_time * sampling_rate)
-    end_sample = int(end_time * sampling_rate)
+    # Segment boundaries in samples relative to the start of the recording
+    start_sample = int(segment['start_sample']) - raw.first_samp
+    end_sample = int(segment['end_sample']) - raw.first_samp
 
-    # Extract the segment
-    segment_data = raw.get_data(start=start_sample, stop=end_sample)
-
-    # Create a new Raw object for the segment
-    segment_raw = mne.io.RawArray(segment_data, raw.info, verbose='WARNING')
-
-    # Save the segment as a FIF file
+    # Copy the segment from the recording into a FIF file in bounded chunks
     segment_filename = f'{sub}_segment_{i + 1}_{filename.split(".")[0]}_eeg.fif'
     segment_filepath = os.path.join(sub_dir, segment_filename)
-    segment_raw.save(segment_filepath, overwrite=True)
-    print(f"Segment {i + 1} saved as '{segment_filepath}'")
\ No newline at end of file
+    save_segment(raw, start_sample, end_sample, segment_filepath, chunk_sec=10.0)
+    print(f"Segment {i + 1} saved as '{segment_filepath}'")
+
+if filter_session:
+    # The segments hold the filtered data, the session-length array is no longer needed
+    del raw
+    os.remove(filtered_path)
@@ -6,159 +6,117 @@ import matplotlib.pyplot as plt
 from mne.preprocessing import ICA
 import json
 from scipy.stats import zscore
+from evoked import accumulate_evoked
+from ica_selection import save_excluded_components
+from subject_ica import load_subject_ica
+from ica_figures import render_ica_figures, wait_for_figures
+from bad_channels import detect_bad_channels, interpolate_bads_cached
+from filtering import fused_filter
+from annotation_index import load_annotation_index
 
-# Set parameters for fif path
-sub = 'pilot-2'
-stim = 'Jobs2'
-seg = 'segment_2'
-comp = 'ica'
+if __name__ == '__main__':
+    # Set parameters for fif path
+    sub = 'pilot-2'
+    stim = 'Jobs2'
+    seg = 'segment_2'
+    comp = 'ica'
 
-base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
-word_path = f'{base_path}/annotations/words/tsv/{stim}-words.tsv'
-phoneme_path = f'{base_path}/annotations/phonemes/tsv/{stim}-phonemes.tsv'
-fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
+    base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
+    fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
 
-# Load the data in MNE
-raw = mne.io.read_raw_fif(fif_path, preload=True)
+    # Load the data in MNE
+    raw = mne.io.read_raw_fif(fif_path, preload=True)
 
-# For visualizing raw data in terminal
-raw.plot()
+    # For visualizing raw data in terminal
+    # raw.plot()
 
-# Get sampling rate
-sampling_rate = raw.info['sfreq']
+    # Get sampling rate
+    sampling_rate = raw.info['sfreq']
 
-raw.info["bads"].extend(["E1", "E8", "E128"])
+    raw.info["bads"].extend(["E1", "E8", "E128"])
 
 
-# Calculate mean and standard deviation across all electrodes
-data = raw.get_data()  # Get the EEG data
-mean_data = np.mean(data, axis=1)  # Calculate mean across channels
-std_data = np.std(data, axis=1)  # Calculate standard deviation across channels
+    # Detect bad electrodes from robust amplitude, flatline, high-frequency noise and neighbour correlation
+    bad_channels, channel_stats = detect_bad_channels(raw)
 
-# Define threshold for identifying bad electrodes (e.g., 5 SD)
-threshold = 5 * np.mean(std_data)
+    # Interpolate bad electrodes (the interpolation matrix is cached per montage and bad set)
+    raw.info['bads'] = bad_channels
+    interpolate_bads_cached(raw, cache_dir=os.path.join(base_path, 'derivatives', 'cache', 'interpolation'))
 
-# Find indices of electrodes exceeding the threshold
-bad_indices = np.where(np.abs(mean_data) > threshold)[0]
+    # Define the path to save the bad electrodes TSV file
+    bad_electrodes_path = f'/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing/segmented_data/{sub}/bad-elecs.tsv'
 
-# Convert indices to channel names
-bad_channels = [raw.ch_names[idx] for idx in bad_indices]
+    # Save the list of bad electrodes to a TSV file
+    bad_electrodes_df = pd.DataFrame({'bad_electrodes': bad_channels})
+    bad_electrodes_df.to_csv(bad_electrodes_path, sep='\t', index=False)
 
-# Interpolate bad electrodes
-raw.info['bads'] = bad_channels
-raw.interpolate_bads()
+    # ICA fitted once per subject on a 1 Hz high-passed, 100 Hz copy of all segments (loaded if already stored)
+    ica = load_subject_ica(base_path, sub, n_components=20, random_state=35)
 
-# Define the path to save the bad electrodes TSV file
-bad_electrodes_path = f'/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing/segmented_data/{sub}/bad-elecs.tsv'
+    # When running in terminal to visualize sources
+    # ica.plot_sources(raw)
 
-# Save the list of bad electrodes to a TSV file
-bad_electrodes_df = pd.DataFrame({'bad_electrodes': bad_channels})
-bad_electrodes_df.to_csv(bad_electrodes_path, sep='\t', index=False)
+    # Save ICA component and source plots, rendered in a background process (skipped if unchanged)
+    ica_fig_dir = os.path.join(base_path, 'vis', 'individual', 'ICA', sub)
+    render_ica_figures(ica, raw, ica_fig_dir, f'{sub}_{seg}_{stim}')
 
-# Apply ICA before filtering
-ica = ICA(n_components=20, random_state=35)
-ica.fit(raw)
+    # Components to remove were selected when the subject ICA was fitted (scores in its -ica-scores.tsv)
+    save_excluded_components(base_path, sub, seg, stim, ica.exclude)
 
-# When running in terminal to visualize sources
-ica.plot_sources(raw)
+    ica.apply(raw)
 
+    # Notch (60 Hz) and band-pass (1-15 Hz) filter in a single pass
+    fused_filter(raw, l_freq=1.0, h_freq=15.0, notch_freq=60)
 
-# Define the directory path for saving ICA figures
-ica_fig_dir = os.path.join(base_path, 'vis', 'individual', 'ICA', sub)
-os.makedirs(ica_fig_dir, exist_ok=True)
+    # Re-reference the data using the 'VREF' channel
+    raw.set_eeg_reference(['VREF'])
 
-# Save ICA component plot
-ica_components_fig = ica.plot_components()
-ica_components_fig.savefig(os.path.join(ica_fig_dir, f'{sub}_{seg}_{stim}_components.jpg'))
-plt.close(ica_components_fig)
+    # Extract only the channels starting with 'E'
+    eeg_channels = [ch for ch in raw.ch_names if ch.startswith('E')]
+    raw = raw.pick_channels(eeg_channels)
 
-# Save ICA source plot
-ica_sources_fig = ica.plot_sources(raw)
-ica_sources_fig.savefig(os.path.join(ica_fig_dir, f'{sub}_{seg}_{stim}_sources.jpg'))
-plt.close(ica_sources_fig)
+    # Apply common average reference (CAR) across remaining electrodes
+    raw_car = raw.set_eeg_reference('average', projection=True)
 
-# Select components from ICA to remove
-ica.exclude = [16]
 
+    # Word events and aligned metadata from the annotation index (rounded onsets, coincident onsets dropped)
+    word_events, word_info = load_annotation_index(base_path).events('words', stim, sampling_rate)
 
+    # Create word epochs
+    word_epochs = mne.Epochs(raw_car, word_events, tmin=-2, tmax=2, baseline=None, reject=None, flat=None, metadata=word_info)
 
-# Save the excluded components to a JSON file
-excluded_components = {
-    'subject': sub,
-    'segment': seg,
-    'stimulus': stim,
-    'excluded_components': ica.exclude
-}
-json_dir = os.path.join(base_path, 'derivatives', 'individual', 'ica_excluded_components')
-os.makedirs(json_dir, exist_ok=True)
-json_filename = f'{sub}_{seg}_{stim}_excluded_components.json'
-json_filepath = os.path.join(json_dir, json_filename)
-with open(json_filepath, 'w') as json_file:
-    json.dump(excluded_components, json_file)
+    # Define the directory path for saving word epochs
+    word_epochs_dir = os.path.join(base_path, 'derivatives', 'individual', 'word_epochs')
+    os.makedirs(word_epochs_dir, exist_ok=True)
 
-ica.apply(raw)
+    # Phoneme events and aligned metadata from the annotation index
+    phoneme_events, phoneme_info = load_annotation_index(base_path).events('phonemes', stim, sampling_rate)
+    phoneme_epochs = mne.Epochs(raw_car, phoneme_events, tmin=-1, tmax=1, preload=False, baseline=None,
+                                metadata=phoneme_info)
 
-# Set Notch filter
-raw.notch_filter(60)
+    # # Save word epochs with a specific filename
+    # word_epochs_filename = f'word-epo-{sub}-{stim}-{seg}-epo.fif'
+    # word_epochs_filepath = os.path.join(word_epochs_dir, word_epochs_filename)
+    # word_epochs.save(word_epochs_filepath, overwrite=True)
+    # print(f"Word epochs saved to: {word_epochs_filepath}")
 
-# Set filter
-raw.filter(l_freq=1.0, h_freq=15.0)
+    # Average epochs for evoked response, streaming the epochs in chunks instead of loading them all
+    word_evoked = accumulate_evoked(word_epochs).evoked()
+    # Phoneme evoked response overall and per manner of articulation, in the same single pass
+    phoneme_accumulator = accumulate_evoked(phoneme_epochs, by='manner')
+    phoneme_evoked = phoneme_accumulator.evoked()
+    phoneme_evoked_by_manner = {manner: phoneme_accumulator.evoked(manner) for manner in phoneme_accumulator.conditions}
 
-# Re-reference the data using the 'VREF' channel
-raw.set_eeg_reference(['VREF'])
+    # Define the path for saving the evoked figure
+    evoked_fig_name = f'word-evoked-{sub}-{stim}_{seg}.jpg'
+    evoked_fig_path = os.path.join(base_path, 'vis', 'individual', 'word_evoked', comp, sub, evoked_fig_name)
+    os.makedirs(os.path.dirname(evoked_fig_path), exist_ok=True)
 
-# Extract only the channels starting with 'E'
-eeg_channels = [ch for ch in raw.ch_names if ch.startswith('E')]
-raw = raw.pick_channels(eeg_channels)
+    # Plot the evoked response and retrieve the Figure object
+    fig = word_evoked.plot_joint()
 
-# Apply common average reference (CAR) across remaining electrodes
-raw_car = raw.set_eeg_reference('average', projection=True)
+    # Save the figure directly from the Figure object
+    fig.savefig(evoked_fig_path, format='jpg', dpi=300)
 
-
-# Load metadata for words from annotations
-word_info = pd.read_csv(word_path, delimiter='\t', encoding='utf-8')
-
-# Create word epochs
-word_onsets = (word_info['Start'].values * sampling_rate).astype(int)
-word_events = np.column_stack((word_onsets, np.zeros_like(word_onsets), np.ones_like(word_onsets)))
-word_epochs = mne.Epochs(raw_car, word_events, tmin=-2, tmax=2, baseline=None, reject=None, flat=None)
-word_epochs.metadata = word_info  # Assign metadata to word epochs
-
-# Define the directory path for saving word epochs
-word_epochs_dir = os.path.join(base_path, 'derivatives', 'individual', 'word_epochs')
-os.makedirs(word_epochs_dir, exist_ok=True)
-
-phoneme_info = pd.read_csv(phoneme_path, delimiter='\t', encoding='utf-8')
-
-phoneme_onsets = (phoneme_info['Start'].values * sampling_rate).astype(int)
-phoneme_events = np.column_stack((phoneme_onsets, np.zeros_like(phoneme_onsets), np.ones_like(phoneme_onsets)))
-min_len = min(len(phoneme_events), len(phoneme_info))
-phoneme_events = phoneme_events[:min_len]
-phoneme_info = phoneme_info[:min_len]
-phoneme_epochs = mne.Epochs(raw_car, phoneme_events, tmin=-1, tmax=1, preload=True, baseline=None,
-                            event_repeated='drop')
-
-# Align metadata with epochs
-phoneme_epochs.metadata = phoneme_info.iloc[phoneme_epochs.selection]
-
-# # Save word epochs with a specific filename
-# word_epochs_filename = f'word-epo-{sub}-{stim}-{seg}-epo.fif'
-# word_epochs_filepath = os.path.join(word_epochs_dir, word_epochs_filename)
-# word_epochs.save(word_epochs_filepath, overwrite=True)
-# print(f"Word epochs saved to: {word_epochs_filepath}")
-
-# Average epochs for evoked response
-word_evoked = word_epochs.average()
-# Average epochs for evoked response
-phoneme_evoked = phoneme_epochs.average()
-
-# Define the path for saving the evoked figure
-evoked_fig_name = f'word-evoked-{sub}-{stim}_{seg}.jpg'
-evoked_fig_path = os.path.join(base_path, 'vis', 'individual', 'word_evoked', comp, sub, evoked_fig_name)
-os.makedirs(os.path.dirname(evoked_fig_path), exist_ok=True)
-
-# Plot the evoked response and retrieve the Figure object
-fig = word_evoked.plot_joint()
-
-# Save the figure directly from the Figure object
-fig.savefig(evoked_fig_path, format='jpg', dpi=300)
\ No newline at end of file
+    # Make sure the ICA figures are written before exiting
+    wait_for_figures()
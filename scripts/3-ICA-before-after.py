@@ -6,18 +6,16 @@ import matplotlib.pyplot as plt
 from mne.preprocessing import ICA
 import json
 from scipy.stats import zscore
+from epoch_store import save_epoch_store, EpochStore
+from ica_figures import render_ica_figures, wait_for_figures
+from filtering import fused_filter
+from annotation_index import load_annotation_index
 
-def save_ica_plots_and_json(ica, subject, segment, stimulus, round, base_path):
+def save_ica_plots_and_json(ica, raw, subject, segment, stimulus, round, base_path):
     ica_fig_dir = os.path.join(base_path, 'vis', 'individual', f'ica_{round}_filtering', subject)
-    os.makedirs(ica_fig_dir, exist_ok=True)
 
-    ica_components_fig = ica.plot_components()
-    ica_components_fig.savefig(os.path.join(ica_fig_dir, f'{subject}_{segment}_{stimulus}_components_{round}.jpg'))
-    plt.close(ica_components_fig)
-
-    ica_sources_fig = ica.plot_sources(raw)
-    ica_sources_fig.savefig(os.path.join(ica_fig_dir, f'{subject}_{segment}_{stimulus}_sources_{round}.jpg'))
-    plt.close(ica_sources_fig)
+    # Component and source figures are rendered in a background process (skipped if unchanged)
+    render_ica_figures(ica, raw, ica_fig_dir, f'{subject}_{segment}_{stimulus}', suffix=f'_{round}')
 
     excluded_components = {
         'subject': subject,
@@ -39,7 +37,6 @@ if __name__ == '__main__':
     segment = 'segment_1'
 
     base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
-    word_path = os.path.join(base_path, 'annotations', 'words', 'tsv', f'{stimulus}-words.tsv')
     fif_path = os.path.join(base_path, 'segmented_data', '../scratch/pilot-2', f'{subject}_{segment}_{stimulus}_eeg.fif')
 
     # Load the data in MNE
@@ -52,14 +49,11 @@ if __name__ == '__main__':
     ica_before = ICA(n_components=10, random_state=42)
     ica_before.fit(raw)
     ica_before.exclude = [8,9]  # Example excluded components
-    save_ica_plots_and_json(ica_before, subject, segment, stimulus, 'before', base_path)
+    save_ica_plots_and_json(ica_before, raw, subject, segment, stimulus, 'before', base_path)
     ica_before.apply(raw)
 
-    # Set Notch filter
-    raw.notch_filter(60)
-
-    # Set filter
-    raw.filter(l_freq=1.0, h_freq=15.0)
+    # Notch (60 Hz) and band-pass (1-15 Hz) filter in a single pass
+    fused_filter(raw, l_freq=1.0, h_freq=15.0, notch_freq=60)
 
     # Re-reference the data using the 'VREF' channel
     raw.set_eeg_reference(['VREF'])
@@ -75,30 +69,26 @@ if __name__ == '__main__':
     ica_after = ICA(n_components=10, random_state=42)
     ica_after.fit(raw)
     ica_after.exclude = []  # Example excluded components
-    save_ica_plots_and_json(ica_after, subject, segment, stimulus, 'after', base_path)
+    save_ica_plots_and_json(ica_after, raw, subject, segment, stimulus, 'after', base_path)
     ica_after.apply(raw)
 
-    # Load metadata for words from annotations
-    word_info = pd.read_csv(word_path, delimiter='\t', encoding='utf-8')
+    # Word events and aligned metadata from the annotation index (rounded onsets, coincident onsets dropped)
+    word_events, word_info = load_annotation_index(base_path).events('words', stimulus, sampling_rate)
 
     # Create word epochs
-    word_onsets = (word_info['Start'].values * sampling_rate).astype(int)
-    word_events = np.column_stack((word_onsets, np.zeros_like(word_onsets), np.ones_like(word_onsets)))
-    word_epochs = mne.Epochs(raw_car, word_events, tmin=-0.2, tmax=.6, baseline=None, reject=None, flat=None)
-    word_epochs.metadata = word_info  # Assign metadata to word epochs
+    word_epochs = mne.Epochs(raw_car, word_events, tmin=-0.2, tmax=.6, baseline=None, reject=None, flat=None, metadata=word_info)
 
     # Define the directory path for saving word epochs
     word_epochs_dir = os.path.join(base_path, 'derivatives', 'individual', 'word_epochs')
     os.makedirs(word_epochs_dir, exist_ok=True)
 
-    # Save word epochs with a specific filename
-    word_epochs_filename = f'word-epo-{subject}-{stimulus}-{segment}-epo.fif'
-    word_epochs_filepath = os.path.join(word_epochs_dir, word_epochs_filename)
-    word_epochs.save(word_epochs_filepath, overwrite=True)
-    print(f"Word epochs saved to: {word_epochs_filepath}")
+    # Save word epochs as a memory-mapped epoch store (float32 array + metadata sidecar)
+    word_epochs_store_dir = os.path.join(word_epochs_dir, f'word-epo-{subject}-{stimulus}-{segment}')
+    save_epoch_store(word_epochs, word_epochs_store_dir)
+    print(f"Word epochs saved to: {word_epochs_store_dir}")
 
-    # Average epochs for evoked response
-    word_evoked = word_epochs.average()
+    # Average epochs for evoked response, reading the store chunk by chunk
+    word_evoked = EpochStore(word_epochs_store_dir).average()
 
     # Define the path for saving the evoked figure
     evoked_fig_name = f'word-evoked-{subject}-{stimulus}_{segment}.jpg'
@@ -109,4 +99,7 @@ if __name__ == '__main__':
     fig = word_evoked.plot_joint()
 
     # Save the figure directly from the Figure object
-    fig.savefig(evoked_fig_path, format='jpg', dpi=300)
\ No newline at end of file
+    fig.savefig(evoked_fig_path, format='jpg', dpi=300)
+
+    # Make sure the ICA figures are written before exiting
+    wait_for_figures()
@@ -6,6 +6,12 @@ import matplotlib.pyplot as plt
 from scipy.stats import zscore
 from mne.preprocessing import ICA, EOGRegression
 import json
+from ica_selection import save_excluded_components
+from subject_ica import load_subject_ica
+from ica_figures import render_ica_figures, wait_for_figures
+from bad_channels import detect_bad_channels, interpolate_bads_cached
+from filtering import fused_filter
+from annotation_index import load_annotation_index
 
 def run_ica_and_eog_regression(sub, stim, seg, base_path):
     """
@@ -22,8 +28,6 @@ def run_ica_and_eog_regression(sub, stim, seg, base_path):
     - evoked_clean: Evoked response after ICA and EOG regression.
     """
     # Set parameters for fif path
-    word_path = f'{base_path}/annotations/words/tsv/{stim}-words.tsv'
-    phoneme_path = f'{base_path}/annotations/phonemes/tsv/{stim}-phonemes.tsv'
     fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
 
     # Load the data in MNE
@@ -32,73 +36,34 @@ def run_ica_and_eog_regression(sub, stim, seg, base_path):
     # Get sampling rate
     sampling_rate = raw.info['sfreq']
 
-    # Calculate mean and standard deviation across all electrodes
-    data = raw.get_data()  # Get the EEG data
-    mean_data = np.mean(data, axis=1)  # Calculate mean across channels
-    std_data = np.std(data, axis=1)  # Calculate standard deviation across channels
+    # Detect bad electrodes from robust amplitude, flatline, high-frequency noise and neighbour correlation
+    bad_channels, channel_stats = detect_bad_channels(raw)
 
-    # Define threshold for identifying bad electrodes (e.g., 5 SD)
-    threshold = 4 * np.mean(std_data)
-
-    # Find indices of electrodes exceeding the threshold
-    bad_indices = np.where(np.abs(mean_data) > threshold)[0]
-
-    # Convert indices to channel names
-    bad_channels = [raw.ch_names[idx] for idx in bad_indices]
-
-    # Interpolate bad electrodes
+    # Interpolate bad electrodes (the interpolation matrix is cached per montage and bad set)
     raw.info['bads'] = bad_channels
-    raw.interpolate_bads()
+    interpolate_bads_cached(raw, cache_dir=os.path.join(base_path, 'derivatives', 'cache', 'interpolation'))
 
     # Define the path to save the bad electrodes TSV file
-    bad_electrodes_path = f'/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing/segmented_data/{sub}/bad-elecs.tsv'
+    bad_electrodes_path = f'{base_path}/segmented_data/{sub}/bad-elecs.tsv'
 
     # Save the list of bad electrodes to a TSV file
     bad_electrodes_df = pd.DataFrame({'bad_electrodes': bad_channels})
     bad_electrodes_df.to_csv(bad_electrodes_path, sep='\t', index=False)
 
-    # Apply ICA before filtering
-    ica = ICA(n_components=10, random_state=42)
-    ica.fit(raw)
+    # ICA fitted once per subject on a 1 Hz high-passed, 100 Hz copy of all segments (loaded if already stored)
+    ica = load_subject_ica(base_path, sub, n_components=10, random_state=42)
 
-    # Define the directory path for saving ICA figures
+    # Save ICA component and source plots, rendered in a background process (skipped if unchanged)
     ica_fig_dir = os.path.join(base_path, 'vis', 'individual', 'ICA', sub)
-    os.makedirs(ica_fig_dir, exist_ok=True)
-
-    # Save ICA component plot
-    ica_components_fig = ica.plot_components()
-    ica_components_fig.savefig(os.path.join(ica_fig_dir, f'{sub}_{seg}_{stim}_components.jpg'))
-    plt.close(ica_components_fig)
-
-    # Save ICA source plot
-    ica_sources_fig = ica.plot_sources(raw)
-    ica_sources_fig.savefig(os.path.join(ica_fig_dir, f'{sub}_{seg}_{stim}_sources.jpg'))
-    plt.close(ica_sources_fig)
-
-    # Select components from ICA to remove
-    ica.exclude = []
-
-    # Save the excluded components to a JSON file
-    excluded_components = {
-        'subject': sub,
-        'segment': seg,
-        'stimulus': stim,
-        'excluded_components': ica.exclude
-    }
-    json_dir = os.path.join(base_path, 'derivatives', 'individual', 'ica_excluded_components')
-    os.makedirs(json_dir, exist_ok=True)
-    json_filename = f'{sub}_{seg}_{stim}_excluded_components.json'
-    json_filepath = os.path.join(json_dir, json_filename)
-    with open(json_filepath, 'w') as json_file:
-        json.dump(excluded_components, json_file)
+    render_ica_figures(ica, raw, ica_fig_dir, f'{sub}_{seg}_{stim}')
 
-    ica.apply(raw)
+    # Components to remove were selected when the subject ICA was fitted (scores in its -ica-scores.tsv)
+    save_excluded_components(base_path, sub, seg, stim, ica.exclude)
 
-    # Set Notch filter
-    raw.notch_filter(60)
+    ica.apply(raw)
 
-    # Set filter
-    raw.filter(l_freq=1, h_freq=15.0)
+    # Notch (60 Hz) and band-pass (1-15 Hz) filter in a single pass
+    fused_filter(raw, l_freq=1.0, h_freq=15.0, notch_freq=60)
 
     # Re-reference the data using the 'VREF' channel
     raw.set_eeg_reference(['VREF'])
@@ -114,23 +79,18 @@ def run_ica_and_eog_regression(sub, stim, seg, base_path):
     # Apply common average reference
     raw_car = raw.set_eeg_reference('average', projection=True)
 
-    # Load metadata for words from annotations
-    word_info = pd.read_csv(word_path, delimiter='\t', encoding='utf-8')
+    # Word events and aligned metadata from the annotation index (rounded onsets, coincident onsets dropped)
+    word_events, word_info = load_annotation_index(base_path).events('words', stim, sampling_rate)
 
     # Create word epochs
 
     # Create word epochs
-    word_onsets = (word_info['Start'].values * sampling_rate).astype(int)
-    word_events = np.column_stack((word_onsets, np.zeros_like(word_onsets), np.ones_like(word_onsets)))
     word_epochs = mne.Epochs(raw_car, word_events, tmin=-0.2, tmax=0.6, baseline=None, reject=None, flat=None,
-                             preload=True)
+                             preload=True, metadata=word_info)
 
-    # Drop bad epochs
+    # Drop bad epochs (the metadata rows are dropped with them)
     word_epochs.drop_bad()
 
-    # Assign metadata to word epochs
-    word_epochs.metadata = word_info.iloc[:len(word_epochs.events)]
-
     # Run EOG regression
     model = EOGRegression(picks="eeg", picks_artifact="eog").fit(word_epochs)
 
@@ -161,6 +121,9 @@ def run_ica_and_eog_regression(sub, stim, seg, base_path):
     fig_evoked.savefig(evoked_fig_path)
     plt.close(fig_evoked)
 
+    # Make sure the ICA figures are written before returning
+    wait_for_figures()
+
     return epochs_clean, evoked_clean
 
 if __name__ == '__main__':
@@ -1,82 +1,93 @@
-# When running epochs with window size -3 to 3 s, the process gets interrupted
-
-
 import mne
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sklearn.preprocessing import StandardScaler
-from sklearn.linear_model import LogisticRegression
-from sklearn.pipeline import make_pipeline
-from sklearn.model_selection import cross_val_score, KFold
 import os
 import csv
 import pandas as pd
-
-
-def load_and_preprocess_data(fif_path):
-    raw = mne.io.read_raw_fif(fif_path, preload=True)
-    raw.filter(l_freq=1.0, h_freq=30.0)
-    #raw.set_eeg_reference(['VREF'])
-    eeg_channels = [ch for ch in raw.ch_names if ch.startswith('E')]
-    raw = raw.pick_channels(eeg_channels)
-    raw_car = raw.set_eeg_reference('average', projection=True)
+from cache import load_preprocessed
+from annotation_index import load_annotation_index
+from epoch_store import save_epoch_store, EpochStore
+from decoding import make_folds, make_group_folds, label_matrix, selected_epochs, index_folds, decode_timecourse
+from dataset import segment_store_dir, build_subject_dataset
+from features import load_features
+from permutation import permutation_test, cluster_test
+
+
+def load_and_preprocess_data(fif_path, cache_dir):
+    # Band-pass filtered, CAR referenced 'E' channels, cached on disk and memory-mapped on later runs
+    raw_car = load_preprocessed(fif_path, cache_dir, l_freq=1.0, h_freq=30.0, reference='average')
     return raw_car
 
 
-def create_phoneme_epochs(raw_car, phoneme_info, sampling_rate):
-    phoneme_onsets = (phoneme_info['Start'].values * sampling_rate).astype(int)
-    phoneme_events = np.column_stack((phoneme_onsets, np.zeros_like(phoneme_onsets), np.ones_like(phoneme_onsets)))
-    min_len = min(len(phoneme_events), len(phoneme_info))
-    phoneme_events = phoneme_events[:min_len]
-    phoneme_info = phoneme_info[:min_len]
-    phoneme_epochs = mne.Epochs(raw_car, phoneme_events, tmin=-1, tmax=1, preload=True, baseline=None,
-                                event_repeated='drop')
-
-    # Align metadata with epochs
-    phoneme_epochs.metadata = phoneme_info.iloc[phoneme_epochs.selection]
+def create_phoneme_epochs(raw_car, phoneme_events, phoneme_metadata):
+    # Events come from the annotation index (rounded onsets, coincident onsets dropped); passing the
+    # metadata to mne.Epochs keeps it aligned with any epochs dropped at the segment edges.
+    # Not preloaded: save_epoch_store reads the epochs in chunks, so longer windows fit in memory
+    phoneme_epochs = mne.Epochs(raw_car, phoneme_events, tmin=-1, tmax=1, preload=False, baseline=None,
+                                metadata=phoneme_metadata)
 
     return phoneme_epochs
 
-def filter_epochs(epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value):
-    filtered_epochs_phonation = epochs[epochs.metadata['phonation'] == desired_phonation_value]
-    filtered_epochs_manner = epochs[epochs.metadata['manner'] == desired_manner_value]
-    filtered_epochs_place = epochs[epochs.metadata['place'] == desired_place_value]
-    filtered_epochs_roundness = epochs[epochs.metadata['roundness'] == desired_roundness_value]
-    filtered_epochs_frontback = epochs[epochs.metadata['frontback'] == desired_frontback_value]
-    filtered_epochs = mne.concatenate_epochs([filtered_epochs_phonation, filtered_epochs_manner, filtered_epochs_place, filtered_epochs_roundness, filtered_epochs_frontback])
-    return filtered_epochs
-
-
-def perform_decoding(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value):
-    clf = make_pipeline(StandardScaler(), LogisticRegression(solver='liblinear'))
-    cv = KFold(5, shuffle=True)
-    accuracy_dict = {}
-
-    for feat, label, color in zip(['phonation', 'manner', 'place', 'roundness', 'frontback'],
-                                  ['Voiced', 'Fricatives', 'Vowels', 'Rounded', 'Front'],
-                                  ['indigo', 'darkorchid', 'plum', 'pink', 'palevioletred']):
-        desired_value = {
-            'phonation': desired_phonation_value,
-            'manner': desired_manner_value,
-            'place': desired_place_value,
-            'roundness': desired_roundness_value,
-            'frontback': desired_frontback_value
-        }[feat]
-        y = (filtered_epochs.metadata[feat] == desired_value).astype(int)
-        accuracy_scores = np.empty(filtered_epochs.get_data(copy=True).shape[-1])
-
-        for tt in range(accuracy_scores.shape[0]):
-            X_ = filtered_epochs.get_data(copy=True)[:, :, tt]
-            scores = cross_val_score(clf, X_, y, scoring='roc_auc', cv=cv, n_jobs=-1)
-            accuracy_scores[tt] = scores.mean()
-
-        accuracy_dict[feat] = accuracy_scores
-
-    return accuracy_dict
 
-
-def visualize_results(filtered_epochs, accuracy_dict, fig_path, sub, seg, stim):
+def make_phoneme_store(fif_path, cache_dir, base_path, stim, store_dir):
+    # Phoneme epochs of one segment, written once to a memory-mapped epoch store
+    raw_car = load_and_preprocess_data(fif_path, cache_dir)
+    phoneme_events, phoneme_metadata = load_annotation_index(base_path).events('phonemes', stim, raw_car.info['sfreq'])
+    save_epoch_store(create_phoneme_epochs(raw_car, phoneme_events, phoneme_metadata), store_dir)
+
+
+def perform_decoding(store, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value, grouped=False, decoding_sfreq=100.0, method='logistic', feature_kind=None, window_ms=50.0, stride_ms=20.0, n_permutations=0, permutation_dir=None):
+    desired_values = {
+        'phonation': desired_phonation_value,
+        'manner': desired_manner_value,
+        'place': desired_place_value,
+        'roundness': desired_roundness_value,
+        'frontback': desired_frontback_value
+    }
+    features = list(desired_values)
+
+    # One label column per feature; the epochs matching any feature are selected once, however many
+    # features they match (instead of one copy of the epochs per feature)
+    labels = label_matrix(store.metadata, desired_values)
+    selected = selected_epochs(labels)
+    Y = labels.values.astype(int)
+
+    if feature_kind is None:
+        # Decimated view of the memory-mapped store (the data is low-passed at 30 Hz)
+        decim = max(1, int(round(store.info['sfreq'] / decoding_sfreq)))
+        X, times = store.data[..., ::decim], store.times[::decim]
+    else:
+        # Windowed features (window mean, concatenated samples or band power), cached next to the store
+        X, times = load_features(store, feature_kind, window_ms=window_ms, stride_ms=stride_ms)
+    # X stays a float32 memory map (casting it here would copy the whole array into memory);
+    # decode_timecourse reads it a chunk of timepoints at a time and standardizes each chunk in float64
+
+    # Folds over the selected epochs index the shared buffer directly; with grouped=True every fold
+    # tests on a story the classifiers were not trained on. With method 'ridge' or 'lda' the five
+    # features are fitted jointly per timepoint in closed form (see decode_timecourse)
+    if grouped:
+        folds = make_group_folds(store.metadata['group'].values[selected])
+    else:
+        folds = make_folds(len(selected), n_splits=5)
+    folds = index_folds(selected, folds)
+    scores = decode_timecourse(X, Y, folds=folds, n_jobs=-1, method=method)
+
+    accuracy_dict = {feat: scores[ii] for ii, feat in enumerate(features)}
+
+    # Significance from shuffled labels (within stories when grouped), scored with the same folds and
+    # closed-form decoder, then a temporal cluster test per feature
+    stats = None
+    if n_permutations:
+        observed, null = permutation_test(X, Y, folds, n_permutations=n_permutations, method=method,
+                                          groups=store.metadata['group'].values if grouped else None,
+                                          work_dir=permutation_dir)
+        stats = {feat: cluster_test(observed[ii], null[:, ii]) for ii, feat in enumerate(features)}
+
+    return accuracy_dict, times, stats
+
+
+def visualize_results(times, accuracy_dict, fig_path, sub, seg, stim, method='logistic'):
     y_min = 0.45
     y_max = 0.75
 
@@ -86,7 +97,7 @@ def visualize_results(filtered_epochs, accuracy_dict, fig_path, sub, seg, stim):
     for feat, label, color in zip(['phonation', 'manner', 'place', 'roundness', 'frontback'],
                                   ['Voiced', 'Fricatives', 'Vowels', 'Rounded', 'Front'],
                                   ['indigo', 'darkorchid', 'plum', 'pink', 'palevioletred']):
-        ax.plot(filtered_epochs.times, accuracy_dict[feat], label=label, color=color)
+        ax.plot(times, accuracy_dict[feat], label=label, color=color)
 
     ax.axvline(x=0, color='grey', linestyle='--')
     ax.axhline(y=0.5, color='grey', linestyle='--')
@@ -94,17 +105,31 @@ def visualize_results(filtered_epochs, accuracy_dict, fig_path, sub, seg, stim):
     ax.set_ylabel("ROC-AUC")
     ax.set_ylim(y_min, y_max)
     ax.legend()
-    plt.savefig(f'{fig_path}/{sub}_{seg}_{stim}_logistic.jpg', dpi=300, bbox_inches='tight')
+    plt.savefig(f'{fig_path}/{sub}_{seg}_{stim}_{method}.jpg', dpi=300, bbox_inches='tight')
     plt.show()
 
 
-def save_accuracy_scores(accuracy_dict, base_path):
+def save_accuracy_scores(accuracy_dict, base_path, times=None, stats=None):
     csv_file_path = os.path.join(base_path, 'accuracy_scores.csv')
     with open(csv_file_path, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
-        writer.writerow(['Key', 'Accuracy Scores'])
-        for key, scores in accuracy_dict.items():
-            writer.writerow([key, scores])
+        if stats is None:
+            writer.writerow(['Key', 'Accuracy Scores'])
+            for key, scores in accuracy_dict.items():
+                writer.writerow([key, scores])
+        else:
+            writer.writerow(['Key', 'Accuracy Scores', 'Pointwise p'])
+            for key, scores in accuracy_dict.items():
+                writer.writerow([key, scores, stats[key][0]])
+
+    if stats is not None:
+        # One row per above-chance cluster, with its time span and cluster-corrected p-value
+        clusters = pd.concat([clusters.assign(feature=key) for key, (_, clusters) in stats.items()], ignore_index=True)
+        clusters['tmin'] = times[clusters['start'].astype(int)]
+        clusters['tmax'] = times[clusters['stop'].astype(int) - 1]
+        clusters_path = os.path.join(base_path, 'accuracy_clusters.tsv')
+        clusters[['feature', 'tmin', 'tmax', 'mass', 'p']].to_csv(clusters_path, sep='\t', index=False)
+        print(f"Cluster statistics saved to '{clusters_path}'")
 
 
 def main():
@@ -113,18 +138,18 @@ def main():
     stim = 'Jobs1'
     seg = 'segment_1'
     comp = 'no-ica'
+    scope = 'segment'  # 'segment' decodes this stimulus only; 'subject' decodes all nine stimuli with story-grouped folds
+    method = 'logistic'  # or the closed forms 'ridge' / 'lda', which fit all five features jointly per timepoint
+    feature_kind = 'mean'  # 'mean', 'concat' or 'bandpower' over sliding windows; None decodes every sample at 100 Hz
+    window_ms, stride_ms = 50.0, 20.0
+    n_permutations = 0  # e.g. 1000 for cluster-corrected significance (requires method 'ridge' or 'lda')
 
     base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
-    phoneme_path = f'{base_path}/annotations/phonemes/tsv/{stim}-phonemes.tsv'
     fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
     fig_path = os.path.join(base_path, 'vis', 'individual', 'phoneme-decode')
     os.makedirs(fig_path, exist_ok=True)
-
-    sampling_rate = mne.io.read_raw_fif(fif_path, preload=False).info['sfreq']
-
-    raw_car = load_and_preprocess_data(fif_path)
-    phoneme_info = pd.read_csv(phoneme_path, delimiter='\t', encoding='utf-8')
-    phoneme_epochs = create_phoneme_epochs(raw_car, phoneme_info, sampling_rate)
+    cache_dir = os.path.join(base_path, 'derivatives', 'cache')
+    phoneme_store_dir = segment_store_dir(base_path, sub, seg, stim)
 
     desired_phonation_value = 'v'
     desired_manner_value = 'f'
@@ -132,12 +157,25 @@ def main():
     desired_roundness_value = 'r'
     desired_frontback_value = 'f'
 
-    filtered_epochs = filter_epochs(phoneme_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value)
-    filtered_epochs.resample(100)
-
-    accuracy_dict = perform_decoding(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value)
-    visualize_results(filtered_epochs, accuracy_dict, fig_path, sub, seg, stim)
-    save_accuracy_scores(accuracy_dict, base_path)
+    if scope == 'subject':
+        # Phoneme epochs of all stimuli combined into one memory-mapped store (segment stores are created as needed)
+        store = build_subject_dataset(base_path, sub, make_store=lambda job, store_dir: make_phoneme_store(
+            job['fif_path'], cache_dir, base_path, job['stim'], store_dir))
+        seg, stim = 'all', 'all'
+    else:
+        # Phoneme epochs are computed once and reopened from the memory-mapped epoch store on later runs
+        if not os.path.exists(os.path.join(phoneme_store_dir, 'store.json')):
+            make_phoneme_store(fif_path, cache_dir, base_path, stim, phoneme_store_dir)
+        store = EpochStore(phoneme_store_dir)
+
+    # Fold weight operators and partial null distributions are checkpointed here, so an interrupted test resumes
+    permutation_dir = os.path.join(base_path, 'derivatives', 'individual', 'permutations', f'{sub}_{seg}_{stim}_{method}')
+
+    accuracy_dict, times, stats = perform_decoding(store, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value, grouped=scope == 'subject', method=method,
+                                                   feature_kind=feature_kind, window_ms=window_ms, stride_ms=stride_ms,
+                                                   n_permutations=n_permutations, permutation_dir=permutation_dir)
+    visualize_results(times, accuracy_dict, fig_path, sub, seg, stim, method)
+    save_accuracy_scores(accuracy_dict, base_path, times, stats)
     print("Decoding analysis completed.")
 
 
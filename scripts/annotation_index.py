@@ -0,0 +1,177 @@
+# Index of the word and phoneme annotation TSVs of every stimulus.
+# Onsets are converted once per sampling rate to rounded sample indices, coincident onsets are
+# deduplicated, and the aligned (events, metadata) pairs are kept in a dict and persisted in a
+# binary file, so every script gets the same events without re-reading and re-aligning the TSVs.
+
+import os
+import glob
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+
+LEVELS = ('words', 'phonemes')
+
+
+def annotation_path(base_path, level, stim):
+    """
+    Path of the annotation TSV of a stimulus, e.g. annotations/phonemes/tsv/Jobs1-phonemes.tsv.
+    """
+    return os.path.join(base_path, 'annotations', level, 'tsv', f'{stim}-{level}.tsv')
+
+
+def index_path(base_path):
+    """
+    Default location of the persisted index.
+    """
+    return os.path.join(base_path, 'derivatives', 'cache', 'annotations', 'annotation-index.pkl')
+
+
+def onset_samples(onsets, sfreq):
+    """
+    Convert onsets in seconds to the nearest sample index (instead of truncating with astype(int)).
+
+    Parameters:
+    - onsets: Onsets in seconds, relative to the start of the segment.
+    - sfreq: Sampling rate in Hz.
+
+    Returns:
+    - samples: Array of int64 sample indices.
+    """
+    return np.round(np.asarray(onsets, dtype=float) * sfreq).astype(np.int64)
+
+
+def aligned_events(table, sfreq, event_id=1):
+    """
+    Build an events array and the matching metadata rows from an annotation table.
+
+    Rows are ordered by onset, and of several rows falling on the same sample only the first is kept
+    (what event_repeated='drop' used to do silently), so events and metadata always have the same length.
+
+    Parameters:
+    - table: Annotation DataFrame with a 'Start' column in seconds.
+    - sfreq: Sampling rate in Hz.
+    - event_id: Event code of every event.
+
+    Returns:
+    - events: Array (n_events, 3) for mne.Epochs.
+    - metadata: Annotation rows aligned with events (index reset), plus the onset 'sample'.
+    """
+    samples = onset_samples(table['Start'].values, sfreq)
+    order = np.argsort(samples, kind='stable')
+    keep = order[np.r_[True, np.diff(samples[order]) > 0]] if len(order) else order
+    n_dropped = len(samples) - len(keep)
+    if n_dropped:
+        print(f"Dropped {n_dropped} annotations with coincident onsets at {sfreq} Hz")
+
+    events = np.column_stack((samples[keep], np.zeros(len(keep), dtype=np.int64),
+                              np.full(len(keep), event_id, dtype=np.int64)))
+    metadata = table.iloc[keep].reset_index(drop=True)
+    metadata['sample'] = samples[keep]
+    return events, metadata
+
+
+def _fingerprint(paths):
+    # Size and modification time of every TSV, so an edited annotation rebuilds the index
+    return {path: (os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths}
+
+
+class AnnotationIndex:
+    """
+    Word and phoneme annotations of every stimulus, with aligned events cached per sampling rate.
+
+    Use load_annotation_index to build or reopen the persisted index rather than the constructor.
+
+    Parameters:
+    - tables: Dict {(level, stim): DataFrame} of the annotation TSVs.
+    - fingerprint: Fingerprint of the TSVs the tables were read from.
+    - path: File the index is persisted to, or None to keep it in memory.
+    """
+
+    def __init__(self, tables, fingerprint, path=None):
+        self.tables = tables
+        self.fingerprint = fingerprint
+        self.path = path
+        self._events = {}
+
+    @property
+    def stimuli(self):
+        return sorted({stim for _, stim in self.tables})
+
+    def table(self, level, stim):
+        """
+        Annotation table of a stimulus as read from the TSV (before rounding and deduplication).
+        """
+        return self.tables[(level, stim)]
+
+    def events(self, level, stim, sfreq, event_id=1):
+        """
+        Aligned events and metadata of a stimulus, computed once per sampling rate.
+
+        Parameters:
+        - level: 'words' or 'phonemes'.
+        - stim: Stimulus name, e.g. 'Jobs1'.
+        - sfreq: Sampling rate of the segment in Hz.
+        - event_id: Event code of every event.
+
+        Returns:
+        - events: Array (n_events, 3); pass it to mne.Epochs with metadata=metadata so dropped
+          epochs stay aligned.
+        - metadata: Aligned annotation rows (shared by every call, copy before modifying).
+        """
+        key = (level, stim, float(sfreq))
+        if key not in self._events:
+            self._events[key] = aligned_events(self.table(level, stim), sfreq)
+            if self.path is not None:
+                self.save(self.path)
+        events, metadata = self._events[key]
+        if event_id != 1:
+            events = events.copy()
+            events[:, 2] = event_id
+        return events, metadata
+
+    def save(self, path):
+        """
+        Write the index (tables and the aligned events of every sampling rate seen so far) to a binary file.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Atomic replace, so concurrent batch workers never read a partial file
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as index_file:
+            pickle.dump({'tables': self.tables, 'fingerprint': self.fingerprint, 'events': self._events},
+                        index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+def load_annotation_index(base_path, path=None, levels=LEVELS):
+    """
+    Open the persisted annotation index, rebuilding it when an annotation TSV was added or changed.
+
+    Parameters:
+    - base_path: Base directory path for the project (with annotations/{level}/tsv/).
+    - path: Index file (default derivatives/cache/annotations/annotation-index.pkl).
+    - levels: Annotation levels to index.
+
+    Returns:
+    - index: AnnotationIndex over every {stim}-{level}.tsv found.
+    """
+    path = index_path(base_path) if path is None else path
+    paths = {}
+    for level in levels:
+        for tsv_path in sorted(glob.glob(os.path.join(base_path, 'annotations', level, 'tsv', f'*-{level}.tsv'))):
+            stim = os.path.basename(tsv_path)[:-len(f'-{level}.tsv')]
+            paths[(level, stim)] = tsv_path
+    fingerprint = _fingerprint(paths.values())
+
+    if os.path.exists(path):
+        with open(path, 'rb') as index_file:
+            stored = pickle.load(index_file)
+        if stored['fingerprint'] == fingerprint:
+            index = AnnotationIndex(stored['tables'], fingerprint, path)
+            index._events = stored['events']
+            return index
+
+    tables = {key: pd.read_csv(tsv_path, delimiter='\t', encoding='utf-8') for key, tsv_path in paths.items()}
+    index = AnnotationIndex(tables, fingerprint, path)
+    index.save(path)
+    return index
@@ -0,0 +1,182 @@
+# Robust bad-channel detection and cached spherical-spline interpolation.
+# All criteria come from one windowed pass over the data; the interpolation matrix depends only on the
+# channel positions and the bad set, so it is computed once and reused across a subject's segments.
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import mne
+
+_interpolation_matrices = {}
+
+
+def _robust_z(values):
+    # Robust z-score across channels (median and MAD)
+    median = np.nanmedian(values)
+    mad = 1.4826 * np.nanmedian(np.abs(values - median))
+    return (values - median) / mad if mad > 0 else np.zeros_like(values)
+
+
+def _neighbours(raw, picks, n_neighbours):
+    pos = np.array([raw.info['chs'][idx]['loc'][:3] for idx in picks])
+    if not np.all(np.isfinite(pos)) or np.allclose(pos, 0):
+        return None
+    dist = np.linalg.norm(pos[:, np.newaxis] - pos[np.newaxis], axis=-1)
+    np.fill_diagonal(dist, np.inf)
+    return np.argsort(dist, axis=1)[:, :n_neighbours]
+
+
+def channel_stats(raw, picks, window_sec=1.0, n_neighbours=6, block_windows=10):
+    """
+    Per-channel robust statistics from one pass over non-overlapping windows.
+
+    Parameters:
+    - raw: Raw, preloaded or not.
+    - picks: Channel indices.
+    - window_sec: Window length in seconds.
+    - n_neighbours: Number of nearest channels (by montage position) for the neighbour correlation.
+    - block_windows: Number of windows read and processed at a time.
+
+    Returns:
+    - stats: DataFrame with one row per channel: amplitude (median window SD), hf_ratio (median ratio
+      of first-difference SD to SD, a proxy for high-frequency noise) and neighbour_corr (median over
+      windows of the mean correlation with the nearest channels; NaN without channel positions).
+    """
+    window = int(round(window_sec * raw.info['sfreq']))
+    n_windows = raw.n_times // window
+    neighbours = _neighbours(raw, picks, n_neighbours)
+    amplitude = np.empty((len(picks), n_windows))
+    hf_ratio = np.empty((len(picks), n_windows))
+    neighbour_corr = np.full((len(picks), n_windows), np.nan)
+
+    for first in range(0, n_windows, block_windows):
+        last = min(first + block_windows, n_windows)
+        data = raw.get_data(picks=picks, start=first * window, stop=last * window)
+        windows = data.reshape(len(picks), last - first, window)
+        windows = windows - windows.mean(axis=2, keepdims=True)
+        std = windows.std(axis=2)
+        amplitude[:, first:last] = std
+        hf_ratio[:, first:last] = np.divide(np.diff(windows, axis=2).std(axis=2), std,
+                                            out=np.zeros_like(std), where=std > 0)
+        if neighbours is not None:
+            z = np.divide(windows, std[..., np.newaxis], out=np.zeros_like(windows), where=std[..., np.newaxis] > 0)
+            # Correlation of every channel with each of its neighbours, window by window
+            neighbour_corr[:, first:last] = np.einsum('cwn,ckwn->cw', z, z[neighbours]) / (window * n_neighbours)
+
+    return pd.DataFrame({
+        'channel': [raw.ch_names[idx] for idx in picks],
+        'amplitude': np.median(amplitude, axis=1),
+        'hf_ratio': np.median(hf_ratio, axis=1),
+        'neighbour_corr': np.median(neighbour_corr, axis=1) if neighbours is not None else np.nan,
+    })
+
+
+def detect_bad_channels(raw, z_threshold=5.0, corr_threshold=0.4, flat_ratio=1e-3, window_sec=1.0,
+                        exclude=('VREF',)):
+    """
+    Detect bad EEG channels from robust statistics instead of a mean-vs-SD threshold.
+
+    A channel is bad when its amplitude deviates from the other channels by more than z_threshold
+    robust SDs (MAD), it is nearly flat (amplitude below flat_ratio times the median amplitude), its
+    high-frequency noise is more than z_threshold robust SDs above the others, or its median
+    correlation with its neighbours is below corr_threshold and z_threshold robust SDs below the others.
+
+    Parameters:
+    - raw: Raw, preloaded or not.
+    - z_threshold: Robust z-score threshold for amplitude and high-frequency noise.
+    - corr_threshold: Minimum median correlation with the neighbouring channels.
+    - flat_ratio: Amplitude ratio below which a channel counts as flat.
+    - window_sec: Window length in seconds.
+    - exclude: Channels never marked bad (the reference is flat by construction).
+
+    Returns:
+    - bad_channels: List of bad channel names.
+    - stats: channel_stats with a 'reason' column ('' for good channels).
+    """
+    picks = [idx for idx in mne.pick_types(raw.info, eeg=True, exclude=[]) if raw.ch_names[idx] not in exclude]
+    stats = channel_stats(raw, picks, window_sec=window_sec)
+    reasons = pd.DataFrame({
+        'flat': stats['amplitude'] < flat_ratio * stats['amplitude'].median(),
+        'deviation': np.abs(_robust_z(np.log(np.maximum(stats['amplitude'], 1e-30)))) > z_threshold,
+        'hf_noise': _robust_z(stats['hf_ratio']) > z_threshold,
+        # Only outliers: on noisy recordings every channel can be below the absolute threshold
+        'neighbour_corr': (stats['neighbour_corr'] < corr_threshold) &
+                          (_robust_z(stats['neighbour_corr']) < -z_threshold),
+    })
+    stats['reason'] = reasons.apply(lambda row: '+'.join(reasons.columns[row.values]), axis=1)
+    bad_channels = stats.loc[stats['reason'] != '', 'channel'].tolist()
+    print(f"Detected bad channels: {bad_channels}")
+    return bad_channels, stats
+
+
+def interpolation_matrix(info, bads, cache_dir=None):
+    """
+    Spherical-spline interpolation matrix from the good to the bad EEG channels.
+
+    The matrix is obtained by interpolating an identity matrix with raw.interpolate_bads, so it is
+    exactly MNE's interpolation. It is cached in memory and, with cache_dir, on disk, keyed on the
+    channel positions and the bad set.
+
+    Parameters:
+    - info: mne.Info with the montage.
+    - bads: Bad channel names.
+    - cache_dir: Optional directory for the on-disk cache, e.g. f'{base_path}/derivatives/cache/interpolation'.
+
+    Returns:
+    - matrix: Array (n_bads, n_goods).
+    - bad_idx, good_idx: Channel indices in info of the rows and columns.
+    """
+    eeg = mne.pick_types(info, eeg=True, exclude=[])
+    bad_idx = np.array([idx for idx in eeg if info['ch_names'][idx] in bads], dtype=int)
+    good_idx = np.array([idx for idx in eeg if info['ch_names'][idx] not in bads], dtype=int)
+
+    digest = hashlib.sha1()
+    for idx in eeg:
+        digest.update(info['ch_names'][idx].encode())
+        digest.update(np.ascontiguousarray(info['chs'][idx]['loc'][:3]).tobytes())
+    digest.update(','.join(sorted(bads)).encode())
+    key = digest.hexdigest()
+
+    if key in _interpolation_matrices:
+        return _interpolation_matrices[key], bad_idx, good_idx
+    cache_path = os.path.join(cache_dir, f'{key}.npy') if cache_dir is not None else None
+    if cache_path is not None and os.path.exists(cache_path):
+        matrix = np.load(cache_path)
+    else:
+        eeg_info = mne.pick_info(info, eeg)
+        with eeg_info._unlock():
+            eeg_info['bads'] = [ch for ch in eeg_info['ch_names'] if ch in bads]
+            eeg_info['projs'] = []
+        identity = mne.io.RawArray(np.eye(len(eeg)), eeg_info, verbose='WARNING')
+        identity.interpolate_bads(verbose='WARNING')
+        # Column j of the interpolated identity holds the weights of channel j
+        eeg_pos = {idx: pos for pos, idx in enumerate(eeg)}
+        matrix = identity.get_data()[np.ix_([eeg_pos[idx] for idx in bad_idx], [eeg_pos[idx] for idx in good_idx])]
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache_path, matrix)
+    _interpolation_matrices[key] = matrix
+    return matrix, bad_idx, good_idx
+
+
+def interpolate_bads_cached(raw, cache_dir=None, chunk_sec=60.0):
+    """
+    Interpolate raw.info['bads'] in place with a cached interpolation matrix, like raw.interpolate_bads().
+
+    Parameters:
+    - raw: Preloaded Raw.
+    - cache_dir: Optional directory for the on-disk matrix cache.
+    - chunk_sec: Length of the time chunks the matrix is applied to.
+
+    Returns:
+    - raw: The same Raw, with the bad channels interpolated and raw.info['bads'] reset.
+    """
+    if not raw.info['bads']:
+        return raw
+    matrix, bad_idx, good_idx = interpolation_matrix(raw.info, raw.info['bads'], cache_dir)
+    chunk = int(np.ceil(chunk_sec * raw.info['sfreq']))
+    for start in range(0, raw.n_times, chunk):
+        raw._data[bad_idx, start:start + chunk] = matrix @ raw._data[good_idx, start:start + chunk]
+    raw.info['bads'] = [ch for ch in raw.info['bads'] if raw.ch_names.index(ch) not in bad_idx]
+    return raw
@@ -0,0 +1,215 @@
+# Batch entry point: run the preprocessing chain for every subject x segment in a process pool
+# Usage: python scripts/batch.py [config.json]   (defaults to scripts/batch-config.json)
+
+import os
+import re
+import sys
+import json
+import time
+import importlib.util
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import pandas as pd
+from precision import PRECISION_ENV, get_dtype
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Stages that can be listed in the config, in the order they should run.
+# Each entry is (script file in scripts/, function name); the function takes (sub, stim, seg, base_path).
+STAGES = {
+    'eog_regression': ('4-EOG-Regression.py', 'run_ica_and_eog_regression'),
+}
+
+segment_pattern = re.compile(r'^(?P<sub>.+)_(?P<seg>segment_\d+)_(?P<stim>[^_]+)_eeg\.fif$')
+
+
+def discover_jobs(base_path, subjects=None):
+    """
+    Find every segmented_data/{sub}/*_eeg.fif file and turn it into a job.
+
+    Parameters:
+    - base_path: Base directory path for the project.
+    - subjects: Optional list of subjects to keep; all subject folders if None.
+
+    Returns:
+    - jobs: List of dicts with sub, seg, stim and fif_path, sorted by subject and segment number.
+    """
+    segmented_data_dir = os.path.join(base_path, 'segmented_data')
+    jobs = []
+    for sub in sorted(os.listdir(segmented_data_dir)):
+        sub_dir = os.path.join(segmented_data_dir, sub)
+        if not os.path.isdir(sub_dir) or (subjects is not None and sub not in subjects):
+            continue
+        for filename in os.listdir(sub_dir):
+            match = segment_pattern.match(filename)
+            if match is None or match['sub'] != sub:
+                continue
+            jobs.append({'sub': sub, 'seg': match['seg'], 'stim': match['stim'],
+                         'fif_path': os.path.join(sub_dir, filename)})
+    jobs.sort(key=lambda job: (job['sub'], int(job['seg'].split('_')[1])))
+    return jobs
+
+
+def load_stage(name):
+    # The pipeline scripts have hyphenated file names, so they are loaded from their path
+    script, function = STAGES[name]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(scripts_dir, script))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, function)
+
+
+def _limit_memory(memory_limit_mb):
+    # On Linux RLIMIT_DATA caps the heap and private anonymous mappings, but not the file-backed
+    # memory maps (caches, epoch stores) or reserved, unused address space (BLAS thread arenas).
+    # Elsewhere only the address-space limit RLIMIT_AS is available, which counts all of these.
+    try:
+        import resource
+        limit = int(memory_limit_mb * 1024 ** 2)
+        kind = resource.RLIMIT_DATA if sys.platform.startswith('linux') else resource.RLIMIT_AS
+        resource.setrlimit(kind, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        # Not enforceable on this platform (e.g. Windows, some macOS versions)
+        print(f"Could not set a {memory_limit_mb} MB memory limit, running unlimited")
+
+
+def _peak_memory_mb():
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _run_job(job, stages, base_path, memory_limit_mb, started=None):
+    # Runs in a fresh worker process; figures are rendered headless
+    if started is not None:
+        # Tells run_batch which jobs were running if the pool breaks
+        started[job['fif_path']] = os.getpid()
+    os.environ['MPLBACKEND'] = 'Agg'
+    if memory_limit_mb:
+        _limit_memory(memory_limit_mb)
+
+    rows = []
+    for name in stages:
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            load_stage(name)(job['sub'], job['stim'], job['seg'], base_path)
+        except MemoryError:
+            status = 'memory limit'
+        except Exception:
+            status = 'failed'
+            traceback.print_exc()
+        rows.append({**job, 'stage': name, 'status': status,
+                     'wall_time_s': time.perf_counter() - start, 'peak_memory_mb': _peak_memory_mb()})
+        if status != 'ok':
+            # Later stages depend on this one
+            break
+    return rows
+
+
+def _run_pool(jobs, stages, base_path, n_jobs, memory_limit_mb, started):
+    # Runs jobs in one process pool. If a worker is killed (e.g. by the OOM killer), the pool breaks
+    # and every unfinished job fails with BrokenProcessPool; those are returned to be run again,
+    # split into the jobs that had started and those still queued.
+    rows, unfinished = [], []
+    with ProcessPoolExecutor(max_workers=n_jobs, max_tasks_per_child=1) as executor:
+        futures = {executor.submit(_run_job, job, stages, base_path, memory_limit_mb, started): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                rows.extend(future.result())
+            except BrokenProcessPool:
+                unfinished.append(job)
+                continue
+            print(f"Finished {job['sub']} {job['seg']} {job['stim']}")
+    in_flight = [job for job in unfinished if job['fif_path'] in started]
+    queued = [job for job in unfinished if job['fif_path'] not in started]
+    return rows, in_flight, queued
+
+
+def run_batch(base_path, stages, subjects=None, n_jobs=4, memory_limit_mb=None, precision=None):
+    """
+    Run the listed stages for every discovered segment across a process pool.
+
+    Each job runs in its own worker process, so the memory limit applies per job and memory is
+    returned to the system between jobs. A worker killed by the operating system breaks the pool:
+    the jobs that were running are then rerun one at a time, so only the one that gets killed again
+    is reported as 'crashed', and the queued jobs continue in a new pool.
+
+    Parameters:
+    - base_path: Base directory path for the project.
+    - stages: List of stage names from STAGES, run in order for each job.
+    - subjects: Optional list of subjects; all subjects in segmented_data if None.
+    - n_jobs: Number of worker processes.
+    - memory_limit_mb: Memory limit per job in MB, or None for no limit. On Linux it limits the heap
+      and anonymous memory (RLIMIT_DATA), so memory-mapped caches and epoch stores do not count; on
+      other platforms it limits the whole address space (RLIMIT_AS), memory maps included.
+    - precision: 'float64' or 'float32' data path for every job (see precision.py), or None to keep
+      the EEG_PRECISION environment variable.
+
+    Returns:
+    - summary: DataFrame with one row per job and stage: status, wall time and peak memory.
+    """
+    unknown = [name for name in stages if name not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stages {unknown}, expected some of {list(STAGES)}")
+
+    if precision is not None:
+        # Inherited by the worker processes, where the caches and segment buffers read it
+        os.environ[PRECISION_ENV] = get_dtype(precision).name
+
+    jobs = discover_jobs(base_path, subjects)
+    print(f"Found {len(jobs)} segments to process with stages {stages}")
+
+    rows = []
+    with multiprocessing.Manager() as manager:
+        started = manager.dict()
+        pending = jobs
+        while pending:
+            pool_rows, in_flight, pending = _run_pool(pending, stages, base_path, n_jobs, memory_limit_mb, started)
+            rows.extend(pool_rows)
+            for job in in_flight:
+                # The pool killed every running job when one worker died; alone, only the culprit dies again
+                print(f"Worker pool broke, rerunning {job['sub']} {job['seg']} {job['stim']} on its own")
+                job_rows, crashed, _ = _run_pool([job], stages, base_path, 1, memory_limit_mb, started)
+                rows.extend(job_rows)
+                if crashed:
+                    # The worker was killed, most likely by the operating system running out of memory
+                    rows.append({**job, 'stage': None, 'status': 'crashed',
+                                 'wall_time_s': float('nan'), 'peak_memory_mb': float('nan')})
+                    print(f"Crashed {job['sub']} {job['seg']} {job['stim']}")
+
+    summary = pd.DataFrame(rows, columns=['sub', 'seg', 'stim', 'fif_path', 'stage', 'status',
+                                          'wall_time_s', 'peak_memory_mb'])
+    return summary.sort_values(['sub', 'seg', 'stage']).reset_index(drop=True)
+
+
+def main():
+    config_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(scripts_dir, 'batch-config.json')
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+
+    base_path = config['base_path']
+    summary = run_batch(base_path, config['stages'], subjects=config.get('subjects'),
+                        n_jobs=config.get('n_jobs', 4), memory_limit_mb=config.get('memory_limit_mb'),
+                        precision=config.get('precision'))
+
+    print("\nBatch summary:")
+    print(summary.drop(columns='fif_path').to_string(index=False))
+
+    # Save the summary table next to the other derivatives
+    summary_dir = os.path.join(base_path, 'derivatives', 'batch')
+    os.makedirs(summary_dir, exist_ok=True)
+    summary_path = os.path.join(summary_dir, f'batch-summary-{time.strftime("%Y%m%d-%H%M%S")}.csv')
+    summary.to_csv(summary_path, index=False)
+    print(f"\nBatch summary saved to '{summary_path}'")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# On-disk cache of preprocessed continuous data (bad channels, ICA, filters, reference)
+# Entries are keyed on a hash of the input file and every preprocessing parameter and are
+# returned memory-mapped, so rerunning an analysis does not redo the filtering pass.
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import mne
+from filtering import fused_filter
+from bad_channels import interpolate_bads_cached
+from precision import get_dtype
+
+
+def _file_fingerprint(fif_path):
+    # Path, size and modification time identify the input without hashing gigabytes of data
+    stat = os.stat(fif_path)
+    return {'path': os.path.abspath(fif_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def ica_fingerprint(ica):
+    """
+    Identify a fitted ICA by a digest of its unmixing and PCA matrices plus its excluded components.
+
+    Returns:
+    - fingerprint: JSON-serializable dict, or None if ica is None.
+    """
+    if ica is None:
+        return None
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(ica.unmixing_matrix_).tobytes())
+    digest.update(np.ascontiguousarray(ica.pca_components_).tobytes())
+    return {'unmixing': digest.hexdigest(), 'exclude': sorted(int(idx) for idx in ica.exclude)}
+
+
+def cache_key(fif_path, params, ica=None):
+    """
+    Hash the input file and the preprocessing parameters into a cache key.
+
+    Parameters:
+    - fif_path: Input FIF path.
+    - params: Dict of JSON-serializable preprocessing parameters.
+    - ica: Fitted ICA whose unmixing matrix and exclusions are part of the key, or None.
+
+    Returns:
+    - key: Hex digest identifying the preprocessed result.
+    """
+    description = {'input': _file_fingerprint(fif_path), 'params': params, 'ica': ica_fingerprint(ica)}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def _preprocess(fif_path, cache_dir, bads, interpolate, ica, notch_freq, l_freq, h_freq, reference):
+    raw = mne.io.read_raw_fif(fif_path, preload=True)
+    raw.info['bads'] = list(bads)
+    if interpolate and bads:
+        # The interpolation matrix is shared by every segment with the same bad set
+        interpolate_bads_cached(raw, cache_dir=os.path.join(cache_dir, 'interpolation'))
+    if ica is not None:
+        ica.apply(raw)
+    if notch_freq is not None or l_freq is not None or h_freq is not None:
+        # Notch and band-pass in a single pass with one combined kernel
+        fused_filter(raw, l_freq=l_freq, h_freq=h_freq, notch_freq=notch_freq)
+    if reference in ('VREF', 'VREF+average'):
+        raw.set_eeg_reference(['VREF'])
+    if reference is not None:
+        # Extract only the channels starting with 'E'
+        eeg_channels = [ch for ch in raw.ch_names if ch.startswith('E')]
+        raw.pick(eeg_channels)
+    if reference in ('average', 'VREF+average'):
+        raw.set_eeg_reference('average', projection=True)
+    return raw
+
+
+def _entry_size(entry_dir):
+    return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+
+
+def evict(cache_dir, max_cache_gb, keep=None):
+    """
+    Remove least recently used entries until the cache fits in max_cache_gb.
+
+    Parameters:
+    - cache_dir: Cache directory.
+    - max_cache_gb: Size bound in gigabytes.
+    - keep: Entry directory that is never evicted (the one just written).
+    """
+    # Only directories with an entry.json are entries (not e.g. the interpolation matrices)
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+               if os.path.exists(os.path.join(cache_dir, name, 'entry.json'))
+               and os.path.join(cache_dir, name) != keep]
+    # Entry directories are touched on every hit, so their mtime is the last use
+    entries.sort(key=os.path.getmtime)
+    sizes = {entry: _entry_size(entry) for entry in entries}
+    total = sum(sizes.values())
+    while entries and total > max_cache_gb * 1024 ** 3:
+        entry = entries.pop(0)
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
+
+
+def _open_entry(entry_dir):
+    with open(os.path.join(entry_dir, 'entry.json')) as json_file:
+        entry = json.load(json_file)
+    info = mne.io.read_info(os.path.join(entry_dir, 'info.fif'), verbose='WARNING')
+    # Copy-on-write mapping: in-place operations on the returned Raw never touch the cache
+    data = np.load(os.path.join(entry_dir, 'data.npy'), mmap_mode='c')
+    # Raw objects are always float64: float64 entries stay memory-mapped, float32 entries are read into
+    # memory as float64 (MNE's resample, filter and reference methods expect float64 data)
+    raw = mne.io.RawArray(data, info, first_samp=entry['first_samp'], verbose='WARNING')
+    annot_path = os.path.join(entry_dir, 'annot.fif')
+    if os.path.exists(annot_path):
+        raw.set_annotations(mne.read_annotations(annot_path))
+    return raw
+
+
+def _write_entry(raw, entry_dir, params, fif_path, dtype):
+    cache_dir = os.path.dirname(entry_dir)
+    # Write into a temporary directory first so a crashed run never leaves a partial entry
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    # Written a block of channels at a time, so a float32 entry never needs a full float32 copy
+    data = np.lib.format.open_memmap(os.path.join(tmp_dir, 'data.npy'), mode='w+', dtype=dtype,
+                                     shape=(len(raw.ch_names), int(raw.n_times)))
+    for start in range(0, len(raw.ch_names), 16):
+        data[start:start + 16] = raw.get_data(picks=np.arange(start, min(start + 16, len(raw.ch_names))))
+    data.flush()
+    del data
+    mne.io.write_info(os.path.join(tmp_dir, 'info.fif'), raw.info)
+    if len(raw.annotations):
+        raw.annotations.save(os.path.join(tmp_dir, 'annot.fif'), overwrite=True)
+    with open(os.path.join(tmp_dir, 'entry.json'), 'w') as json_file:
+        json.dump({'source': os.path.abspath(fif_path), 'params': params, 'first_samp': int(raw.first_samp)},
+                  json_file)
+    try:
+        os.replace(tmp_dir, entry_dir)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_preprocessed(fif_path, cache_dir, bads=(), interpolate=False, ica=None, notch_freq=None,
+                      l_freq=None, h_freq=None, reference=None, max_cache_gb=20.0, precision=None):
+    """
+    Return the preprocessed continuous data for a segment, computing it only on a cache miss.
+
+    The steps run in the pipeline order: bad channels (optionally interpolated), ICA exclusion,
+    notch filter, band-pass filter, re-reference.
+
+    Parameters:
+    - fif_path: Segment FIF path.
+    - cache_dir: Cache directory, e.g. f'{base_path}/derivatives/cache'.
+    - bads: Bad channel names.
+    - interpolate: Whether to interpolate the bad channels.
+    - ica: Fitted ICA with ica.exclude set, or None to skip ICA.
+    - notch_freq: Notch frequency in Hz, or None.
+    - l_freq, h_freq: Band-pass edges in Hz (None for no high-pass / low-pass).
+    - reference: None, 'average' (CAR projection), 'VREF', or 'VREF+average'. When set, only the
+      channels starting with 'E' are kept.
+    - max_cache_gb: Size bound of the cache; least recently used entries are evicted.
+    - precision: 'float64' or 'float32' storage of the cached data (default: the EEG_PRECISION
+      environment variable). float32 halves the entry on disk; preprocessing runs and the returned
+      Raw is in float64 either way, read into memory for float32 entries.
+
+    Returns:
+    - raw: Preprocessed float64 Raw, whose data is memory-mapped from the cache for float64 entries.
+    """
+    dtype = get_dtype(precision)
+    params = {'bads': sorted(bads), 'interpolate': interpolate, 'notch_freq': notch_freq,
+              'l_freq': l_freq, 'h_freq': h_freq, 'filter': 'fused-fir', 'reference': reference}
+    if dtype != np.float64:
+        # Only added for float32, so existing float64 entries keep their keys
+        params['precision'] = dtype.name
+    key = cache_key(fif_path, params, ica)
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_dir = os.path.join(cache_dir, key)
+
+    if os.path.exists(entry_dir):
+        os.utime(entry_dir)
+        print(f"Loading preprocessed data from cache: {entry_dir}")
+        return _open_entry(entry_dir)
+
+    raw = _preprocess(fif_path, cache_dir, bads, interpolate, ica, notch_freq, l_freq, h_freq, reference)
+    _write_entry(raw, entry_dir, params, fif_path, dtype)
+    evict(cache_dir, max_cache_gb, keep=entry_dir)
+    del raw
+    return _open_entry(entry_dir)
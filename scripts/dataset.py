@@ -0,0 +1,87 @@
+# Cross-segment datasets: the phoneme epochs of every stimulus (segment) of a subject combined into one
+# memory-mapped epoch store, with the stimulus and story of each epoch for grouped cross-validation.
+
+import os
+import re
+import json
+from batch import discover_jobs
+from epoch_store import EpochStore, concatenate_stores
+
+
+def segment_store_dir(base_path, sub, seg, stim, level='phoneme'):
+    """
+    Epoch store of one segment, e.g. derivatives/individual/phoneme_epochs/phoneme-epo-pilot-3-Jobs1-segment_1.
+    """
+    return os.path.join(base_path, 'derivatives', 'individual', f'{level}_epochs', f'{level}-epo-{sub}-{stim}-{seg}')
+
+
+def subject_store_dir(base_path, sub, level='phoneme'):
+    """
+    Combined epoch store of all segments of a subject, e.g. .../phoneme_epochs/phoneme-epo-pilot-3-all.
+    """
+    return os.path.join(base_path, 'derivatives', 'individual', f'{level}_epochs', f'{level}-epo-{sub}-all')
+
+
+def stimulus_group(stim):
+    """
+    Story a stimulus belongs to, so the fast and slow versions of a story (e.g. BecFast and BecSlow)
+    fall in the same cross-validation group. Jobs1..3 are different parts of one story and are kept apart.
+    """
+    return re.sub(r'(Fast|Slow)$', '', stim)
+
+
+def _is_current(out_dir, store_dirs):
+    # The combined store is reused when it was built from the same stores after they were last written
+    store_json = os.path.join(out_dir, 'store.json')
+    if not os.path.exists(store_json):
+        return False
+    with open(store_json) as json_file:
+        sources = json.load(json_file).get('sources')
+    if sources != [os.path.abspath(store_dir) for store_dir in store_dirs]:
+        return False
+    built = os.path.getmtime(store_json)
+    return all(os.path.getmtime(os.path.join(store_dir, 'store.json')) <= built for store_dir in store_dirs)
+
+
+def build_subject_dataset(base_path, sub, make_store=None, level='phoneme', rebuild=False):
+    """
+    Combine the epoch stores of every segment of a subject into one memory-mapped epoch store.
+
+    The segment stores are copied chunk by chunk into the combined store (see concatenate_stores), so
+    neither the segments nor the combined data are ever held in memory. The metadata gains 'seg',
+    'stim' and 'group' (story) columns, for make_group_folds.
+
+    Parameters:
+    - base_path: Base directory path for the project.
+    - sub: Subject identifier.
+    - make_store: Optional function (job, store_dir) that writes a missing segment store, where job is
+      a dict from batch.discover_jobs (sub, seg, stim, fif_path). Without it, missing stores are an error.
+    - level: 'phoneme' or 'word' epoch stores.
+    - rebuild: Whether to rebuild the combined store even if it is up to date.
+
+    Returns:
+    - store: EpochStore over the combined epochs of all segments, in segment order.
+    """
+    jobs = discover_jobs(base_path, [sub])
+    if not jobs:
+        raise FileNotFoundError(f"No segments found for {sub} in {base_path}/segmented_data")
+
+    store_dirs = []
+    for job in jobs:
+        store_dir = segment_store_dir(base_path, sub, job['seg'], job['stim'], level)
+        if not os.path.exists(os.path.join(store_dir, 'store.json')):
+            if make_store is None:
+                raise FileNotFoundError(f"Missing epoch store {store_dir}")
+            print(f"Creating {level} epochs for {sub} {job['seg']} {job['stim']}")
+            make_store(job, store_dir)
+        store_dirs.append(store_dir)
+
+    out_dir = subject_store_dir(base_path, sub, level)
+    if not rebuild and _is_current(out_dir, store_dirs):
+        print(f"Loading combined {level} epochs from {out_dir}")
+        return EpochStore(out_dir)
+
+    metadata_columns = [{'seg': job['seg'], 'stim': job['stim'], 'group': stimulus_group(job['stim'])} for job in jobs]
+    store = concatenate_stores(store_dirs, out_dir, metadata_columns=metadata_columns)
+    print(f"Combined {len(store)} {level} epochs from {len(jobs)} segments into {out_dir}")
+    return store
@@ -0,0 +1,385 @@
+# Shared decoding helpers for the phoneme decoding scripts
+# The epoch array is pulled once, the CV folds and per-fold scalers are computed once, and every
+# (fold, time chunk) is fitted as one task in a single process pool instead of one pool per timepoint.
+# The same folds and scalers serve the diagonal decoder and the temporal generalization matrix.
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.stats import rankdata
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import KFold, GroupKFold, LeaveOneGroupOut
+
+
+def make_folds(n_epochs, n_splits=5, random_state=42):
+    """
+    Precompute the train/test splits shared by every timepoint and every feature.
+
+    Parameters:
+    - n_epochs: Number of epochs (trials).
+    - n_splits: Number of CV folds.
+    - random_state: Seed for the fold shuffle, so reruns and features use identical folds.
+
+    Returns:
+    - folds: List of (train_indices, test_indices) tuples.
+    """
+    cv = KFold(n_splits, shuffle=True, random_state=random_state)
+    return list(cv.split(np.arange(n_epochs)))
+
+
+def make_group_folds(groups, n_splits=None):
+    """
+    Precompute train/test splits that never put epochs of the same group in both train and test.
+
+    Use this for datasets combining several stimuli (see dataset.build_subject_dataset), so the
+    classifier is always tested on a story it was not trained on.
+
+    Parameters:
+    - groups: Group label of every epoch, e.g. the 'group' metadata column.
+    - n_splits: Number of folds (GroupKFold); None leaves one group out per fold.
+
+    Returns:
+    - folds: List of (train_indices, test_indices) tuples.
+    """
+    groups = np.asarray(groups)
+    cv = LeaveOneGroupOut() if n_splits is None else GroupKFold(n_splits)
+    return list(cv.split(np.arange(len(groups)), groups=groups))
+
+
+def label_matrix(metadata, desired_values):
+    """
+    One binary label column per phonetic feature, from the epoch metadata.
+
+    Parameters:
+    - metadata: Epoch metadata (epochs.metadata or EpochStore.metadata).
+    - desired_values: Dict {column: value}, e.g. {'phonation': 'v', 'manner': 'f', ...}; column k of
+      the result is metadata[column] == value.
+
+    Returns:
+    - labels: Boolean DataFrame (n_epochs, n_features) with the same row order as metadata.
+    """
+    return pd.DataFrame({feat: (metadata[feat] == value).values for feat, value in desired_values.items()})
+
+
+def selected_epochs(labels):
+    """
+    Indices of the epochs matching at least one feature, each epoch once.
+
+    This replaces indexing the epochs once per feature and concatenating the results, which copied
+    the data and repeated an epoch for every feature it matched.
+
+    Parameters:
+    - labels: Output of label_matrix.
+
+    Returns:
+    - idx: Sorted epoch indices.
+    """
+    return np.flatnonzero(labels.values.any(axis=1))
+
+
+def index_folds(idx, folds):
+    """
+    Map folds over a subset of epochs to indices into the full epoch array.
+
+    The decoders then index the shared epoch buffer directly (X[train]), so a subset of epochs is
+    never copied out of it first.
+
+    Parameters:
+    - idx: Epoch indices of the subset (e.g. from selected_epochs).
+    - folds: Folds over positions in idx, from make_folds(len(idx)) or make_group_folds(groups[idx]).
+
+    Returns:
+    - folds: List of (train_indices, test_indices) into the full epoch array.
+    """
+    return [(idx[train], idx[test]) for train, test in folds]
+
+
+def fold_scalers(X, folds, chunk_size=50):
+    """
+    Compute StandardScaler statistics for every fold and every timepoint.
+
+    The statistics are computed a chunk of timepoints at a time, so a memory-mapped X (e.g. from an
+    EpochStore) is never copied whole.
+
+    Parameters:
+    - X: Epoch array (n_epochs, n_channels, n_times).
+    - folds: Output of make_folds.
+    - chunk_size: Number of timepoints loaded at a time.
+
+    Returns:
+    - scalers: List of (mean, scale) arrays, each (n_channels, n_times), one pair per fold.
+    """
+    scalers = []
+    for train, _ in folds:
+        mean = np.empty(X.shape[1:])
+        scale = np.empty(X.shape[1:])
+        for start in range(0, X.shape[-1], chunk_size):
+            times = slice(start, start + chunk_size)
+            X_train = X[train, :, times]
+            mean[:, times] = X_train.mean(axis=0, dtype=np.float64)
+            scale[:, times] = X_train.std(axis=0, dtype=np.float64)
+        # Same convention as StandardScaler for constant features
+        scale[scale == 0] = 1.0
+        scalers.append((mean, scale))
+    return scalers
+
+
+def roc_auc(y, scores):
+    """
+    Rank-based ROC-AUC vectorized over targets and timepoints.
+
+    Parameters:
+    - y: Binary labels (n_epochs, n_targets).
+    - scores: Decision values (n_epochs, n_targets, ...), e.g. (n_epochs, n_targets, n_times).
+
+    Returns:
+    - auc: Array (n_targets, ...), NaN where a target has a single class in y.
+    """
+    ranks = rankdata(scores, axis=0)
+    n_pos = y.sum(axis=0).astype(float)
+    n_neg = len(y) - n_pos
+    rank_sum = np.einsum('nk,nk...->k...', y, ranks)
+    shape = (-1,) + (1,) * (rank_sum.ndim - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        auc = (rank_sum - (n_pos * (n_pos + 1) / 2).reshape(shape)) / (n_pos * n_neg).reshape(shape)
+    auc[(n_pos == 0) | (n_neg == 0)] = np.nan
+    return auc
+
+
+def bin_times(X, times, decim=1, bin_size=1):
+    """
+    Reduce the time axis before decoding to bound the cost of the T x T generalization matrix.
+
+    Parameters:
+    - X: Epoch array (n_epochs, n_channels, n_times).
+    - times: Epoch times in seconds (n_times,).
+    - decim: Keep every decim-th sample (applied after binning).
+    - bin_size: Average non-overlapping bins of this many samples (trailing samples are dropped).
+
+    Returns:
+    - X: Reduced epoch array.
+    - times: Times of the retained samples (bin centres when binning).
+    """
+    if bin_size > 1:
+        n_bins = X.shape[-1] // bin_size
+        X = X[..., :n_bins * bin_size].reshape(X.shape[:-1] + (n_bins, bin_size)).mean(axis=-1)
+        times = times[:n_bins * bin_size].reshape(n_bins, bin_size).mean(axis=-1)
+    return X[..., ::decim], times[::decim]
+
+
+def _make_classifier():
+    return LogisticRegression(solver='liblinear')
+
+
+def _fit_logistic(X_train, y_train):
+    # One liblinear fit per target and timepoint
+    n_targets, n_times = y_train.shape[1], X_train.shape[-1]
+    coef = np.zeros((n_targets, n_times, X_train.shape[1]))
+    intercept = np.full((n_targets, n_times), np.nan)
+    for kk in range(n_targets):
+        # liblinear cannot fit a single class, leave those scores undefined
+        if len(np.unique(y_train[:, kk])) < 2:
+            continue
+        for tt in range(n_times):
+            clf = _make_classifier().fit(X_train[:, :, tt], y_train[:, kk])
+            coef[kk, tt] = clf.coef_[0]
+            intercept[kk, tt] = clf.intercept_[0]
+    return coef, intercept
+
+
+def _fit_closed_form(X_train, y_train, method, alpha):
+    # All targets and timepoints of a standardized chunk at once: one (regularized) channel covariance
+    # per timepoint, shared by every target, and one batched solve for all of them
+    n_epochs, n_channels = X_train.shape[:2]
+    Xt = np.ascontiguousarray(X_train.transpose(2, 0, 1), dtype=np.float64)  # (n_times, n_epochs, n_channels)
+    y = y_train.astype(np.float64)
+    eye = np.eye(n_channels)
+
+    if method == 'ridge':
+        # Ridge regression on +-1 targets; the dual form is cheaper with fewer epochs than channels
+        targets = 2 * y - 1
+        if n_epochs >= n_channels:
+            coef = np.linalg.solve(Xt.transpose(0, 2, 1) @ Xt + alpha * eye, Xt.transpose(0, 2, 1) @ targets)
+        else:
+            gram = Xt @ Xt.transpose(0, 2, 1) + alpha * np.eye(n_epochs)
+            coef = Xt.transpose(0, 2, 1) @ np.linalg.solve(gram, np.broadcast_to(targets, (len(Xt),) + targets.shape))
+        # The training data is centred by the fold scaler, so the intercept is the mean target
+        intercept = np.broadcast_to(targets.mean(axis=0)[:, np.newaxis], (y.shape[1], len(Xt))).copy()
+    else:
+        # Shrinkage LDA: for two classes the total covariance gives the same direction as the pooled
+        # within-class covariance, so one covariance per timepoint serves every target
+        cov = Xt.transpose(0, 2, 1) @ Xt / n_epochs
+        shrunk = (1 - alpha) * cov + alpha * (np.trace(cov, axis1=1, axis2=2) / n_channels)[:, np.newaxis, np.newaxis] * eye
+        n_pos = y.sum(axis=0)
+        n_neg = n_epochs - n_pos
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_pos = Xt.transpose(0, 2, 1) @ y / n_pos
+            mean_neg = Xt.transpose(0, 2, 1) @ (1 - y) / n_neg
+        coef = np.linalg.solve(shrunk, np.nan_to_num(mean_pos - mean_neg))
+        intercept = -np.einsum('tck,tck->kt', coef, (mean_pos + mean_neg) / 2)
+
+    coef = coef.transpose(2, 0, 1)  # (n_targets, n_times, n_channels)
+    # Like liblinear, a target with a single class in the training set has undefined scores
+    single_class = (y.sum(axis=0) == 0) | (y.sum(axis=0) == n_epochs)
+    coef[single_class] = 0
+    intercept[single_class] = np.nan
+    return coef, intercept
+
+
+def _fit_chunk(X_train, y_train, method='logistic', alpha=None):
+    # Fit one classifier per target and timepoint of an already standardized chunk
+    if method == 'logistic':
+        return _fit_logistic(X_train, y_train)
+    if method not in ('ridge', 'lda'):
+        raise ValueError(f"method should be 'logistic', 'ridge' or 'lda', got {method!r}")
+    if alpha is None:
+        alpha = 1.0 if method == 'ridge' else 0.1
+    return _fit_closed_form(X_train, y_train, method, alpha)
+
+
+def _score_chunk(X, Y, train, test, mean, scale, times, method='logistic', alpha=None):
+    # Standardize only this chunk of timepoints, using the fold's precomputed statistics
+    X_train = (X[train, :, times] - mean[:, times]) / scale[:, times]
+    X_test = (X[test, :, times] - mean[:, times]) / scale[:, times]
+    coef, intercept = _fit_chunk(X_train, Y[train], method, alpha)
+
+    decision = np.einsum('nct,ktc->nkt', X_test, coef) + intercept
+    return roc_auc(Y[test], decision)
+
+
+def _generalize_chunk(X, Y, train, test, mean, scale, times, method='logistic', alpha=None):
+    X_train = (X[train, :, times] - mean[:, times]) / scale[:, times]
+    coef, intercept = _fit_chunk(X_train, Y[train], method, alpha)
+
+    # Fold each training time's scaler into its weights so every test time is scored by one product
+    weights = coef / scale[:, times].T
+    offset = intercept - np.einsum('ktc,ct->kt', weights, mean[:, times])
+    decision = np.einsum('ncs,ktc->nkts', X[test], weights) + offset[..., None]
+    return roc_auc(Y[test], decision)
+
+
+def _chunks(n_times, n_chunks, size):
+    if n_chunks is None:
+        n_chunks = max(1, n_times // size)
+    bounds = np.linspace(0, n_times, min(n_chunks, n_times) + 1).astype(int)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def decode_timecourse(X, Y, folds=None, n_chunks=None, n_jobs=-1, method='logistic', alpha=None):
+    """
+    Decode every target at every timepoint with shared folds and scalers.
+
+    Parameters:
+    - X: Epoch array (n_epochs, n_channels, n_times), e.g. epochs.get_data(copy=False).
+    - Y: Binary labels (n_epochs,) or (n_epochs, n_targets), one column per phonetic feature.
+    - folds: Output of make_folds, make_group_folds or index_folds (folds may cover only a subset of
+      the epochs); computed with the defaults if None.
+    - n_chunks: Number of time chunks per fold dispatched to the pool (defaults to ~50 timepoints each).
+    - n_jobs: Number of worker processes for the single joblib pool.
+    - method: 'logistic' (one liblinear fit per target and timepoint), or the closed forms 'ridge'
+      (ridge regression on +-1 targets) and 'lda' (shrinkage LDA), which fit every target of a time chunk in one
+      batched solve and are many times faster.
+    - alpha: Ridge penalty for 'ridge' (default 1.0), shrinkage in [0, 1] for 'lda' (default 0.1).
+
+    Returns:
+    - scores: Mean ROC-AUC across folds, (n_targets, n_times) or (n_times,) for 1-D Y.
+    """
+    Y = np.asarray(Y, dtype=int)
+    squeeze = Y.ndim == 1
+    if squeeze:
+        Y = Y[:, None]
+    if folds is None:
+        folds = make_folds(len(X))
+    scalers = fold_scalers(X, folds)
+
+    n_times = X.shape[-1]
+    chunks = _chunks(n_times, n_chunks, 50)
+
+    # One task per (fold, chunk); joblib memory-maps X so workers do not copy it
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_score_chunk)(X, Y, train, test, mean, scale, times, method, alpha)
+        for (train, test), (mean, scale) in zip(folds, scalers)
+        for times in chunks
+    )
+
+    fold_scores = np.concatenate(results, axis=1).reshape(Y.shape[1], len(folds), n_times)
+    scores = fold_scores.mean(axis=1)
+    return scores[0] if squeeze else scores
+
+
+def generalize_timecourse(X, Y, folds=None, scalers=None, n_chunks=None, n_jobs=-1, method='logistic', alpha=None):
+    """
+    Temporal generalization: train at every timepoint and test at every timepoint.
+
+    One classifier is fitted per training timepoint per fold and scored against all test timepoints
+    as a single matrix product. Use bin_times first to bound the T x T cost.
+
+    Parameters:
+    - X: Epoch array (n_epochs, n_channels, n_times).
+    - Y: Binary labels (n_epochs,) or (n_epochs, n_targets).
+    - folds: Output of make_folds, make_group_folds or index_folds; computed with the defaults if None.
+    - scalers: Output of fold_scalers for the same X and folds; computed if None.
+    - n_chunks: Number of training-time chunks per fold dispatched to the pool (defaults to ~10 timepoints each).
+    - n_jobs: Number of worker processes for the single joblib pool.
+    - method: 'logistic' (one liblinear fit per target and timepoint), or the closed forms 'ridge'
+      (ridge regression on +-1 targets) and 'lda' (shrinkage LDA), which fit every target of a time chunk in one
+      batched solve and are many times faster.
+    - alpha: Ridge penalty for 'ridge' (default 1.0), shrinkage in [0, 1] for 'lda' (default 0.1).
+
+    Returns:
+    - scores: Mean ROC-AUC across folds, (n_targets, n_train_times, n_test_times), without the
+      target axis for 1-D Y.
+    """
+    Y = np.asarray(Y, dtype=int)
+    squeeze = Y.ndim == 1
+    if squeeze:
+        Y = Y[:, None]
+    if folds is None:
+        folds = make_folds(len(X))
+    if scalers is None:
+        scalers = fold_scalers(X, folds)
+
+    n_times = X.shape[-1]
+    chunks = _chunks(n_times, n_chunks, 10)
+
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_generalize_chunk)(X, Y, train, test, mean, scale, times, method, alpha)
+        for (train, test), (mean, scale) in zip(folds, scalers)
+        for times in chunks
+    )
+
+    fold_scores = np.concatenate(results, axis=1).reshape(Y.shape[1], len(folds), n_times, n_times)
+    scores = fold_scores.mean(axis=1)
+    return scores[0] if squeeze else scores
+
+
+def save_generalization(path, scores, times, y=None):
+    """
+    Save one generalization matrix as a compact float32 archive alongside its time axis.
+
+    A matrix decoded from labels with a single class has undefined (NaN) scores everywhere and is
+    refused, so it never ends up in a cache that later runs reload instead of recomputing.
+
+    Parameters:
+    - path: Output .npz path.
+    - scores: Matrix (n_train_times, n_test_times).
+    - times: Times of the matrix axes in seconds.
+    - y: Binary labels (n_epochs,) the matrix was decoded from, checked for both classes.
+    """
+    if y is not None and len(np.unique(y)) < 2:
+        raise ValueError(f"Labels of {path} have a single class; the generalization scores are undefined")
+    if np.isnan(scores).all():
+        raise ValueError(f"Generalization scores of {path} are all NaN")
+    np.savez_compressed(path, scores=scores.astype(np.float32), times=np.asarray(times, dtype=np.float32))
+
+
+def load_generalization(path):
+    """
+    Load a generalization matrix written by save_generalization.
+
+    Returns:
+    - scores: Matrix (n_train_times, n_test_times).
+    - times: Times of the matrix axes in seconds.
+    """
+    with np.load(path) as archive:
+        return archive['scores'], archive['times']
@@ -0,0 +1,243 @@
+# Memory-mapped epoch store: one contiguous (n_epochs, n_channels, n_times) float32 array per
+# subject/segment/stimulus plus the aligned annotation rows as a metadata sidecar.
+
+import io
+import os
+import json
+import numpy as np
+import pandas as pd
+import mne
+
+
+def iter_epoch_chunks(epochs, chunk_size=256, drop_log=None):
+    """
+    Yield epochs a chunk at a time, so long windows never need preload=True.
+
+    Create the epochs with preload=False (and decim to downsample on the fly); each chunk is read
+    from the continuous data only when it is requested, and its bad epochs (reject/flat thresholds,
+    windows running past the data) are dropped as it is read. Every epoch is therefore read once,
+    instead of once by a drop_bad() over all epochs and again for its chunk.
+
+    Parameters:
+    - epochs: mne.Epochs, usually not preloaded.
+    - chunk_size: Number of epochs read per chunk (before rejection).
+    - drop_log: Optional list, e.g. list(epochs.drop_log), updated with the reason of every epoch
+      dropped in each chunk as it is read.
+
+    Yields:
+    - chunk: mne.Epochs of the good epochs in this chunk, with their events and metadata rows.
+    - data: Array (n_good, n_channels, n_times).
+    """
+    # len(epochs) is unknown before rejection, the candidate epochs are the selected events
+    n_candidates = len(epochs.events)
+    for start in range(0, n_candidates, chunk_size):
+        stop = min(start + chunk_size, n_candidates)
+        chunk = epochs[start:stop]
+        data = chunk.get_data()
+        if drop_log is not None:
+            for ii in epochs.selection[start:stop]:
+                drop_log[ii] = chunk.drop_log[ii]
+        yield chunk, data
+
+
+def _truncate_npy(path, n_rows):
+    # Shrink the first axis of a .npy file in place. numpy pads the header so the first dimension
+    # can change without moving the data, so only the header is rewritten and the tail cut off
+    with open(path, 'r+b') as npy_file:
+        version = np.lib.format.read_magic(npy_file)
+        read_header, write_header = ((np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0)
+                                     if version == (1, 0) else
+                                     (np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0))
+        shape, fortran_order, dtype = read_header(npy_file)
+        offset = npy_file.tell()
+        header = io.BytesIO()
+        write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                              'shape': (n_rows,) + tuple(shape[1:])})
+        if header.tell() != offset:
+            raise RuntimeError(f"Cannot truncate {path} in place")
+        npy_file.seek(0)
+        npy_file.write(header.getvalue())
+        npy_file.truncate(offset + n_rows * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+
+
+def save_epoch_store(epochs, store_dir, chunk_size=256):
+    """
+    Write epochs to an epoch store, reading them in chunks so non-preloaded epochs are never fully in memory.
+
+    Bad epochs are rejected chunk by chunk as they are read (see iter_epoch_chunks); the data file is
+    allocated for every candidate epoch and cut to the good ones at the end. The drop log is saved
+    alongside as drop_log.json.
+
+    Parameters:
+    - epochs: mne.Epochs, preloaded or not, with the aligned annotation rows as epochs.metadata.
+    - store_dir: Output directory, created if needed.
+    - chunk_size: Number of epochs read and written at a time.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    n_candidates = len(epochs.events)
+    n_channels, n_times = len(epochs.ch_names), len(epochs.times)
+
+    data_path = os.path.join(store_dir, 'data.npy')
+    data = np.lib.format.open_memmap(data_path, mode='w+', dtype=np.float32,
+                                     shape=(n_candidates, n_channels, n_times))
+    drop_log = list(epochs.drop_log)
+    events, metadata = [], []
+    n_epochs = 0
+    for chunk, chunk_data in iter_epoch_chunks(epochs, chunk_size, drop_log):
+        data[n_epochs:n_epochs + len(chunk_data)] = chunk_data
+        n_epochs += len(chunk_data)
+        events.append(chunk.events)
+        if chunk.metadata is not None:
+            metadata.append(chunk.metadata)
+    data.flush()
+    del data
+    if n_epochs < n_candidates:
+        _truncate_npy(data_path, n_epochs)
+
+    np.save(os.path.join(store_dir, 'events.npy'),
+            np.concatenate(events) if events else np.empty((0, 3), dtype=epochs.events.dtype))
+    mne.io.write_info(os.path.join(store_dir, 'info.fif'), epochs.info)
+    if epochs.metadata is not None:
+        pd.concat(metadata, ignore_index=True).to_csv(os.path.join(store_dir, 'metadata.tsv'), sep='\t', index=False)
+    with open(os.path.join(store_dir, 'drop_log.json'), 'w') as json_file:
+        json.dump([list(reasons) for reasons in drop_log], json_file)
+    with open(os.path.join(store_dir, 'store.json'), 'w') as json_file:
+        json.dump({'tmin': float(epochs.tmin), 'sfreq': float(epochs.info['sfreq']),
+                   'shape': [n_epochs, n_channels, n_times]}, json_file)
+
+
+class EpochStore:
+    """
+    Read-only view of an epoch store written by save_epoch_store.
+
+    The data array is memory-mapped, so indexing a subset of epochs reads only those epochs from disk.
+
+    Parameters:
+    - store_dir: Directory written by save_epoch_store.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'store.json')) as json_file:
+            store = json.load(json_file)
+        self.tmin = store['tmin']
+        self.data = np.load(os.path.join(store_dir, 'data.npy'), mmap_mode='r')
+        self.events = np.load(os.path.join(store_dir, 'events.npy'))
+        self.info = mne.io.read_info(os.path.join(store_dir, 'info.fif'), verbose='WARNING')
+        metadata_path = os.path.join(store_dir, 'metadata.tsv')
+        self.metadata = pd.read_csv(metadata_path, sep='\t') if os.path.exists(metadata_path) else None
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def times(self):
+        return self.tmin + np.arange(self.data.shape[-1]) / self.info['sfreq']
+
+    def _indices(self, idx):
+        if idx is None:
+            return np.arange(len(self))
+        idx = np.asarray(idx)
+        return np.flatnonzero(idx) if idx.dtype == bool else idx
+
+    def get_data(self, idx=None):
+        """
+        Load a subset of epochs into memory.
+
+        Parameters:
+        - idx: Epoch indices or boolean mask (e.g. from a metadata query); all epochs if None.
+
+        Returns:
+        - data: Array (n_selected, n_channels, n_times), float32.
+        """
+        return np.asarray(self.data[self._indices(idx)])
+
+    def to_epochs(self, idx=None):
+        """
+        Build an mne.EpochsArray from a subset of epochs, with their metadata rows.
+        """
+        idx = self._indices(idx)
+        metadata = None if self.metadata is None else self.metadata.iloc[idx].reset_index(drop=True)
+        return mne.EpochsArray(self.get_data(idx), self.info, events=self.events[idx], tmin=self.tmin,
+                               metadata=metadata, baseline=None, verbose='WARNING')
+
+    def average(self, idx=None, chunk_size=256):
+        """
+        Evoked response over a subset of epochs, summed chunk by chunk from the memory map.
+
+        Parameters:
+        - idx: Epoch indices or boolean mask; all epochs if None.
+        - chunk_size: Number of epochs read at a time.
+
+        Returns:
+        - evoked: mne.EvokedArray.
+        """
+        idx = self._indices(idx)
+        total = np.zeros(self.data.shape[1:])
+        for start in range(0, len(idx), chunk_size):
+            total += self.data[idx[start:start + chunk_size]].sum(axis=0, dtype=np.float64)
+        return mne.EvokedArray(total / max(len(idx), 1), self.info, tmin=self.tmin, nave=len(idx),
+                               verbose='WARNING')
+
+
+def concatenate_stores(store_dirs, out_dir, metadata_columns=None, chunk_size=256):
+    """
+    Concatenate epoch stores into one store, copying a chunk of epochs at a time.
+
+    Unlike mne.concatenate_epochs, no Epochs object and no in-memory copy of the combined data is made:
+    the epochs go straight from the source memory maps into the output memory map.
+
+    Parameters:
+    - store_dirs: Epoch store directories with the same channels, sampling rate and epoch window.
+    - out_dir: Output store directory, created if needed.
+    - metadata_columns: Optional list of dicts, one per store, of constant metadata columns to add
+      (e.g. {'seg': 'segment_1', 'stim': 'Jobs1'}).
+    - chunk_size: Number of epochs copied at a time.
+
+    Returns:
+    - store: EpochStore over out_dir.
+    """
+    stores = [EpochStore(store_dir) for store_dir in store_dirs]
+    if not stores:
+        raise ValueError("No epoch stores to concatenate")
+    first = stores[0]
+    for store in stores[1:]:
+        if (store.info['ch_names'] != first.info['ch_names'] or store.info['sfreq'] != first.info['sfreq']
+                or store.data.shape[1:] != first.data.shape[1:] or not np.isclose(store.tmin, first.tmin)):
+            raise ValueError(f"Epoch store {store.store_dir} does not match {first.store_dir} "
+                             f"(channels, sampling rate or epoch window)")
+
+    os.makedirs(out_dir, exist_ok=True)
+    n_epochs = sum(len(store) for store in stores)
+    data = np.lib.format.open_memmap(os.path.join(out_dir, 'data.npy'), mode='w+', dtype=np.float32,
+                                     shape=(n_epochs,) + first.data.shape[1:])
+    events, metadata = [], []
+    offset, sample_offset = 0, 0
+    for ii, store in enumerate(stores):
+        for start in range(0, len(store), chunk_size):
+            stop = min(start + chunk_size, len(store))
+            data[offset + start:offset + stop] = store.data[start:stop]
+        offset += len(store)
+
+        # Shift the event samples so they stay unique across segments; the segment's own samples
+        # are kept in the 'sample' metadata column
+        store_events = store.events.copy()
+        store_metadata = store.metadata.copy() if store.metadata is not None else pd.DataFrame(index=range(len(store)))
+        store_metadata['sample'] = store_events[:, 0]
+        store_events[:, 0] += sample_offset
+        sample_offset = store_events[:, 0].max(initial=sample_offset) + store.data.shape[-1] + 1
+        for column, value in (metadata_columns[ii] if metadata_columns is not None else {}).items():
+            store_metadata[column] = value
+        events.append(store_events)
+        metadata.append(store_metadata)
+    data.flush()
+    del data
+
+    np.save(os.path.join(out_dir, 'events.npy'), np.concatenate(events))
+    mne.io.write_info(os.path.join(out_dir, 'info.fif'), first.info)
+    pd.concat(metadata, ignore_index=True).to_csv(os.path.join(out_dir, 'metadata.tsv'), sep='\t', index=False)
+    with open(os.path.join(out_dir, 'store.json'), 'w') as json_file:
+        json.dump({'tmin': float(first.tmin), 'sfreq': float(first.info['sfreq']),
+                   'shape': [n_epochs] + list(first.data.shape[1:]),
+                   'sources': [os.path.abspath(store.store_dir) for store in stores]}, json_file)
+    return EpochStore(out_dir)
@@ -0,0 +1,104 @@
+# Streaming evoked responses: running mean and sum of squares per channel x time (Welford),
+# optionally split by annotation metadata columns, without holding the full epoch tensor.
+
+import numpy as np
+import mne
+from epoch_store import iter_epoch_chunks
+
+
+class EvokedAccumulator:
+    """
+    Running evoked mean and variance, updated one chunk of epochs at a time.
+
+    Chunks are merged with the parallel form of Welford's algorithm, so the result does not depend
+    on the chunk size and stays numerically stable over thousands of epochs.
+
+    Parameters:
+    - info: mne.Info of the epochs.
+    - tmin: Start time of the epochs in seconds.
+    - by: Metadata column name or list of names to split conditions by, or None.
+    """
+
+    def __init__(self, info, tmin, by=None):
+        self.info = info
+        self.tmin = tmin
+        self.by = [by] if isinstance(by, str) else by
+        # Reasons for every dropped epoch, filled in by accumulate_evoked
+        self.drop_log = ()
+        # condition -> [n, mean, M2]; the key None holds all epochs
+        self._stats = {}
+
+    def _merge(self, key, data):
+        n_b = len(data)
+        mean_b = data.mean(axis=0, dtype=np.float64)
+        m2_b = ((data - mean_b) ** 2).sum(axis=0)
+        if key not in self._stats:
+            self._stats[key] = [n_b, mean_b, m2_b]
+            return
+        n_a, mean_a, m2_a = self._stats[key]
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        self._stats[key] = [n, mean_a + delta * (n_b / n), m2_a + m2_b + delta ** 2 * (n_a * n_b / n)]
+
+    def update(self, data, metadata=None):
+        """
+        Add a chunk of epochs.
+
+        Parameters:
+        - data: Array (n_chunk, n_channels, n_times).
+        - metadata: The chunk's metadata rows (DataFrame), required when splitting by columns.
+        """
+        if len(data) == 0:
+            return
+        self._merge(None, data)
+        if self.by:
+            keys = metadata[self.by].astype(str).agg('/'.join, axis=1).values
+            for key in np.unique(keys):
+                self._merge(key, data[keys == key])
+
+    @property
+    def conditions(self):
+        return [key for key in self._stats if key is not None]
+
+    def nave(self, condition=None):
+        return self._stats[condition][0] if condition in self._stats else 0
+
+    def evoked(self, condition=None):
+        """
+        Evoked mean for one condition ('value' or 'value1/value2' for several columns), or all epochs.
+        """
+        n, mean, _ = self._stats[condition]
+        return mne.EvokedArray(mean, self.info, tmin=self.tmin, nave=n,
+                               comment=str(condition) if condition is not None else '', verbose='WARNING')
+
+    def standard_error(self, condition=None):
+        """
+        Standard error of the mean for one condition, or all epochs, as an EvokedArray.
+        """
+        n, _, m2 = self._stats[condition]
+        sem = np.sqrt(m2 / max(n - 1, 1) / n)
+        comment = f'{condition} SE' if condition is not None else 'SE'
+        return mne.EvokedArray(sem, self.info, tmin=self.tmin, nave=n, comment=comment, verbose='WARNING')
+
+
+def accumulate_evoked(epochs, by=None, chunk_size=256):
+    """
+    Compute evoked means and standard errors in one pass over the continuous data.
+
+    Bad epochs are rejected chunk by chunk as they are read, so every epoch is read once.
+
+    Parameters:
+    - epochs: mne.Epochs, preferably with preload=False so epochs are read chunk by chunk.
+    - by: Metadata column name or list of names to split conditions by, or None.
+    - chunk_size: Number of epochs read at a time.
+
+    Returns:
+    - accumulator: EvokedAccumulator with evoked(condition) and standard_error(condition), and the
+      drop log of the epochs in accumulator.drop_log.
+    """
+    accumulator = EvokedAccumulator(epochs.info, epochs.tmin, by=by)
+    drop_log = list(epochs.drop_log)
+    for chunk, data in iter_epoch_chunks(epochs, chunk_size, drop_log):
+        accumulator.update(data, chunk.metadata if by is not None else None)
+    accumulator.drop_log = tuple(drop_log)
+    return accumulator
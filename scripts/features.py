@@ -0,0 +1,159 @@
+# Windowed decoding features: instead of one raw sample per classifier, the epochs are cut into
+# overlapping N-ms windows (strided views of the epoch array, no copy) and each window is reduced to
+# its mean, the concatenation of its samples, or its band power. The decoders then fit tens of
+# windows instead of hundreds of samples, each averaging over several samples of noise.
+# Features are written next to the epoch store they come from and reopened memory-mapped.
+
+import os
+import json
+import numpy as np
+
+KINDS = ('mean', 'concat', 'bandpower')
+# Bands below the 30 Hz low-pass of the phoneme epochs
+BANDS = {'theta': (4.0, 8.0), 'alpha': (8.0, 13.0), 'beta': (13.0, 30.0)}
+
+
+def window_samples(sfreq, window_ms, stride_ms):
+    """
+    Convert a window length and stride in milliseconds to samples (at least one each).
+    """
+    win = max(1, int(round(window_ms * sfreq / 1000)))
+    stride = max(1, int(round(stride_ms * sfreq / 1000)))
+    return win, stride
+
+
+def window_view(X, win, stride):
+    """
+    Strided view of the windows of an epoch array, without copying (works on memory-mapped arrays).
+
+    Parameters:
+    - X: Epoch array (n_epochs, n_channels, n_times).
+    - win: Window length in samples.
+    - stride: Step between window starts in samples.
+
+    Returns:
+    - windows: View (n_epochs, n_channels, n_windows, win); trailing samples that do not fill a window are dropped.
+    """
+    if win > X.shape[-1]:
+        raise ValueError(f"Window of {win} samples is longer than the epochs ({X.shape[-1]} samples)")
+    return np.lib.stride_tricks.sliding_window_view(X, win, axis=-1)[..., ::stride, :]
+
+
+def window_times(times, win, stride):
+    """
+    Centre time of every window of window_view.
+    """
+    return np.lib.stride_tricks.sliding_window_view(times, win)[::stride].mean(axis=-1)
+
+
+def n_features(n_channels, kind, win=1, bands=None):
+    """
+    Number of features per window: one per channel for 'mean', one per channel and sample for
+    'concat', one per channel and band for 'bandpower'.
+    """
+    if kind == 'mean':
+        return n_channels
+    if kind == 'concat':
+        return n_channels * win
+    if kind == 'bandpower':
+        return n_channels * len(BANDS if bands is None else bands)
+    raise ValueError(f"kind should be one of {KINDS}, got {kind!r}")
+
+
+def _band_masks(win, sfreq, bands):
+    freqs = np.fft.rfftfreq(win, 1 / sfreq)
+    masks = []
+    for name, (low, high) in bands.items():
+        mask = (freqs >= low) & (freqs < high)
+        if not mask.any():
+            raise ValueError(f"Band {name} ({low}-{high} Hz) has no frequency bin in a {win}-sample window "
+                             f"(resolution {sfreq / win:.1f} Hz); use a longer window")
+        masks.append(mask)
+    return np.array(masks, dtype=float)
+
+
+def window_features(windows, kind, sfreq=None, bands=None):
+    """
+    Reduce windows to features.
+
+    Parameters:
+    - windows: Windows (n_epochs, n_channels, n_windows, win), e.g. from window_view.
+    - kind: 'mean' (window average), 'concat' (all samples of the window) or 'bandpower'
+      (log10 mean power of the Hann-tapered window in each band).
+    - sfreq: Sampling rate in Hz, for 'bandpower'.
+    - bands: Dict {name: (low, high)} in Hz for 'bandpower' (default BANDS).
+
+    Returns:
+    - features: Array (n_epochs, n_features, n_windows), features ordered channel by channel.
+    """
+    n_epochs, n_channels, n_windows, win = windows.shape
+    if kind == 'mean':
+        return windows.mean(axis=-1, dtype=np.float64)
+    if kind == 'concat':
+        return windows.transpose(0, 1, 3, 2).reshape(n_epochs, n_channels * win, n_windows)
+    if kind == 'bandpower':
+        masks = _band_masks(win, sfreq, BANDS if bands is None else bands)
+        power = np.abs(np.fft.rfft(windows * np.hanning(win), axis=-1)) ** 2
+        band_power = power @ (masks / masks.sum(axis=1, keepdims=True)).T  # (n_epochs, n_channels, n_windows, n_bands)
+        return np.log10(band_power + np.finfo(float).tiny).transpose(0, 1, 3, 2).reshape(n_epochs, -1, n_windows)
+    raise ValueError(f"kind should be one of {KINDS}, got {kind!r}")
+
+
+def feature_path(store_dir, kind, window_ms, stride_ms):
+    """
+    Features of an epoch store, e.g. .../phoneme-epo-pilot-3-Jobs1-segment_1/features/mean-w50ms-s20ms.npy.
+    """
+    return os.path.join(store_dir, 'features', f'{kind}-w{window_ms:g}ms-s{stride_ms:g}ms.npy')
+
+
+def load_features(store, kind='mean', window_ms=50.0, stride_ms=20.0, bands=None, chunk_size=64, rebuild=False):
+    """
+    Windowed features of an epoch store, computed once and cached next to the epochs.
+
+    The epochs are read from the memory map a chunk at a time, windowed with strided views and reduced
+    into a memory-mapped float32 feature array, so neither the epochs nor the features are held in memory.
+    The cache is rebuilt when the epoch store is rewritten.
+
+    Parameters:
+    - store: EpochStore.
+    - kind: 'mean', 'concat' or 'bandpower' (see window_features).
+    - window_ms: Window length in milliseconds.
+    - stride_ms: Step between windows in milliseconds.
+    - bands: Dict {name: (low, high)} in Hz for 'bandpower' (default BANDS).
+    - chunk_size: Number of epochs processed at a time.
+    - rebuild: Whether to recompute the features even if they are cached.
+
+    Returns:
+    - features: Memory-mapped array (n_epochs, n_features, n_windows), float32, in place of the
+      (n_epochs, n_channels, n_times) epochs for decode_timecourse.
+    - times: Centre time of every window in seconds.
+    """
+    sfreq = store.info['sfreq']
+    win, stride = window_samples(sfreq, window_ms, stride_ms)
+    times = window_times(store.times, win, stride)
+    path = feature_path(store.store_dir, kind, window_ms, stride_ms)
+    params = {'kind': kind, 'win': win, 'stride': stride,
+              'bands': {name: list(band) for name, band in (BANDS if bands is None else bands).items()}
+              if kind == 'bandpower' else None}
+
+    params_path = path[:-len('.npy')] + '.json'
+    if not rebuild and os.path.exists(params_path):
+        with open(params_path) as json_file:
+            cached = json.load(json_file)
+        if cached == params and os.path.getmtime(params_path) >= os.path.getmtime(os.path.join(store.store_dir, 'store.json')):
+            return np.load(path, mmap_mode='r'), times
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    n_epochs, n_channels = store.data.shape[:2]
+    shape = (int(n_epochs), n_features(int(n_channels), kind, win, bands), len(times))
+    features = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+    windows = window_view(store.data, win, stride)
+    for start in range(0, n_epochs, chunk_size):
+        idx = slice(start, min(start + chunk_size, n_epochs))
+        features[idx] = window_features(windows[idx], kind, sfreq, bands)
+    features.flush()
+    del features
+    # Parameters written last, so an interrupted run is recomputed
+    with open(params_path, 'w') as json_file:
+        json.dump(params, json_file)
+    return np.load(path, mmap_mode='r'), times
@@ -0,0 +1,173 @@
+# Fused notch + band-pass filtering: one zero-phase FIR kernel per (sfreq, band, notch) configuration,
+# applied with FFT overlap-add to blocks of channels in parallel threads, so the continuous data is
+# read and written once instead of once per filter. filter_to_file does the same out of core, in
+# time chunks, for recordings that do not fit in memory.
+
+import os
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import mne
+from scipy.signal import oaconvolve
+
+
+@functools.lru_cache(maxsize=None)
+def design_kernel(sfreq, l_freq=None, h_freq=None, notch_freq=None, notch_width=None, trans_bandwidth=1.0):
+    """
+    Design the combined notch + band-pass FIR kernel, with the same designs as raw.notch_filter and
+    raw.filter (firwin, zero phase). Kernels are cached, so each configuration is designed once.
+
+    Parameters:
+    - sfreq: Sampling rate in Hz.
+    - l_freq, h_freq: Band-pass edges in Hz (None for no high-pass / low-pass).
+    - notch_freq: Notch frequency in Hz, or None. The notch is left out when it lies in the
+      stop band of the low-pass, where it has no effect.
+    - notch_width: Width of the notch in Hz (default notch_freq / 200, as in raw.notch_filter).
+    - trans_bandwidth: Transition bandwidth of the notch in Hz.
+
+    Returns:
+    - kernel: Odd-length, symmetric FIR kernel (read-only).
+    """
+    kernels = []
+    if l_freq is not None or h_freq is not None:
+        kernels.append(mne.filter.create_filter(None, sfreq, l_freq, h_freq, method='fir', fir_design='firwin',
+                                                phase='zero', verbose='WARNING'))
+    width = notch_freq / 200.0 if notch_width is None and notch_freq is not None else notch_width
+    half = trans_bandwidth / 2.0
+    # Stop band of the low-pass with the default ('auto') transition bandwidth of create_filter
+    stop_band = None if h_freq is None else h_freq + min(max(0.25 * h_freq, 2.0), sfreq / 2.0 - h_freq)
+    if notch_freq is not None and (stop_band is None or notch_freq - width / 2.0 - half < stop_band):
+        # A band-stop filter is a create_filter call with l_freq above h_freq
+        kernels.append(mne.filter.create_filter(None, sfreq, notch_freq + width / 2.0 + half,
+                                                notch_freq - width / 2.0 - half, l_trans_bandwidth=half,
+                                                h_trans_bandwidth=half, method='fir', fir_design='firwin',
+                                                phase='zero', verbose='WARNING'))
+    kernel = functools.reduce(np.convolve, kernels, np.ones(1))
+    kernel.flags.writeable = False
+    return kernel
+
+
+def _filter_block(data, kernel):
+    # Reflect the edges so the filter does not ring at the start and end of the recording
+    pad = min(len(kernel) // 2, data.shape[1] - 1)
+    padded = np.pad(data, ((0, 0), (pad, pad)), mode='reflect')
+    return oaconvolve(padded, kernel[np.newaxis], mode='same', axes=1)[:, pad:pad + data.shape[1]]
+
+
+def fused_filter(raw, l_freq=None, h_freq=None, notch_freq=None, picks=None, block_size=16, n_jobs=4):
+    """
+    Notch and band-pass filter a preloaded Raw in place in a single pass.
+
+    Equivalent to raw.notch_filter(notch_freq) followed by raw.filter(l_freq, h_freq), up to the
+    handling of the first and last few seconds.
+
+    Parameters:
+    - raw: Preloaded Raw, filtered in place.
+    - l_freq, h_freq: Band-pass edges in Hz (None for no high-pass / low-pass).
+    - notch_freq: Notch frequency in Hz, or None.
+    - picks: Channel names to filter (default: all EEG and EOG channels, bad channels included).
+    - block_size: Number of channels filtered at a time.
+    - n_jobs: Number of threads (the FFTs release the GIL).
+
+    Returns:
+    - raw: The same Raw.
+    """
+    kernel = design_kernel(float(raw.info['sfreq']), l_freq, h_freq, notch_freq)
+    if picks is None:
+        picks = mne.pick_types(raw.info, eeg=True, eog=True, exclude=[])
+    else:
+        picks = mne.pick_channels(raw.ch_names, picks, ordered=True)
+    blocks = [picks[start:start + block_size] for start in range(0, len(picks), block_size)]
+
+    def filter_block(block):
+        raw._data[block] = _filter_block(raw._data[block], kernel)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(filter_block, blocks))
+
+    with raw.info._unlock():
+        if l_freq is not None:
+            raw.info['highpass'] = float(l_freq)
+        if h_freq is not None:
+            raw.info['lowpass'] = float(h_freq)
+    return raw
+
+
+def filter_chunks(raw, out, l_freq=None, h_freq=None, notch_freq=None, picks=None, chunk_sec=10.0):
+    """
+    Fused notch + band-pass filter a non-preloaded Raw chunk by chunk into an output array.
+
+    Each chunk is read with a margin of half the kernel length on both sides, so the result equals
+    filtering the whole recording at once (edges reflected as in fused_filter); only one chunk plus
+    its margins is in memory at a time. Channels that are not picked are copied unfiltered.
+
+    Parameters:
+    - raw: Raw, usually opened with preload=False (read_raw_fif or read_raw_egi).
+    - out: Array (n_channels, n_times) to write to, e.g. a memory-mapped .npy file.
+    - l_freq, h_freq, notch_freq: As in fused_filter.
+    - picks: Channel names to filter (default: all EEG and EOG channels, bad channels included).
+    - chunk_sec: Chunk length in seconds, excluding the margins.
+    """
+    kernel = design_kernel(float(raw.info['sfreq']), l_freq, h_freq, notch_freq)
+    if picks is None:
+        picks = mne.pick_types(raw.info, eeg=True, eog=True, exclude=[])
+    else:
+        picks = mne.pick_channels(raw.ch_names, picks, ordered=True)
+    margin = len(kernel) // 2
+    chunk = int(np.ceil(chunk_sec * raw.info['sfreq']))
+    n_times = raw.n_times
+
+    for start in range(0, n_times, chunk):
+        stop = min(start + chunk, n_times)
+        read_start, read_stop = max(start - margin, 0), min(stop + margin, n_times)
+        data = raw.get_data(start=read_start, stop=read_stop)
+        out[:, start:stop] = data[:, start - read_start:stop - read_start]
+
+        # Reflect at the ends of the recording, like the whole-recording filter
+        padded = np.pad(data[picks], ((0, 0), (margin - (start - read_start), margin - (read_stop - stop))),
+                        mode='reflect')
+        out[picks, start:stop] = oaconvolve(padded, kernel[np.newaxis], mode='valid', axes=1)
+
+
+def filter_to_file(raw, out_path, l_freq=None, h_freq=None, notch_freq=None, picks=None, chunk_sec=10.0):
+    """
+    Out-of-core fused notch + band-pass filter of a recording that does not fit in memory.
+
+    Parameters:
+    - raw: Raw, usually opened with preload=False (read_raw_fif or read_raw_egi).
+    - out_path: Output path. A '.npy' file is kept as a memory-mapped array; a '.fif' file is
+      written through a temporary memory-mapped buffer in the same directory.
+    - l_freq, h_freq, notch_freq, picks, chunk_sec: As in filter_chunks.
+
+    Returns:
+    - raw: The filtered recording, memory-mapped (for '.npy') or opened with preload=False (for '.fif').
+    """
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    os.makedirs(out_dir, exist_ok=True)
+    shape = (raw.info['nchan'], int(raw.n_times))
+    filtered_info = raw.info.copy()
+    with filtered_info._unlock():
+        if l_freq is not None:
+            filtered_info['highpass'] = float(l_freq)
+        if h_freq is not None:
+            filtered_info['lowpass'] = float(h_freq)
+
+    if out_path.endswith('.npy'):
+        buffer = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float64, shape=shape)
+        filter_chunks(raw, buffer, l_freq, h_freq, notch_freq, picks, chunk_sec)
+        buffer.flush()
+        # RawArray keeps the memory-mapped buffer as its data instead of copying it
+        filtered_raw = mne.io.RawArray(buffer, filtered_info, first_samp=raw.first_samp, verbose='WARNING')
+        filtered_raw.set_annotations(raw.annotations)
+        return filtered_raw
+
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        buffer = np.lib.format.open_memmap(os.path.join(tmp_dir, 'filtered.npy'), mode='w+', dtype=np.float64,
+                                           shape=shape)
+        filter_chunks(raw, buffer, l_freq, h_freq, notch_freq, picks, chunk_sec)
+        filtered_raw = mne.io.RawArray(buffer, filtered_info, first_samp=raw.first_samp, verbose='WARNING')
+        filtered_raw.set_annotations(raw.annotations)
+        filtered_raw.save(out_path, buffer_size_sec=chunk_sec, overwrite=True)
+        del filtered_raw, buffer
+    return mne.io.read_raw_fif(out_path, preload=False, verbose='WARNING')
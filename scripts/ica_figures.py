@@ -0,0 +1,152 @@
+# Headless ICA figure rendering in background worker processes.
+# Component topomaps and downsampled source traces are rendered with the Agg backend while the main
+# process keeps preprocessing, and figures are skipped when neither the ICA nor its sources changed.
+# Workers are spawned (forking is unsafe on macOS and once BLAS or matplotlib threads are running),
+# so a calling script needs an `if __name__ == '__main__':` guard, or background=False.
+
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from cache import ica_fingerprint
+
+_executor = None
+_futures = []
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _get_executor(n_workers=2):
+    global _executor
+    if _executor is None:
+        # Spawned workers import this module and run _render; they do not inherit the caller's threads
+        _executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker)
+    return _executor
+
+
+def downsample_sources(sources, sfreq, max_points=2000):
+    """
+    Min/max envelope of the source traces with at most max_points samples per trace.
+
+    Keeping the minimum and maximum of each bin preserves blinks and other spikes that plain
+    decimation would drop.
+
+    Parameters:
+    - sources: Array (n_components, n_times).
+    - sfreq: Sampling rate in Hz.
+    - max_points: Number of samples kept per trace.
+
+    Returns:
+    - times: Array (n_points,) in seconds.
+    - traces: Array (n_components, n_points).
+    """
+    n_bins = max_points // 2
+    bin_size = int(np.ceil(sources.shape[1] / n_bins))
+    if bin_size <= 1:
+        return np.arange(sources.shape[1]) / sfreq, sources
+    n_bins = sources.shape[1] // bin_size
+    binned = sources[:, :n_bins * bin_size].reshape(len(sources), n_bins, bin_size)
+    traces = np.stack([binned.min(axis=2), binned.max(axis=2)], axis=2).reshape(len(sources), -1)
+    times = np.repeat(np.arange(n_bins) * bin_size / sfreq, 2)
+    return times, traces
+
+
+def _render(ica, times, traces, components_path, sources_path, manifest_path, fingerprint):
+    import matplotlib.pyplot as plt
+
+    ica_components_fig = ica.plot_components(show=False)
+    # plot_components returns one figure per 20 components
+    for idx, fig in enumerate(ica_components_fig if isinstance(ica_components_fig, list) else [ica_components_fig]):
+        fig.savefig(components_path if idx == 0 else components_path.replace('.jpg', f'_{idx}.jpg'))
+        plt.close(fig)
+
+    # Stacked source traces, one row per component, scaled to a common spacing
+    n_components = len(traces)
+    scale = np.nanmax(np.abs(traces), axis=1, keepdims=True)
+    scale[scale == 0] = 1
+    fig, ax = plt.subplots(figsize=(14, max(4, 0.5 * n_components)))
+    ax.plot(times, (0.45 * traces / scale + np.arange(n_components)[::-1, np.newaxis]).T, color='k', linewidth=0.5)
+    ax.set_yticks(np.arange(n_components)[::-1])
+    ax.set_yticklabels([f'ICA{idx:03d}' for idx in range(n_components)])
+    for idx in ica.exclude:
+        ax.get_yticklabels()[int(idx)].set_color('r')
+    ax.set_xlim(times[0], times[-1])
+    ax.set_xlabel('Time (s)')
+    fig.tight_layout()
+    fig.savefig(sources_path)
+    plt.close(fig)
+
+    # Written last, so an interrupted render is redone next time
+    with open(manifest_path, 'w') as json_file:
+        json.dump({'fingerprint': fingerprint}, json_file)
+
+
+def render_ica_figures(ica, raw, fig_dir, prefix, suffix='', max_points=2000, n_workers=2, background=True):
+    """
+    Save the component topomaps and source traces of an ICA in a background process.
+
+    The background workers are spawned, and spawning re-imports the calling script, so scripts
+    calling this need an `if __name__ == '__main__':` guard; otherwise pass background=False.
+
+    Figures are written to {fig_dir}/{prefix}_components{suffix}.jpg and {prefix}_sources{suffix}.jpg.
+    Nothing is rendered if the figures were already made for the same ICA (unmixing and exclusions)
+    and sources.
+
+    Parameters:
+    - ica: Fitted ICA.
+    - raw: Raw whose sources are plotted.
+    - fig_dir: Output directory, created if needed.
+    - prefix: File name prefix, e.g. f'{sub}_{seg}_{stim}'.
+    - suffix: File name suffix, e.g. '_before'.
+    - max_points: Number of samples kept per source trace.
+    - n_workers: Size of the rendering pool (created on first use and shared by later calls).
+    - background: Whether to render in the pool; if False the figures are rendered in this process
+      (off screen, nothing is shown) before returning.
+
+    Returns:
+    - future: Future of the render, or None if the figures are up to date or were rendered in this process.
+    """
+    os.makedirs(fig_dir, exist_ok=True)
+    times, traces = downsample_sources(ica.get_sources(raw).get_data(), raw.info['sfreq'], max_points)
+
+    digest = hashlib.sha1(json.dumps(ica_fingerprint(ica), sort_keys=True).encode())
+    digest.update(np.ascontiguousarray(traces, dtype=np.float32).tobytes())
+    fingerprint = digest.hexdigest()
+
+    manifest_path = os.path.join(fig_dir, f'{prefix}_figures{suffix}.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as json_file:
+            if json.load(json_file)['fingerprint'] == fingerprint:
+                print(f"ICA figures for {prefix}{suffix} are up to date")
+                return None
+
+    render_args = (ica, times, traces, os.path.join(fig_dir, f'{prefix}_components{suffix}.jpg'),
+                   os.path.join(fig_dir, f'{prefix}_sources{suffix}.jpg'), manifest_path, fingerprint)
+    if not background:
+        _render(*render_args)
+        return None
+    future = _get_executor(n_workers).submit(_render, *render_args)
+    _futures.append(future)
+    return future
+
+
+def wait_for_figures():
+    """
+    Block until every submitted figure is saved, re-raising the first rendering error, and shut the
+    rendering pool down (the next render_ica_figures call starts a new one).
+    """
+    global _executor
+    try:
+        while _futures:
+            _futures.pop(0).result()
+    finally:
+        # Worker processes left running would keep a batch job's process from exiting
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
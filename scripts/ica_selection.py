@@ -0,0 +1,123 @@
+# Automatic ICA component scoring, so the ICA step runs without plot_sources and a hand-typed ica.exclude.
+# Components are scored by their correlation with the frontal/EOG electrodes (blinks and eye movements),
+# the slope of their log-log spectrum (muscle) and their kurtosis (transient artifacts).
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from scipy.signal import welch
+from scipy.stats import kurtosis
+
+# Frontal electrodes above and below the eyes on the 128-channel EGI net
+FRONTAL_CHANNELS = ['E8', 'E14', 'E21', 'E25', 'E126', 'E127']
+
+
+def score_components(ica, raw, ref_channels=FRONTAL_CHANNELS, fmin=2.0, fmax=40.0):
+    """
+    Score every ICA component for ocular, muscle and transient artifacts.
+
+    Parameters:
+    - ica: Fitted mne.preprocessing.ICA.
+    - raw: Raw the ICA was fitted on (preloaded).
+    - ref_channels: Channels whose correlation with the sources indicates eye artifacts. Bad
+      channels are still used, since frontal channels are often marked bad for the fit.
+    - fmin, fmax: Frequency range in Hz of the spectral slope fit.
+
+    Returns:
+    - scores: DataFrame with one row per component, sorted by eog_corr (highest first): component,
+      eog_corr (largest absolute correlation with a reference channel), eog_channel, spectral_slope
+      (of log10 power vs log10 frequency) and kurtosis (excess).
+    """
+    sources = ica.get_sources(raw).get_data()
+    ref_channels = [ch for ch in ref_channels if ch in raw.ch_names]
+    ref_data = raw.get_data(picks=ref_channels)
+
+    # Correlations of the sources with the reference channels only, via standardized dot products
+    def standardize(data):
+        centred = data - data.mean(axis=1, keepdims=True)
+        norm = np.linalg.norm(centred, axis=1, keepdims=True)
+        return np.divide(centred, norm, out=np.zeros_like(centred), where=norm > 0)
+    corr = np.abs(standardize(sources) @ standardize(ref_data).T) if ref_channels else np.zeros((len(sources), 1))
+
+    sfreq = raw.info['sfreq']
+    freqs, psd = welch(sources, fs=sfreq, nperseg=min(sources.shape[1], int(2 * sfreq)))
+    in_band = (freqs >= fmin) & (freqs <= min(fmax, sfreq / 2))
+    slope, _ = np.polyfit(np.log10(freqs[in_band]), np.log10(psd[:, in_band]).T, 1)
+
+    scores = pd.DataFrame({
+        'component': np.arange(len(sources)),
+        'eog_corr': corr.max(axis=1),
+        'eog_channel': [ref_channels[idx] for idx in corr.argmax(axis=1)] if ref_channels else None,
+        'spectral_slope': slope,
+        'kurtosis': kurtosis(sources, axis=1),
+    })
+    return scores.sort_values('eog_corr', ascending=False).reset_index(drop=True)
+
+
+def propose_exclusions(scores, corr_threshold=0.6, slope_threshold=0.0, kurtosis_threshold=10.0,
+                       max_components=None):
+    """
+    Propose components to exclude from their scores.
+
+    A component is proposed when its eog_corr exceeds corr_threshold (eye), its spectral slope is
+    flatter than slope_threshold (muscle; brain sources fall off roughly as 1/f), or its kurtosis
+    exceeds kurtosis_threshold (blinks and other transients).
+
+    Parameters:
+    - scores: Output of score_components.
+    - corr_threshold, slope_threshold, kurtosis_threshold: Criteria described above.
+    - max_components: Optional cap on the number of excluded components, keeping the highest eog_corr.
+
+    Returns:
+    - exclude: Sorted list of component indices.
+    - scores: The scores with a 'reason' column ('' for kept components).
+    """
+    scores = scores.copy()
+    reasons = pd.DataFrame({
+        'eog': scores['eog_corr'] > corr_threshold,
+        'muscle': scores['spectral_slope'] > slope_threshold,
+        'kurtosis': scores['kurtosis'] > kurtosis_threshold,
+    })
+    scores['reason'] = reasons.apply(lambda row: '+'.join(reasons.columns[row.values]), axis=1)
+    flagged = scores[scores['reason'] != '']
+    if max_components is not None:
+        flagged = flagged.head(max_components)
+    return sorted(int(idx) for idx in flagged['component']), scores
+
+
+def select_components(ica, raw, **kwargs):
+    """
+    Score the components, set ica.exclude to the proposed components and return the scores.
+
+    Keyword arguments are passed to propose_exclusions.
+    """
+    ica.exclude, scores = propose_exclusions(score_components(ica, raw), **kwargs)
+    print(f"Automatically excluded ICA components: {ica.exclude}")
+    return scores
+
+
+def save_excluded_components(base_path, sub, seg, stim, exclude, scores=None):
+    """
+    Write the excluded components to derivatives/individual/ica_excluded_components, in the same
+    format as the manually selected components, plus the component scores when given.
+
+    Returns:
+    - json_filepath: Path of the written JSON file.
+    """
+    excluded_components = {
+        'subject': sub,
+        'segment': seg,
+        'stimulus': stim,
+        'excluded_components': [int(idx) for idx in exclude],
+    }
+    if scores is not None:
+        excluded_components['selection'] = 'automatic'
+        excluded_components['component_scores'] = json.loads(scores.to_json(orient='records'))
+    json_dir = os.path.join(base_path, 'derivatives', 'individual', 'ica_excluded_components')
+    os.makedirs(json_dir, exist_ok=True)
+    json_filename = f'{sub}_{seg}_{stim}_excluded_components.json'
+    json_filepath = os.path.join(json_dir, json_filename)
+    with open(json_filepath, 'w') as json_file:
+        json.dump(excluded_components, json_file)
+    return json_filepath
@@ -6,6 +6,11 @@ import matplotlib.pyplot as plt
 from mne.preprocessing import ICA
 import json
 from scipy.stats import zscore
+from epoch_store import save_epoch_store, EpochStore
+from decoding import make_folds, decode_timecourse
+from features import load_features
+from filtering import fused_filter
+from annotation_index import load_annotation_index
 
 # Set parameters for fif path
 sub = 'pilot-3'
@@ -14,8 +19,6 @@ seg = 'segment_1'
 comp = 'ica'
 
 base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
-word_path = f'{base_path}/annotations/words/tsv/{stim}-words.tsv'
-phoneme_path = f'{base_path}/annotations/phonemes/tsv/{stim}-phonemes.tsv'
 fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
 
 # Load the data in MNE
@@ -24,11 +27,8 @@ raw = mne.io.read_raw_fif(fif_path, preload=True)
 # Get sampling rate
 sampling_rate = raw.info['sfreq']
 
-# Set Notch filter
-raw.notch_filter(60)
-
-# Set filter
-raw.filter(l_freq=1.0, h_freq=15.0)
+# Notch (60 Hz) and band-pass (1-15 Hz) filter in a single pass
+fused_filter(raw, l_freq=1.0, h_freq=15.0, notch_freq=60)
 
 # For visualizing raw data in terminal
 # raw.plot()
@@ -56,14 +56,11 @@ ica.exclude = components_to_exclude
 ica.apply(raw_car)
 
 
-# Load metadata for words from annotations
-word_info = pd.read_csv(word_path, delimiter='\t', encoding='utf-8')
+# Word events and aligned metadata from the annotation index (rounded onsets, coincident onsets dropped)
+word_events, word_info = load_annotation_index(base_path).events('words', stim, sampling_rate)
 
 # Create word epochs
-word_onsets = (word_info['Start'].values * sampling_rate).astype(int)
-word_events = np.column_stack((word_onsets, np.zeros_like(word_onsets), np.ones_like(word_onsets)))
-word_epochs = mne.Epochs(raw_car, word_events, tmin=-3, tmax=3, baseline=None, reject=None, flat=None)
-word_epochs.metadata = word_info  # Assign metadata to word epochs
+word_epochs = mne.Epochs(raw_car, word_events, tmin=-3, tmax=3, baseline=None, reject=None, flat=None, metadata=word_info)
 
 word_evoked = word_epochs.average()
 
@@ -80,20 +77,21 @@ fig = word_evoked.plot_joint()
 fig.savefig(evoked_fig_path, format='jpg', dpi=300)
 
 
-phoneme_info = pd.read_csv(phoneme_path, delimiter='\t', encoding='utf-8')
+# Phoneme events and aligned metadata from the annotation index
+phoneme_events, phoneme_info = load_annotation_index(base_path).events('phonemes', stim, sampling_rate)
 
-phoneme_onsets = (phoneme_info['Start'].values * sampling_rate).astype(int)
-phoneme_events = np.column_stack((phoneme_onsets, np.zeros_like(phoneme_onsets), np.ones_like(phoneme_onsets)))
-min_len = min(len(phoneme_events), len(phoneme_info))
-phoneme_events = phoneme_events[:min_len]
-phoneme_info = phoneme_info[:min_len]
-phoneme_epochs = mne.Epochs(raw_car, phoneme_events, tmin=-3, tmax=3, preload=True, baseline=None,
-                            event_repeated='drop')
+# The -3 to 3 s window does not fit in memory with preload=True, so epochs are read lazily in chunks,
+# decimated on the fly (the data is already low-passed at 15 Hz) and streamed into an epoch store
+decim = 5
+phoneme_epochs = mne.Epochs(raw_car, phoneme_events, tmin=-3, tmax=3, preload=False, baseline=None,
+                            metadata=phoneme_info, decim=decim)
 
-# Align metadata with epochs
-phoneme_epochs.metadata = phoneme_info.iloc[phoneme_epochs.selection]
+phoneme_store_dir = os.path.join(base_path, 'derivatives', 'individual', 'phoneme_epochs', f'phoneme-epo-{sub}-{stim}-{seg}-long')
+save_epoch_store(phoneme_epochs, phoneme_store_dir)
+phoneme_store = EpochStore(phoneme_store_dir)
 
-phoneme_evoked = phoneme_epochs.average()
+# Average the memory-mapped epochs chunk by chunk
+phoneme_evoked = phoneme_store.average()
 
 # Define the path for saving the evoked figure
 evoked_fig_name = f'phoneme-evoked-{sub}-{stim}_{seg}.jpg'
@@ -106,33 +104,16 @@ fig = phoneme_evoked.plot_joint()
 # Save the figure directly from the Figure object
 fig.savefig(evoked_fig_path, format='jpg', dpi=300)
 
-from sklearn.preprocessing import StandardScaler
-from sklearn.linear_model import LogisticRegression
-from sklearn.pipeline import make_pipeline
-from sklearn.model_selection import cross_val_score, KFold
-
-# Decoding whether a phoneme is voiced or unvoiced using logistic regression
-clf = make_pipeline(StandardScaler(), LogisticRegression(solver='liblinear'))
-cv = KFold(5, shuffle=True)
-
-y = (phoneme_epochs.metadata['manner'] == 'f').astype(int).values
-X = phoneme_epochs.get_data()  # Get the epoch data
-
-accuracy_scores = []
+# Decoding whether a phoneme is a fricative on the mean of 100 ms windows every 50 ms (cached next to
+# the epoch store) instead of every sample, read from the memory map a chunk of windows at a time
+y = (phoneme_store.metadata['manner'] == 'f').astype(int).values
+X, times = load_features(phoneme_store, 'mean', window_ms=100.0, stride_ms=50.0)
 
 # Perform decoding across time points
-for tt in range(X.shape[2]):
-    print(f'Time point {tt}')
-    X_ = X[:, :, tt]
-    scores = cross_val_score(clf, X_, y, scoring='roc_auc', cv=cv, n_jobs=-1)
-    accuracy_scores.append(scores.mean())
-
-# Convert accuracy scores to numpy array for easier indexing
-accuracy_scores = np.array(accuracy_scores)
+accuracy_scores = decode_timecourse(X, y, folds=make_folds(len(X), n_splits=5))
 
 # Plot the decoding results
 plt.figure(figsize=(10, 5))
-times = phoneme_epochs.times
 plt.plot(times, accuracy_scores, label='AUC Score')
 plt.axhline(0.5, color='r', linestyle='--', label='Chance Level')
 plt.xlabel('Time (s)')
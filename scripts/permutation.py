@@ -0,0 +1,282 @@
+# Permutation tests and temporal cluster statistics for decoding time courses.
+# With the closed-form decoders ('ridge', 'lda') the decision function of a fold is linear in the
+# training labels: decision = X_test W c(y), with W = M^-1 X_train' a label-independent operator, up
+# to a constant per target that does not change the AUC. The (n_channels, n_train) operator of every
+# fold and timepoint is factorized once and stored in a work directory, so a whole block of shuffled
+# labellings costs two small matrix products (W c, then X_test times the resulting coefficients).
+# Blocks are spread over a process pool and the null distribution is checkpointed after every batch,
+# so an interrupted test resumes where it stopped.
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from decoding import make_folds, fold_scalers, roc_auc, _chunks
+from precision import get_dtype
+
+
+def _weights_chunk(X, train, mean, scale, times, method, alpha, weights_path):
+    # Label-independent operator W = M^-1 X_train' of the closed-form decoders for one fold and time
+    # chunk, written into the fold's memory-mapped weights array
+    X_train = np.ascontiguousarray(((X[train, :, times] - mean) / scale).transpose(2, 0, 1),
+                                   dtype=np.float64)  # (n_times, n_train, n_channels)
+    n_train, n_channels = X_train.shape[1:]
+
+    if method == 'ridge' and n_train < n_channels:
+        # Dual form: X_train' (X_train X_train' + aI)^-1, the Gram matrix being symmetric
+        gram = X_train @ X_train.transpose(0, 2, 1) + alpha * np.eye(n_train)
+        operator = np.linalg.solve(gram, X_train).transpose(0, 2, 1)
+    else:
+        if method == 'ridge':
+            matrix = X_train.transpose(0, 2, 1) @ X_train + alpha * np.eye(n_channels)
+        else:
+            # Same shrunk total covariance as decoding._fit_closed_form
+            cov = X_train.transpose(0, 2, 1) @ X_train / n_train
+            matrix = (1 - alpha) * cov + alpha * (np.trace(cov, axis1=1, axis2=2) / n_channels)[:, None, None] * np.eye(n_channels)
+        operator = np.linalg.solve(matrix, X_train.transpose(0, 2, 1))
+
+    weights = np.load(weights_path, mmap_mode='r+')
+    weights[times] = operator  # (n_chunk, n_channels, n_train)
+    weights.flush()
+
+
+def _label_weights(y, method):
+    # Training-label vector c(y) of the weight operator: +-1 targets for ridge, class-mean contrast for LDA
+    y = y.astype(np.float64)
+    if method == 'ridge':
+        return 2 * y - 1
+    n_pos = y.sum(axis=0)
+    n_neg = len(y) - n_pos
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nan_to_num(y / n_pos - (1 - y) / n_neg)
+
+
+def _permutation_chunk(X, test, mean, scale, y_train, y_test, times, method, weights_path):
+    # AUCs of a block of labellings (n_perm, n_targets) for one fold and time chunk; y_train and
+    # y_test are the fold's labels of the block, (n_train, n_perm, n_targets) and (n_test, n_perm, n_targets)
+    n_train, n_perm, n_targets = y_train.shape
+    y_train = y_train.reshape(n_train, -1)
+    y_test = y_test.reshape(len(test), -1)
+
+    weights = np.load(weights_path, mmap_mode='r')[times]  # (n_chunk, n_channels, n_train)
+    coef = weights @ _label_weights(y_train, method)  # (n_chunk, n_channels, n_perm * n_targets)
+    X_test = (X[test, :, times] - mean) / scale  # (n_test, n_channels, n_chunk), float64
+    decision = np.einsum('nct,tck->nkt', X_test, coef)  # (n_test, n_perm * n_targets, n_chunk)
+    auc = roc_auc(y_test, decision)
+
+    # Like the decoders, a labelling with a single class in the training set has undefined scores
+    n_pos = y_train.sum(axis=0)
+    auc[(n_pos == 0) | (n_pos == n_train)] = np.nan
+    return auc.reshape(n_perm, n_targets, -1)
+
+
+def _permutations(n_permutations, n_epochs, groups=None, random_state=0):
+    # Row 0 is the identity (the observed labels); labels are shuffled within groups when given
+    rng = np.random.default_rng(random_state)
+    perms = np.tile(np.arange(n_epochs), (n_permutations + 1, 1))
+    members = [np.arange(n_epochs)] if groups is None else [np.flatnonzero(groups == group) for group in np.unique(groups)]
+    for perm in perms[1:]:
+        for idx in members:
+            perm[idx] = rng.permutation(idx)
+    return perms
+
+
+def _permuted_labels(Y, epochs, perms):
+    # Labellings (n_epochs, n_perm, n_targets) of the full epoch buffer: epoch epochs[i] takes the
+    # labels of perms[:, i]; epochs outside the folds keep theirs (they are never indexed)
+    Y_perm = np.repeat(Y[:, np.newaxis], len(perms), axis=1)
+    Y_perm[epochs] = Y[perms].transpose(1, 0, 2)
+    return Y_perm
+
+
+def _fingerprint(X, Y, folds, groups, method, alpha, n_permutations, random_state):
+    digest = hashlib.sha1()
+    for array in (np.asarray(X.shape), np.asarray(X[0]), np.asarray(X[-1]), Y,
+                  *[np.concatenate(fold) for fold in folds], np.asarray([] if groups is None else groups, dtype=str)):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(json.dumps([method, alpha, n_permutations, random_state, str(get_dtype())]).encode())
+    return digest.hexdigest()
+
+
+def _write_state(work_dir, state):
+    # Atomic replace, so an interrupted run never leaves a partial state file
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=work_dir)
+    with os.fdopen(fd, 'w') as json_file:
+        json.dump(state, json_file)
+    os.replace(tmp_path, os.path.join(work_dir, 'state.json'))
+
+
+def permutation_test(X, Y, folds=None, n_permutations=1000, method='lda', alpha=None, groups=None,
+                     work_dir=None, batch_size=200, block_size=25, n_chunks=None, n_jobs=-1, random_state=0):
+    """
+    Null distribution of the decoding time course under shuffled labels.
+
+    The labels of the epochs in the folds are shuffled (whole rows, so the targets keep their joint
+    distribution) and every shuffled labelling is scored with the same folds, scalers and decoder as
+    decode_timecourse. The fold weight operators are computed once; permutations are then scored in blocks
+    of block_size labellings per (fold, time chunk) task in a single joblib pool, and the null
+    distribution is saved to work_dir after every batch_size permutations.
+
+    Parameters:
+    - X: Epoch or feature array (n_epochs, n_channels, n_times), as passed to decode_timecourse.
+    - Y: Binary labels (n_epochs,) or (n_epochs, n_targets).
+    - folds: Output of make_folds, make_group_folds or index_folds; computed with the defaults if None.
+    - n_permutations: Number of shuffled labellings.
+    - method: Closed-form decoder, 'ridge' or 'lda' (logistic regression has no label-independent factorization).
+    - alpha: Ridge penalty for 'ridge' (default 1.0), shrinkage in [0, 1] for 'lda' (default 0.1).
+    - groups: Optional group label of every epoch (e.g. the 'group' metadata column); labels are then
+      only shuffled within groups.
+    - work_dir: Directory for the weight operators and the checkpoint; a run with the same data and
+      settings resumes from it. None uses a temporary directory without checkpointing.
+    - batch_size: Number of permutations between checkpoints.
+    - block_size: Number of permutations scored per task.
+    - n_chunks: Number of time chunks per fold (defaults to ~50 timepoints each).
+    - n_jobs: Number of worker processes for the joblib pool.
+    - random_state: Seed of the permutations.
+
+    Returns:
+    - observed: Mean ROC-AUC across folds of the true labels, (n_targets, n_times) or (n_times,) for 1-D Y.
+    - null: Mean ROC-AUC across folds of every permutation, (n_permutations, n_targets, n_times) or
+      (n_permutations, n_times) for 1-D Y.
+    """
+    if method not in ('ridge', 'lda'):
+        raise ValueError(f"method should be 'ridge' or 'lda' for permutation tests, got {method!r}")
+    if alpha is None:
+        alpha = 1.0 if method == 'ridge' else 0.1
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            return permutation_test(X, Y, folds, n_permutations, method, alpha, groups, tmp_dir,
+                                    batch_size, block_size, n_chunks, n_jobs, random_state)
+
+    Y = np.asarray(Y, dtype=int)
+    squeeze = Y.ndim == 1
+    if squeeze:
+        Y = Y[:, None]
+    if folds is None:
+        folds = make_folds(len(X))
+    n_targets, n_times = Y.shape[1], X.shape[-1]
+    chunks = _chunks(n_times, n_chunks, 50)
+
+    # Only the epochs in the folds (e.g. the selected epochs of a shared buffer) exchange labels
+    epochs = np.unique(np.concatenate([test for _, test in folds]))
+    perms = epochs[_permutations(n_permutations, len(epochs), None if groups is None else np.asarray(groups)[epochs],
+                                 random_state)]
+
+    os.makedirs(work_dir, exist_ok=True)
+    key = _fingerprint(X, Y, folds, groups, method, alpha, n_permutations, random_state)
+    state_path = os.path.join(work_dir, 'state.json')
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as json_file:
+            state = json.load(json_file)
+    if state.get('key') != key:
+        state = {'key': key, 'weights': False, 'n_done': 0}
+
+    weights_paths = [os.path.join(work_dir, f'weights-fold{ii}.npy') for ii in range(len(folds))]
+    null_path = os.path.join(work_dir, 'null.npy')
+    scalers = [[(mean[:, times], scale[:, times]) for times in chunks] for mean, scale in fold_scalers(X, folds)]
+    with Parallel(n_jobs=n_jobs) as parallel:
+        if not state.get('weights'):
+            for weights_path, (train, _) in zip(weights_paths, folds):
+                np.lib.format.open_memmap(weights_path, mode='w+', dtype=get_dtype(),
+                                          shape=(int(n_times), X.shape[1], len(train))).flush()
+            parallel(
+                delayed(_weights_chunk)(X, train, mean, scale, times, method, alpha, weights_path)
+                for weights_path, (train, _), fold_scaler in zip(weights_paths, folds, scalers)
+                for times, (mean, scale) in zip(chunks, fold_scaler)
+            )
+            np.lib.format.open_memmap(null_path, mode='w+', dtype=np.float32,
+                                      shape=(n_permutations + 1, n_targets, int(n_times))).flush()
+            state.update(weights=True, n_done=0)
+            _write_state(work_dir, state)
+        elif state['n_done']:
+            print(f"Resuming permutations from {state['n_done'] - 1}/{n_permutations}")
+
+        null = np.load(null_path, mmap_mode='r+')
+        # Row 0 of the permutations is the identity, scored along with the first batch
+        for start in range(state['n_done'], n_permutations + 1, batch_size):
+            stop = min(start + batch_size, n_permutations + 1)
+            blocks = [slice(ii, min(ii + block_size, stop)) for ii in range(start, stop, block_size)]
+            # Labellings of a block are built once and sliced per fold, not in every task
+            labels = [_permuted_labels(Y, epochs, perms[block]) for block in blocks]
+            results = parallel(
+                delayed(_permutation_chunk)(X, test, mean, scale, Y_perm[train], Y_perm[test],
+                                            times, method, weights_path)
+                for Y_perm in labels
+                for weights_path, (train, test), fold_scaler in zip(weights_paths, folds, scalers)
+                for times, (mean, scale) in zip(chunks, fold_scaler)
+            )
+            # Results are ordered by block, fold, then chunk
+            results = iter(results)
+            for block in blocks:
+                fold_scores = [np.concatenate([next(results) for _ in chunks], axis=-1) for _ in folds]
+                null[block] = np.mean(fold_scores, axis=0)
+            null.flush()
+            state['n_done'] = stop
+            _write_state(work_dir, state)
+            print(f"Permutations {stop - 1}/{n_permutations}")
+
+        scores = np.array(null)
+    del null
+    observed, null = scores[0], scores[1:]
+    return (observed[0], null[:, 0]) if squeeze else (observed, null)
+
+
+def find_clusters(mask):
+    """
+    Contiguous runs of True in a 1-D mask.
+
+    Returns:
+    - clusters: List of slices, one per run.
+    """
+    edges = np.flatnonzero(np.diff(np.r_[0, np.asarray(mask, dtype=int), 0]))
+    return [slice(start, stop) for start, stop in zip(edges[::2], edges[1::2])]
+
+
+def _max_cluster_mass(auc, threshold, chance):
+    above = np.where(np.isfinite(auc) & (auc > threshold), auc - chance, 0.0)
+    return max((above[cluster].sum() for cluster in find_clusters(above > 0)), default=0.0)
+
+
+def cluster_test(observed, null, threshold=None, p_threshold=0.05, chance=0.5):
+    """
+    Temporal cluster-based permutation test of a decoding time course (above-chance clusters).
+
+    Timepoints above the threshold form clusters of adjacent timepoints; a cluster's mass is the sum
+    of (AUC - chance) over its timepoints. Each observed cluster is compared with the largest cluster
+    mass of every permutation, which controls the family-wise error over time.
+
+    Parameters:
+    - observed: ROC-AUC time course (n_times,), e.g. one target of permutation_test's observed.
+    - null: Permutation AUCs (n_permutations, n_times) of the same target.
+    - threshold: AUC a timepoint must exceed to join a cluster; default the per-timepoint
+      (1 - p_threshold) quantile of null.
+    - p_threshold: Cluster-forming level of the default threshold.
+    - chance: Chance level of the score.
+
+    Returns:
+    - pointwise_p: Uncorrected permutation p-value of every timepoint (n_times,).
+    - clusters: DataFrame with one row per observed cluster: 'start' and 'stop' timepoint indices
+      (stop exclusive), 'mass' and the corrected 'p'.
+    """
+    observed = np.asarray(observed, dtype=float)
+    null = np.asarray(null, dtype=float)
+    n_permutations = len(null)
+    if threshold is None:
+        threshold = np.nanquantile(null, 1 - p_threshold, axis=0)
+
+    with np.errstate(invalid='ignore'):
+        pointwise_p = (1 + (null >= observed).sum(axis=0)) / (n_permutations + 1)
+    pointwise_p[~np.isfinite(observed)] = np.nan
+
+    null_mass = np.array([_max_cluster_mass(auc, threshold, chance) for auc in null])
+    above = np.where(np.isfinite(observed) & (observed > threshold), observed - chance, 0.0)
+    rows = []
+    for cluster in find_clusters(above > 0):
+        mass = above[cluster].sum()
+        rows.append({'start': cluster.start, 'stop': cluster.stop, 'mass': mass,
+                     'p': (1 + (null_mass >= mass).sum()) / (n_permutations + 1)})
+    return pointwise_p, pd.DataFrame(rows, columns=['start', 'stop', 'mass', 'p'])
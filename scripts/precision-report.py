@@ -0,0 +1,89 @@
+# Validation report for the float32 data path: the same segment is preprocessed, epoched and decoded
+# once in float64 and once in float32, and the differences in the evoked response and the decoding
+# AUC are written to derivatives/individual/precision/.
+
+import os
+import mne
+import numpy as np
+import pandas as pd
+from cache import load_preprocessed
+from decoding import make_folds, decode_timecourse
+from annotation_index import load_annotation_index
+from precision import get_dtype
+
+features = ['phonation', 'manner', 'place', 'roundness', 'frontback']
+desired_values = {'phonation': 'v', 'manner': 'f', 'place': 'm', 'roundness': 'r', 'frontback': 'f'}
+
+
+def run_precision(fif_path, cache_dir, annotation_index, stim, precision, decoding_sfreq=100.0):
+    # Same preprocessing as 6-phoneme-decoding.py, with the cache stored in the given precision
+    raw_car = load_preprocessed(fif_path, cache_dir, l_freq=1.0, h_freq=30.0, reference='average',
+                                precision=precision)
+    sampling_rate = raw_car.info['sfreq']
+    phoneme_events, phoneme_metadata = annotation_index.events('phonemes', stim, sampling_rate)
+    phoneme_epochs = mne.Epochs(raw_car, phoneme_events, tmin=-0.2, tmax=0.6, preload=True, baseline=None,
+                                metadata=phoneme_metadata)
+
+    evoked = phoneme_epochs.average()
+
+    # The Raw and epochs are float64 in both runs (only the cache entry is stored in the given precision);
+    # the decoding features are cast to it
+    decim = max(1, int(round(sampling_rate / decoding_sfreq)))
+    X = np.ascontiguousarray(phoneme_epochs.get_data(copy=False)[..., ::decim], dtype=get_dtype(precision))
+    Y = np.column_stack([(phoneme_epochs.metadata[feat] == desired_values[feat]).values for feat in features]).astype(int)
+    folds = make_folds(len(X), n_splits=5)
+    scores = decode_timecourse(X, Y, folds=folds, n_jobs=-1)
+
+    # Size of the cached continuous data as stored
+    cache_mb = len(raw_car.ch_names) * raw_car.n_times * get_dtype(precision).itemsize / 1024 ** 2
+    return {'evoked': evoked.data, 'scores': scores, 'cache_mb': cache_mb,
+            'features_mb': X.nbytes / 1024 ** 2}
+
+
+def compare(reference, result):
+    rows = []
+    evoked_diff = np.abs(result['evoked'] - reference['evoked'])
+    rows.append({'measure': 'evoked', 'max_abs_diff': evoked_diff.max(), 'mean_abs_diff': evoked_diff.mean(),
+                 'relative_diff': evoked_diff.max() / np.abs(reference['evoked']).max(),
+                 'correlation': np.corrcoef(result['evoked'].ravel(), reference['evoked'].ravel())[0, 1]})
+    for ii, feat in enumerate(features):
+        ref_auc, auc = reference['scores'][ii], result['scores'][ii]
+        valid = np.isfinite(ref_auc) & np.isfinite(auc)
+        auc_diff = np.abs(auc[valid] - ref_auc[valid])
+        rows.append({'measure': f'auc_{feat}', 'max_abs_diff': auc_diff.max(initial=0.0),
+                     'mean_abs_diff': auc_diff.mean() if valid.any() else np.nan,
+                     'correlation': np.corrcoef(auc[valid], ref_auc[valid])[0, 1] if valid.sum() > 1 else np.nan})
+    # Memory of the cached continuous data and the decoding features, with the float32 / float64 ratio
+    for name in ('cache_mb', 'features_mb'):
+        rows.append({'measure': name, 'float64': reference[name], 'float32': result[name],
+                     'ratio': result[name] / reference[name]})
+    return pd.DataFrame(rows, columns=['measure', 'max_abs_diff', 'mean_abs_diff', 'relative_diff', 'correlation',
+                                       'float64', 'float32', 'ratio'])
+
+
+def main():
+    # Set parameters for fif path
+    sub = 'pilot-3'
+    stim = 'Jobs1'
+    seg = 'segment_1'
+
+    base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
+    fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
+    cache_dir = os.path.join(base_path, 'derivatives', 'cache')
+    report_dir = os.path.join(base_path, 'derivatives', 'individual', 'precision')
+    os.makedirs(report_dir, exist_ok=True)
+
+    annotation_index = load_annotation_index(base_path)
+    reference = run_precision(fif_path, cache_dir, annotation_index, stim, 'float64')
+    result = run_precision(fif_path, cache_dir, annotation_index, stim, 'float32')
+
+    # relative_diff is max |diff| / max |evoked| of the float64 evoked response
+    report = compare(reference, result)
+    print(report.to_string(index=False))
+    report_path = os.path.join(report_dir, f'{sub}_{seg}_{stim}_precision-report.tsv')
+    report.to_csv(report_path, sep='\t', index=False)
+    print(f"Precision report saved to '{report_path}'")
+
+
+if __name__ == '__main__':
+    main()
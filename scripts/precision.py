@@ -0,0 +1,28 @@
+# Pipeline-wide floating point precision of the stored and decoded data.
+# Set EEG_PRECISION=float32 (or "precision": "float32" in the batch config) to keep the arrays the
+# pipeline owns (preprocessed cache entries, decoding feature matrices, permutation weights) in single
+# precision, halving their size. MNE objects (Raw, Epochs) always hold float64 data, as MNE expects.
+
+import os
+import numpy as np
+
+PRECISION_ENV = 'EEG_PRECISION'
+PRECISIONS = ('float64', 'float32')
+
+
+def get_dtype(precision=None):
+    """
+    Resolve a precision name to a numpy dtype.
+
+    Parameters:
+    - precision: 'float64' or 'float32'; if None, the EEG_PRECISION environment variable (default 'float64').
+
+    Returns:
+    - dtype: np.dtype('float64') or np.dtype('float32').
+    """
+    if precision is None:
+        precision = os.environ.get(PRECISION_ENV, 'float64')
+    precision = np.dtype(precision).name
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision should be one of {PRECISIONS}, got {precision!r}")
+    return np.dtype(precision)
@@ -0,0 +1,82 @@
+# Helpers for finding trigger runs and cutting the continuous EGI recording into one FIF per story segment
+
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import mne
+
+
+def find_event_runs(samples, codes, sfreq, max_gap_sec=20.0, split_on_code=True, min_events=1):
+    """
+    Split trigger events into runs (story segments, tone blocks) without a Python loop over events.
+
+    A new run starts wherever the gap to the previous trigger exceeds max_gap_sec or, with
+    split_on_code, wherever the event code changes.
+
+    Parameters:
+    - samples: Trigger sample indices (first column of mne.find_events).
+    - codes: Trigger event codes (third column of mne.find_events).
+    - sfreq: Sampling rate in Hz.
+    - max_gap_sec: Largest gap in seconds allowed between triggers of the same run.
+    - split_on_code: Whether a change of event code also starts a new run.
+    - min_events: Runs with fewer triggers than this are dropped (e.g. stray test triggers).
+
+    Returns:
+    - runs: DataFrame with one row per run: start and end (seconds), event, duration (seconds),
+      start_sample and end_sample (first and last trigger samples), and n_events.
+    """
+    samples = np.asarray(samples)
+    codes = np.asarray(codes)
+    order = np.argsort(samples, kind='stable')
+    samples, codes = samples[order], codes[order]
+
+    breaks = np.diff(samples) > max_gap_sec * sfreq
+    if split_on_code:
+        breaks |= codes[1:] != codes[:-1]
+
+    first = np.r_[0, np.flatnonzero(breaks) + 1] if len(samples) else np.array([], dtype=int)
+    last = np.r_[first[1:] - 1, len(samples) - 1] if len(samples) else np.array([], dtype=int)
+
+    runs = pd.DataFrame({
+        'start': samples[first] / sfreq,
+        'end': samples[last] / sfreq,
+        'event': codes[first],
+        'duration': (samples[last] - samples[first]) / sfreq,
+        'start_sample': samples[first],
+        'end_sample': samples[last],
+        'n_events': last - first + 1,
+    })
+    return runs[runs['n_events'] >= min_events].reset_index(drop=True)
+
+
+def save_segment(raw, start_sample, stop_sample, fif_path, chunk_sec=10.0):
+    """
+    Copy samples [start_sample, stop_sample) of a non-preloaded recording into a FIF in bounded chunks.
+
+    The segment is filled chunk by chunk into an on-disk buffer next to the output file and written
+    from there with the same chunk size, so peak memory is a few chunk buffers rather than the full
+    recording. The saved segment starts at first_samp 0, like the RawArray segments it replaces, so
+    annotation onsets in seconds still map directly to event samples.
+
+    Parameters:
+    - raw: Raw object opened with preload=False (e.g. from mne.io.read_raw_egi).
+    - start_sample: First sample of the segment.
+    - stop_sample: Sample after the last sample of the segment.
+    - fif_path: Output FIF path.
+    - chunk_sec: Chunk length in seconds for both reading and writing.
+    """
+    chunk = int(np.ceil(chunk_sec * raw.info['sfreq']))
+    n_samples = stop_sample - start_sample
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(fif_path)) as tmp_dir:
+        buffer = np.lib.format.open_memmap(os.path.join(tmp_dir, 'segment.npy'), mode='w+', dtype=np.float64,
+                                           shape=(raw.info['nchan'], n_samples))
+        for start in range(start_sample, stop_sample, chunk):
+            stop = min(start + chunk, stop_sample)
+            buffer[:, start - start_sample:stop - start_sample] = raw.get_data(start=start, stop=stop)
+
+        # RawArray keeps the memory-mapped buffer as its data instead of copying it
+        segment_raw = mne.io.RawArray(buffer, raw.info, verbose='WARNING')
+        segment_raw.save(fif_path, buffer_size_sec=chunk_sec, overwrite=True)
+        del segment_raw, buffer
@@ -0,0 +1,145 @@
+# One ICA per subject: fitted once on a 1 Hz high-passed, downsampled copy of all of the subject's
+# segments (bad channels interpolated, as in the per-segment preprocessing), stored on disk under a
+# name derived from the fit parameters, and applied (at full rate) to each of the nine segments.
+
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+import mne
+import pandas as pd
+from mne.preprocessing import ICA, read_ica
+from batch import discover_jobs
+from ica_selection import select_components
+from bad_channels import detect_bad_channels, interpolate_bads_cached
+
+
+def subject_ica_path(base_path, sub, fit_params=None):
+    """
+    Path of the stored subject ICA. The name includes a digest of the fit parameters, so scripts
+    fitting with different settings (e.g. n_components or random_state) never share a file.
+    """
+    tag = hashlib.sha1(json.dumps(fit_params or {}, sort_keys=True, default=str).encode()).hexdigest()[:10]
+    return os.path.join(base_path, 'derivatives', 'individual', 'ica', sub, f'{sub}-{tag}-ica.fif')
+
+
+@contextmanager
+def _file_lock(lock_path):
+    # Exclusive lock, so parallel batch jobs of the same subject wait for one fit instead of each fitting
+    try:
+        import fcntl
+    except ImportError:
+        # Not available on this platform (e.g. Windows), run unguarded
+        yield
+        return
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def prepare_fit_data(fif_path, bads=None, l_freq=1.0, fit_sfreq=100.0, interpolation_cache_dir=None):
+    """
+    Load a segment and return the copy the ICA is fitted on: bad channels interpolated, high-passed
+    at l_freq and resampled to fit_sfreq. ICA is a spatial filter, so the unmixing fitted here applies
+    to the full-rate data.
+
+    Parameters:
+    - fif_path: Segment FIF path.
+    - bads: Bad channel names to interpolate before the fit; if None they are detected in this
+      segment with bad_channels.detect_bad_channels, as in the per-segment preprocessing.
+    - l_freq: High-pass edge in Hz; slow drifts otherwise dominate the decomposition.
+    - fit_sfreq: Sampling rate of the fit copy in Hz (the resampling includes the anti-alias low-pass).
+    - interpolation_cache_dir: Optional directory of the interpolation matrix cache.
+
+    Returns:
+    - raw: Preprocessed copy, annotations kept for reject_by_annotation.
+    """
+    raw = mne.io.read_raw_fif(fif_path, preload=True, verbose='WARNING')
+    if bads is None:
+        bads, _ = detect_bad_channels(raw)
+    raw.info['bads'] = list(bads)
+    interpolate_bads_cached(raw, cache_dir=interpolation_cache_dir)
+    raw.filter(l_freq=l_freq, h_freq=None, verbose='WARNING')
+    if raw.info['sfreq'] > fit_sfreq:
+        raw.resample(fit_sfreq, verbose='WARNING')
+    return raw
+
+
+def fit_ica(fif_paths, bads=None, n_components=20, l_freq=1.0, fit_sfreq=100.0, reject_by_annotation=True,
+            random_state=97, interpolation_cache_dir=None, **selection_kwargs):
+    """
+    Fit one ICA on the fit copies of several segments and select the components to exclude.
+
+    Parameters:
+    - fif_paths: Segment FIF paths of one subject.
+    - bads: Bad channel names interpolated in every segment, or None to detect them per segment.
+    - n_components: Number of ICA components.
+    - l_freq, fit_sfreq, interpolation_cache_dir: See prepare_fit_data.
+    - reject_by_annotation: Whether spans annotated as BAD (e.g. BAD_artifact) are left out of the fit.
+    - random_state: Seed of the ICA.
+    - selection_kwargs: Passed to ica_selection.propose_exclusions.
+
+    Returns:
+    - ica: Fitted ICA with ica.exclude set.
+    - scores: Component scores from ica_selection.score_components.
+    """
+    fit_raw = mne.concatenate_raws([prepare_fit_data(fif_path, bads, l_freq, fit_sfreq, interpolation_cache_dir)
+                                    for fif_path in fif_paths])
+    ica = ICA(n_components=n_components, random_state=random_state)
+    ica.fit(fit_raw, reject_by_annotation=reject_by_annotation)
+    scores = select_components(ica, fit_raw, **selection_kwargs)
+    return ica, scores
+
+
+def load_subject_ica(base_path, sub, bads=None, refit=False, **fit_kwargs):
+    """
+    Return the subject's ICA for these fit parameters, fitting it on all of the subject's segments
+    only if none is stored yet.
+
+    The fit runs under a file lock, so when several batch jobs of the same subject start together one
+    of them fits and the others wait and load the stored ICA. The parameters are saved next to the
+    ICA in a -ica.json file.
+
+    Parameters:
+    - base_path: Base directory path for the project.
+    - sub: Subject identifier.
+    - bads: Bad channel names interpolated in every segment before the fit, or None to detect and
+      interpolate them per segment (see prepare_fit_data).
+    - refit: Whether to fit again even if an ICA is stored.
+    - fit_kwargs: Passed to fit_ica.
+
+    Returns:
+    - ica: Fitted ICA with ica.exclude set, ready for ica.apply(raw) on any of the subject's segments.
+    """
+    fit_kwargs.setdefault('interpolation_cache_dir', os.path.join(base_path, 'derivatives', 'cache', 'interpolation'))
+    # The cache directory does not change the fit, so it is left out of the file name
+    fit_params = {'bads': None if bads is None else sorted(bads),
+                  **{key: value for key, value in fit_kwargs.items() if key != 'interpolation_cache_dir'}}
+    ica_path = subject_ica_path(base_path, sub, fit_params)
+    if os.path.exists(ica_path) and not refit:
+        print(f"Loading subject ICA from: {ica_path}")
+        return read_ica(ica_path, verbose='WARNING')
+
+    os.makedirs(os.path.dirname(ica_path), exist_ok=True)
+    with _file_lock(ica_path[:-len('-ica.fif')] + '.lock'):
+        # Another job may have finished the fit while this one waited for the lock
+        if os.path.exists(ica_path) and not refit:
+            print(f"Loading subject ICA from: {ica_path}")
+            return read_ica(ica_path, verbose='WARNING')
+
+        fif_paths = [job['fif_path'] for job in discover_jobs(base_path, [sub])]
+        print(f"Fitting ICA for {sub} on {len(fif_paths)} segments")
+        ica, scores = fit_ica(fif_paths, bads=bads, **fit_kwargs)
+
+        # Save under a temporary name first so parallel jobs never read a partial file
+        tmp_path = ica_path[:-len('-ica.fif')] + f'.tmp{os.getpid()}-ica.fif'
+        ica.save(tmp_path, overwrite=True)
+        os.replace(tmp_path, ica_path)
+        scores.to_csv(ica_path[:-len('-ica.fif')] + '-ica-scores.tsv', sep='\t', index=False)
+        with open(ica_path[:-len('.fif')] + '.json', 'w') as json_file:
+            json.dump(fit_params, json_file, default=str)
+    print(f"Subject ICA saved to: {ica_path}")
+    return ica
@@ -2,79 +2,87 @@ import mne
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sklearn.preprocessing import StandardScaler
-from sklearn.linear_model import LogisticRegression
-from sklearn.pipeline import make_pipeline
-from sklearn.model_selection import cross_val_score, KFold
 import os
 import csv
 import pandas as pd
+import json
+import hashlib
+from cache import load_preprocessed
+from annotation_index import load_annotation_index
+from decoding import make_folds, label_matrix, selected_epochs, fold_scalers, bin_times, decode_timecourse, generalize_timecourse, save_generalization, load_generalization
+from precision import get_dtype
 
 
-def load_and_preprocess_data(fif_path):
-    raw = mne.io.read_raw_fif(fif_path, preload=True)
-    raw.filter(l_freq=1.0, h_freq=30.0)
-    raw.set_eeg_reference(['VREF'])
-    eeg_channels = [ch for ch in raw.ch_names if ch.startswith('E')]
-    raw.pick_channels(eeg_channels)
-    raw_car = raw.set_eeg_reference('average', projection=True)
+def load_and_preprocess_data(fif_path, cache_dir, l_freq=1.0, h_freq=30.0, reference='VREF+average'):
+    # Band-pass filtered, CAR referenced 'E' channels, cached on disk and memory-mapped on later runs
+    raw_car = load_preprocessed(fif_path, cache_dir, l_freq=l_freq, h_freq=h_freq, reference=reference)
     return raw_car
 
 
-def create_phoneme_epochs(raw_car, phoneme_info, sampling_rate):
-    phoneme_onsets = (phoneme_info['Start'].values * sampling_rate).astype(int)
-    phoneme_events = np.column_stack((phoneme_onsets, np.zeros_like(phoneme_onsets), np.ones_like(phoneme_onsets)))
-    min_len = min(len(phoneme_events), len(phoneme_info))
-    phoneme_events = phoneme_events[:min_len]
-    phoneme_info = phoneme_info[:min_len]
-    phoneme_epochs = mne.Epochs(raw_car, phoneme_events, tmin=-0.2, tmax=0.6, preload=True, baseline=None,
-                                event_repeated='drop')
-
-    # Align metadata with epochs
-    phoneme_epochs.metadata = phoneme_info.iloc[phoneme_epochs.selection]
+def create_phoneme_epochs(raw_car, phoneme_events, phoneme_metadata, tmin=-0.2, tmax=0.6):
+    # Events come from the annotation index (rounded onsets, coincident onsets dropped); passing the
+    # metadata to mne.Epochs keeps it aligned with any epochs dropped at the segment edges
+    phoneme_epochs = mne.Epochs(raw_car, phoneme_events, tmin=tmin, tmax=tmax, preload=True, baseline=None,
+                                metadata=phoneme_metadata)
 
     return phoneme_epochs
 
+
+def desired_values_dict(desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value):
+    return {
+        'phonation': desired_phonation_value,
+        'manner': desired_manner_value,
+        'place': desired_place_value,
+        'roundness': desired_roundness_value,
+        'frontback': desired_frontback_value
+    }
+
+
 def filter_epochs(epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value):
-    conditions = [
-        (epochs.metadata['phonation'] == desired_phonation_value),
-        (epochs.metadata['manner'] == desired_manner_value),
-        (epochs.metadata['place'] == desired_place_value),
-        (epochs.metadata['roundness'] == desired_roundness_value),
-        (epochs.metadata['frontback'] == desired_frontback_value)
-    ]
-    filtered_epochs = epochs[np.logical_and.reduce(conditions)]
+    # Epochs matching at least one feature, as in 6-phoneme-decoding.py; requiring all of them would
+    # leave every label column with a single class
+    desired_values = desired_values_dict(desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value)
+    filtered_epochs = epochs[selected_epochs(label_matrix(epochs.metadata, desired_values))]
     return filtered_epochs
 
 
-def perform_decoding(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value):
-    clf = make_pipeline(StandardScaler(), LogisticRegression(solver='liblinear'))
-    cv = KFold(5, shuffle=True)
-    accuracy_dict = {}
+def build_labels(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value):
+    labels = label_matrix(filtered_epochs.metadata, desired_values_dict(desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value))
+    return list(labels.columns), labels.values.astype(int)
 
-    for feat, label, color in zip(['phonation', 'manner', 'place', 'roundness', 'frontback'],
-                                  ['Voiced', 'Fricatives', 'Vowels', 'Rounded', 'Front'],
-                                  ['indigo', 'darkorchid', 'plum', 'pink', 'palevioletred']):
-        desired_value = {
-            'phonation': desired_phonation_value,
-            'manner': desired_manner_value,
-            'place': desired_place_value,
-            'roundness': desired_roundness_value,
-            'frontback': desired_frontback_value
-        }[feat]
-        y = (filtered_epochs.metadata[feat] == desired_value).astype(int)
-        accuracy_scores = np.empty(filtered_epochs.get_data().shape[-1])
-
-        for tt in range(accuracy_scores.shape[0]):
-            X_ = filtered_epochs.get_data()[:, :, tt]
-            scores = cross_val_score(clf, X_, y, scoring='roc_auc', cv=cv, n_jobs=-1)
-            accuracy_scores[tt] = scores.mean()
-
-        accuracy_dict[feat] = accuracy_scores
+
+def perform_decoding(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value, folds=None):
+    features, Y = build_labels(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value)
+
+    # Pull the epoch array once, in the pipeline precision (EEG_PRECISION); folds and per-fold scalers
+    # are shared by every timepoint and every feature
+    X = filtered_epochs.get_data(copy=False).astype(get_dtype(), copy=False)
+    if folds is None:
+        folds = make_folds(len(X), n_splits=5)
+    scores = decode_timecourse(X, Y, folds=folds, n_jobs=-1)
+
+    accuracy_dict = {feat: scores[ii] for ii, feat in enumerate(features)}
 
     return accuracy_dict
 
 
+def perform_generalization(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value, folds=None, decim=1, bin_size=1):
+    features, Y = build_labels(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value)
+
+    # Bin and decimate first so the train-time x test-time matrix stays small
+    X, times = bin_times(filtered_epochs.get_data(copy=False).astype(get_dtype(), copy=False), filtered_epochs.times,
+                         decim=decim, bin_size=bin_size)
+    if folds is None:
+        folds = make_folds(len(X), n_splits=5)
+    scalers = fold_scalers(X, folds)
+    scores = generalize_timecourse(X, Y, folds=folds, scalers=scalers, n_jobs=-1)
+
+    generalization_dict = {feat: scores[ii] for ii, feat in enumerate(features)}
+    labels = {feat: Y[:, ii] for ii, feat in enumerate(features)}
+
+    return generalization_dict, times, labels
+
+
 def visualize_results(filtered_epochs, accuracy_dict, fig_path, sub, seg, stim):
     y_min = 0.45
     y_max = 0.75
@@ -106,24 +114,79 @@ def save_accuracy_scores(accuracy_dict, base_path):
             writer.writerow([key, scores])
 
 
+def generalization_key(params):
+    # Digest of everything the matrices depend on (epoch window, filter, reference, resampling, label
+    # values and time reduction), so changing any of them never reuses an old matrix
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:10]
+
+
+def generalization_file(gen_dir, sub, seg, stim, feat, params):
+    return os.path.join(gen_dir, sub, f'{sub}_{seg}_{stim}_{feat}-{generalization_key(params)}_generalization.npz')
+
+
+def save_generalization_scores(generalization_dict, times, labels, gen_dir, sub, seg, stim, params):
+    os.makedirs(os.path.join(gen_dir, sub), exist_ok=True)
+    for feat, scores in generalization_dict.items():
+        if len(np.unique(labels[feat])) < 2:
+            # Undefined scores are not cached, so the feature is recomputed once the labels allow it
+            print(f"Not saving the {feat} generalization matrix: its labels have a single class")
+            continue
+        save_generalization(generalization_file(gen_dir, sub, seg, stim, feat, params), scores, times, y=labels[feat])
+    # Parameters behind the digest in the file names
+    with open(os.path.join(gen_dir, sub, f'{sub}_{seg}_{stim}-{generalization_key(params)}_generalization.json'), 'w') as json_file:
+        json.dump(params, json_file, indent=2, default=str)
+
+
+def load_generalization_scores(features, gen_dir, sub, seg, stim, params):
+    # Returns None if any feature still has to be computed
+    paths = [generalization_file(gen_dir, sub, seg, stim, feat, params) for feat in features]
+    if not all(os.path.exists(path) for path in paths):
+        return None, None
+    generalization_dict = {}
+    for feat, path in zip(features, paths):
+        generalization_dict[feat], times = load_generalization(path)
+    return generalization_dict, times
+
+
+def visualize_generalization(generalization_dict, times, fig_path, sub, seg, stim):
+    fig, axes = plt.subplots(1, len(generalization_dict), figsize=(4 * len(generalization_dict), 4), sharey=True)
+    fig.suptitle(f"Temporal Generalization for {sub}")
+    extent = [times[0], times[-1], times[0], times[-1]]
+
+    for ax, (feat, label) in zip(axes, zip(['phonation', 'manner', 'place', 'roundness', 'frontback'],
+                                          ['Voiced', 'Fricatives', 'Vowels', 'Rounded', 'Front'])):
+        im = ax.imshow(generalization_dict[feat], origin='lower', extent=extent, cmap='RdBu_r', vmin=0.35, vmax=0.65)
+        ax.axvline(x=0, color='grey', linestyle='--')
+        ax.axhline(y=0, color='grey', linestyle='--')
+        ax.set_title(label)
+        ax.set_xlabel("Test time (s)")
+    axes[0].set_ylabel("Train time (s)")
+    fig.colorbar(im, ax=axes, label="ROC-AUC")
+    plt.savefig(f'{fig_path}/{sub}_{seg}_{stim}_generalization.jpg', dpi=300, bbox_inches='tight')
+    plt.show()
+
+
 def main():
     # Set parameters for fif path
     sub = 'pilot-3'
     stim = 'Jobs3'
     seg = 'segment_3'
     comp = 'no-ica'
+    mode = 'diagonal'  # two options: 'diagonal' or 'generalization'
+    decim = 1  # keep every n-th sample for the generalization matrix
+    bin_size = 5  # average n samples per bin for the generalization matrix
 
     base_path = '/Users/derekrosenzweig/Documents/GitHub/EEG-Preprocessing'
-    phoneme_path = f'{base_path}/annotations/phonemes/tsv/{stim}-phonemes.tsv'
     fif_path = f'{base_path}/segmented_data/{sub}/{sub}_{seg}_{stim}_eeg.fif'
     fig_path = os.path.join(base_path, 'vis', 'individual', 'phoneme-decode')
     os.makedirs(fig_path, exist_ok=True)
+    cache_dir = os.path.join(base_path, 'derivatives', 'cache')
+    gen_dir = os.path.join(base_path, 'derivatives', 'individual', 'time_generalization')
+    features = ['phonation', 'manner', 'place', 'roundness', 'frontback']
 
-    sampling_rate = mne.io.read_raw_fif(fif_path, preload=False).info['sfreq']
-
-    raw_car = load_and_preprocess_data(fif_path)
-    phoneme_info = pd.read_csv(phoneme_path, delimiter='\t', encoding='utf-8')
-    phoneme_epochs = create_phoneme_epochs(raw_car, phoneme_info, sampling_rate)
+    tmin, tmax = -0.2, 0.6  # phoneme epoch window in seconds
+    l_freq, h_freq, reference = 1.0, 30.0, 'VREF+average'
+    resample_sfreq = 500
 
     desired_phonation_value = 'v'
     desired_manner_value = 'f'
@@ -131,12 +194,39 @@ def main():
     desired_roundness_value = 'r'
     desired_frontback_value = 'f'
 
-    filtered_epochs = filter_epochs(phoneme_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value)
-    filtered_epochs.resample(500)
+    # Everything the generalization matrices depend on, hashed into their file names
+    params = {'tmin': tmin, 'tmax': tmax, 'l_freq': l_freq, 'h_freq': h_freq, 'reference': reference,
+              'resample_sfreq': resample_sfreq, 'decim': decim, 'bin_size': bin_size,
+              'desired_values': desired_values_dict(desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value)}
+
+    # Cached generalization matrices are checked before anything is loaded or epoched
+    if mode == 'generalization':
+        generalization_dict, times = load_generalization_scores(features, gen_dir, sub, seg, stim, params)
+        if generalization_dict is not None:
+            visualize_generalization(generalization_dict, times, fig_path, sub, seg, stim)
+            print("Decoding analysis completed.")
+            return
+
+    sampling_rate = mne.io.read_raw_fif(fif_path, preload=False).info['sfreq']
+
+    raw_car = load_and_preprocess_data(fif_path, cache_dir, l_freq=l_freq, h_freq=h_freq, reference=reference)
+    phoneme_events, phoneme_metadata = load_annotation_index(base_path).events('phonemes', stim, sampling_rate)
+    phoneme_epochs = create_phoneme_epochs(raw_car, phoneme_events, phoneme_metadata, tmin=tmin, tmax=tmax)
 
-    accuracy_dict = perform_decoding(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value)
-    visualize_results(filtered_epochs, accuracy_dict, fig_path, sub, seg, stim)
-    save_accuracy_scores(accuracy_dict, base_path)
+    filtered_epochs = filter_epochs(phoneme_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value)
+    filtered_epochs.resample(resample_sfreq)
+
+    # Both modes reuse the same folds
+    folds = make_folds(len(filtered_epochs), n_splits=5)
+
+    if mode == 'diagonal':
+        accuracy_dict = perform_decoding(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value, folds=folds)
+        visualize_results(filtered_epochs, accuracy_dict, fig_path, sub, seg, stim)
+        save_accuracy_scores(accuracy_dict, base_path)
+    else:
+        generalization_dict, times, labels = perform_generalization(filtered_epochs, desired_phonation_value, desired_manner_value, desired_place_value, desired_roundness_value, desired_frontback_value, folds=folds, decim=decim, bin_size=bin_size)
+        save_generalization_scores(generalization_dict, times, labels, gen_dir, sub, seg, stim, params)
+        visualize_generalization(generalization_dict, times, fig_path, sub, seg, stim)
     print("Decoding analysis completed.")
 
 